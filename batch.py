@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+import pricing.pricing as pricing
+import argparse
+import csv
+import datetime
+import json
+import os
+import sys
+
+
+def read_tasks(file_name):
+    """
+    Reads pharmacies to price from a CSV or JSON file
+
+    Every row has enterprise, serial_number and ID_Branch values,
+    tasks API names Code and SerialNumber are accepted too.
+
+    returns a list of tuples (enterprise code, serial number, ID_Branch)
+    """
+
+    if os.path.splitext(file_name)[1].lower() == '.json':
+        with open(file_name, 'r') as file:
+            rows = json.load(file)
+        if isinstance(rows, dict):
+            rows = rows.get('Items', [])
+    else:
+        with open(file_name, 'r', newline='') as file:
+            rows = list(csv.DictReader(file))
+
+    tasks = []
+    for row in rows:
+        enterprise = row.get('enterprise', row.get('Code'))
+        serial_number = row.get('serial_number', row.get('SerialNumber'))
+        pharm_id = row.get('ID_Branch') or ''
+        if not enterprise or not serial_number:
+            continue
+
+        tasks.append((int(enterprise), int(serial_number), str(pharm_id)))
+
+    return tasks
+
+
+def write_summary(file_name, results, started, finished, settings):
+    summary = {
+        'started': started.isoformat(),
+        'finished': finished.isoformat(),
+        'seconds': round((finished - started).total_seconds(), 3),
+        'total': len(results),
+        'success': sum(1 for result in results if result['success']),
+        'pharmacies': results,
+        'api': pricing.get_api_stats(settings)
+    }
+
+    with open(file_name, 'w') as file:
+        json.dump(summary, file, indent=2, default=str)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prices many pharmacies without the GUI')
+    parser.add_argument('tasks', help='CSV or JSON file with enterprise, serial_number, ID_Branch')
+    parser.add_argument('--settings', default='settings.ini', help='settings file name')
+    parser.add_argument('--set', dest='overrides', action='append', default=[], metavar='NAME=VALUE',
+                        help='overrides a setting, e.g. --set distances=[300,500,1000]')
+    parser.add_argument('--workers', type=int, default=0, help='concurrent pharmacies, max_threads by default')
+    parser.add_argument('--top-k-report', action='store_true',
+                        help='compares prices of competitors_top_k competitors with all competitors')
+    parser.add_argument('--summary', default='', help='summary JSON file, summary_<date>.json by default')
+    args = parser.parse_args()
+
+    overrides = {}
+    for override in args.overrides:
+        name, _, value = override.partition('=')
+        overrides[name.strip()] = value
+    settings = pricing.PricingSettings(args.settings).replace(**overrides)
+
+    if not settings:
+        print('Error: settings are not configured')
+        return 1
+
+    tasks = read_tasks(args.tasks)
+    runner = pricing.PricingRunner(settings, workers=args.workers, top_k_report=args.top_k_report)
+
+    started = datetime.datetime.now()
+    print('Starting... ', started, 'pharmacies:', len(tasks), 'workers:', runner.workers)
+
+    results = runner.run(tasks)
+
+    finished = datetime.datetime.now()
+    print('Finished... ', finished)
+
+    summary_name = args.summary or 'summary_' + started.strftime('%Y%m%d%H%M%S') + '.json'
+    write_summary(summary_name, results, started, finished, settings)
+
+    return 0 if all(result['success'] for result in results) else 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,86 @@
 #!/usr/bin/env python
 
 import pricing.pricing as pricing
+import queue
+import threading
 from tkinter import *
 from tkinter import messagebox
+from tkinter import ttk
+
+
+class PricingWorker:
+    """
+    A background worker for pricing jobs.
+
+    Jobs are queued and calculated one by one outside of the Tk main thread,
+    progress and results are put into the messages queue polled by the window.
+    The branches cache is kept warm between the jobs of a session.
+    """
+
+    def __init__(self):
+        self._jobs = queue.Queue()
+        self._messages = queue.Queue()
+        self._cache = pricing.BranchCache()
+        self._cancel_event = threading.Event()
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+    @property
+    def messages(self):
+        return self._messages
+
+    def submit(self, enterprise, serial_number, settings):
+        self._jobs.put((enterprise, serial_number, settings))
+
+    def cancel(self):
+        """Cancels the current job and removes the pending ones"""
+
+        while True:
+            try:
+                self._jobs.get_nowait()
+            except queue.Empty:
+                break
+        self._cancel_event.set()
+
+    def _work(self):
+        while True:
+            enterprise, serial_number, settings = self._jobs.get()
+            self._cancel_event.clear()
+
+            try:
+                result = self._calculate(enterprise, serial_number, settings)
+            except Exception as e:
+                self._messages.put(('error', str(e)))
+                continue
+
+            if self._cancel_event.is_set():
+                self._messages.put(('cancelled', serial_number))
+            else:
+                self._messages.put(result)
+
+    def _calculate(self, enterprise, serial_number, settings):
+        def progress(stage, current, total):
+            self._messages.put(('progress', (stage, current, total)))
+
+        new_pricing = pricing.GoodsPricing(
+            enterprise,
+            serial_number,
+            '',
+            settings,
+            cache=self._cache,
+            progress=progress,
+            cancel_event=self._cancel_event
+        )
+
+        if not new_pricing.settings:
+            return 'error', 'Settings are not configured'
+
+        if not new_pricing.recalculate():
+            return 'error', 'Pharmacy %s is not calculated' % serial_number
+        if not new_pricing.make_pricing():
+            return 'error', 'Pharmacy %s is not priced' % serial_number
+
+        return 'done', new_pricing.settings
 
 
 def start():
@@ -13,7 +91,9 @@ def start():
 
     window = Tk()
     window.title("Ценообразование (v.0.1)")
-    window.geometry('330x50')
+    window.geometry('420x100')
+
+    worker = PricingWorker()
 
     def settings():
         global curr_settings
@@ -25,11 +105,11 @@ def start():
         deviation = ''
 
         if curr_settings:
-            distances = ','.join(str(el) for el in curr_settings.distances)
-            prices = ','.join(str(el) for el in curr_settings.prices)
-            dist = str(curr_settings.def_unit)
-            price = str(curr_settings.unit_price)
-            deviation = str(curr_settings.deviation)
+            distances = ','.join(str(el) for el in curr_settings.get_setting('distances'))
+            prices = ','.join(str(el) for el in curr_settings.get_setting('prices'))
+            dist = str(curr_settings.get_setting('default_unit'))
+            price = str(curr_settings.get_setting('default_unit_price'))
+            deviation = str(curr_settings.get_setting('deviation'))
 
         settings_window = Tk()
         settings_window.title("Настройки")
@@ -73,19 +153,24 @@ def start():
         def save_settings():
             global curr_settings
 
-            new_distances = tuple([int(el) for el in distances_value.get().split(',')])
-            new_prices = tuple([int(el) for el in prices_value.get().split(',')])
+            new_distances = tuple([float(el) for el in distances_value.get().split(',')])
+            new_prices = tuple([float(el) for el in prices_value.get().split(',')])
             new_dist = float(dist_value.get())
             new_price = float(price_value.get())
             new_deviation = float(dev_value.get())
 
-            curr_settings = pricing.PricingSettings(
-                new_prices,
-                new_distances,
-                new_dist,
-                new_price,
-                new_deviation
-            )
+            base_settings = curr_settings if curr_settings else pricing.PricingSettings()
+            try:
+                curr_settings = base_settings.replace(
+                    prices=new_prices,
+                    distances=new_distances,
+                    default_unit=new_dist,
+                    default_unit_price=new_price,
+                    deviation=new_deviation
+                )
+            except ValueError as e:
+                messagebox.showerror('Ошибка', str(e))
+                return
 
             settings_window.destroy()
 
@@ -112,8 +197,6 @@ def start():
     pharm_value.grid(column=3, row=0, pady=10)
 
     def calculate():
-        global curr_settings
-
         ent_str = ent_value.get()
         pharm_str = pharm_value.get()
         if not ent_str or not pharm_str:
@@ -121,24 +204,58 @@ def start():
 
         enterprise = int(ent_str)
         serial_number = int(pharm_str)
-        new_pricing = pricing.GoodsPricing(enterprise, serial_number, curr_settings)
-
-        if not new_pricing.id_pharmacy:
-            return
 
-        if not new_pricing.settings:
-            return
+        status_value.set('В очереди: ' + pharm_str)
+        worker.submit(enterprise, serial_number, curr_settings)
 
-        curr_settings = new_pricing.settings
+    def cancel():
+        worker.cancel()
+        status_value.set('Отмена...')
 
-        new_pricing.recalculate()
-        new_pricing.make_pricing()
+    def check_messages():
+        global curr_settings
 
-        messagebox.showinfo('Готово', 'Расчет выполнен')
+        while True:
+            try:
+                kind, data = worker.messages.get_nowait()
+            except queue.Empty:
+                break
+
+            if kind == 'progress':
+                stage, current, total = data
+                progress_bar['maximum'] = max(total, 1)
+                progress_bar['value'] = current
+                status_value.set('%s: %s / %s' % (stage, current, total))
+            elif kind == 'done':
+                curr_settings = data
+                progress_bar['value'] = progress_bar['maximum']
+                status_value.set('Готово')
+                messagebox.showinfo('Готово', 'Расчет выполнен')
+            elif kind == 'cancelled':
+                progress_bar['value'] = 0
+                status_value.set('Отменено')
+            elif kind == 'error':
+                progress_bar['value'] = 0
+                status_value.set('Ошибка')
+                messagebox.showerror('Ошибка', data)
+
+        window.after(100, check_messages)
 
     btn = Button(window, text='Расчет', command=calculate)
     btn.grid(column=4, row=0, padx=15, pady=10)
 
+    progress_bar = ttk.Progressbar(window, orient=HORIZONTAL, length=300, mode='determinate')
+    progress_bar.grid(column=0, row=1, columnspan=4, padx=5, sticky=W)
+
+    cancel_btn = Button(window, text='Отмена', command=cancel)
+    cancel_btn.grid(column=4, row=1, padx=15)
+
+    status_value = StringVar(window)
+    status_lbl = Label(window, textvariable=status_value)
+    status_lbl.grid(column=0, row=2, columnspan=5, sticky=W, padx=5)
+
+    window.after(100, check_messages)
+
     window.mainloop()
 
 
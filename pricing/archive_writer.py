@@ -0,0 +1,127 @@
+"""
+A module for asynchronous writing of price archives
+"""
+
+import queue
+import threading
+import zipfile
+from concurrent.futures import Future
+
+
+class ArchiveCodec:
+    """Possible compressions of archives"""
+
+    Store = 'store'
+    Deflate = 'deflate'
+    BZip2 = 'bzip2'
+    LZMA = 'lzma'
+
+
+_compressions = {
+    ArchiveCodec.Store: zipfile.ZIP_STORED,
+    ArchiveCodec.Deflate: zipfile.ZIP_DEFLATED,
+    ArchiveCodec.BZip2: zipfile.ZIP_BZIP2,
+    ArchiveCodec.LZMA: zipfile.ZIP_LZMA
+}
+
+
+def write_archive(archive_name, file_name, codec=ArchiveCodec.Deflate, level=None):
+    """
+    Compresses a file into a zip archive
+
+    Attributes:
+        -codec - string, ArchiveCodec value
+        -level - int, compression level of deflate (0-9) and bzip2 (1-9), the codec's default when None
+    """
+
+    if codec not in _compressions:
+        raise ValueError('Unknown archive codec: %s' % codec)
+
+    if codec in (ArchiveCodec.Store, ArchiveCodec.LZMA):
+        level = None
+
+    with zipfile.ZipFile(archive_name, 'w', _compressions[codec], compresslevel=level) as z_file:
+        z_file.write(file_name)
+
+
+class ArchiveWriter:
+    """
+    A pool of threads writing archives in the background.
+
+    Jobs wait in a bounded queue, submit() blocks when it's full, so pricing
+    doesn't run far ahead of the disk. Every job has a Future, its result is
+    reported when the archive is written. wait(key) returns after the key's last
+    job is finished, a job depending on the previous one of its key waits for it.
+
+    Usage:
+        with ArchiveWriter(workers=2) as writer:
+            future = writer.submit(serial_number, job)
+    """
+
+    def __init__(self, workers=2, queue_size=8):
+        self._queue = queue.Queue(maxsize=max(int(queue_size), 1))
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._threads = []
+        for ind in range(max(int(workers), 1)):
+            thread = threading.Thread(target=self._work, name='ArchiveWriter-%s' % ind, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def submit(self, key, job):
+        """
+        Queues a job
+
+        Attributes:
+            -key - a job's owner, e.g. the pharmacy's (enterprise code, serial number)
+            -job - callable without arguments, its result is the future's result
+
+        returns concurrent.futures.Future
+        """
+
+        future = Future()
+        with self._lock:
+            self._pending[key] = future
+        self._queue.put((key, job, future))
+        return future
+
+    def wait(self, key):
+        """Waits for the last job of the key, its errors are ignored"""
+
+        with self._lock:
+            future = self._pending.get(key)
+        if future is not None:
+            future.exception()
+
+    def close(self):
+        """Writes queued archives and stops the threads"""
+
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            key, job, future = item
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(job())
+                except Exception as e:
+                    print('Error:', e)
+                    future.set_exception(e)
+
+            with self._lock:
+                if self._pending.get(key) is future:
+                    del self._pending[key]
@@ -0,0 +1,256 @@
+"""
+A module for backtesting of the pricing on the prices history
+
+Run offline: python backtest.py HISTORY_PATH BRANCHES_FILE --start 2024-01-01 --end 2024-01-31
+"""
+
+import argparse
+import sys
+import time
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+
+import pricing
+import price_history
+import price_index
+import repricing
+
+
+class Backtest:
+    """
+    A class replays the pricing of branches over a period, offline.
+
+    The history is scanned once, own, competitors' and exported snapshots
+    are rolled forward day by day, a branch's new snapshot replaces its older one.
+    Competitors' minimum prices are indexed once a day for all the branches, new prices
+    are calculated by the vectorized core and compared with the prices that were exported that day.
+
+    Attributes:
+        -history - price_history.PriceHistory
+        -pharmacy_table - DataFrame, the branches table of GoodsPricing.load_pharmacy_table
+        -settings - PricingSettings, a changed model is tested with settings.replace()
+        -ratio_matrix - ratios (price ranges, distance bands), calculated from the settings by default
+    """
+
+    _differ = 0.005
+
+    def __init__(self, history, pharmacy_table, settings, ratio_matrix=None):
+        self._history = history
+        self._pharmacy_table = pharmacy_table
+        self._settings = settings
+        if ratio_matrix is None:
+            ratio_matrix = repricing.get_ratio_matrix(settings)
+        self._ratio_matrix = np.asarray(ratio_matrix, dtype=float)
+        self._timings = {}
+
+    @property
+    def timings(self):
+        return dict(self._timings)
+
+    def run(self, branches, start, end, lookback_days=7):
+        """
+        Replays the pricing of the branches from start to end dates
+
+        Attributes:
+            -branches - list of ID_Branch
+            -lookback_days - days before start, prices seen then are the initial snapshot
+
+        returns a tuple (deltas, summary):
+            deltas - DataFrame with Date, ID_Branch, ID_Goods, PriceReserve, Exported, Delta columns
+            summary - DataFrame with Date, ID_Branch, goods, differ, max_delta, mean_delta, seconds columns
+        """
+
+        self._timings = {}
+        branches = [str(branch).upper() for branch in branches]
+        start = pd.Timestamp(start).normalize()
+        end = pd.Timestamp(end).normalize()
+
+        with self._measure('Competitors'):
+            bands = self._get_bands(branches)
+        competitors = set(branches)
+        for band_competitors in bands.values():
+            for band in band_competitors.values():
+                competitors.update(str(branch).upper() for branch in band)
+
+        with self._measure('History'):
+            records = self._history.scan(start - pd.Timedelta(days=lookback_days), end + pd.Timedelta(days=1),
+                                         branches=sorted(competitors))
+        timestamps = records['Timestamp'].to_numpy()
+
+        deltas = []
+        summary = []
+        state = records.iloc[:0]
+        prev_pos = 0
+        for day in pd.date_range(start, end, freq='D'):
+            next_day = day + pd.Timedelta(days=1)
+            pos = int(np.searchsorted(timestamps, next_day.to_datetime64(), side='left'))
+
+            with self._measure('Snapshots'):
+                new_records = records.iloc[prev_pos:pos]
+                state = Backtest._roll(state, new_records)
+                exported = new_records[(new_records['Source'] == price_history.PriceSource.Exported)
+                                       & (new_records['Timestamp'] >= day.to_datetime64())]
+            prev_pos = pos
+
+            with self._measure('Index'):
+                competitors_prices = state[state['Source'] == price_history.PriceSource.Competitor]
+                index = price_index.MinPriceIndex(competitors_prices) if len(competitors_prices) else None
+                own_prices = dict(tuple(state[state['Source'] == price_history.PriceSource.Own].groupby('ID_Branch')))
+                exported_prices = dict(tuple(exported.groupby('ID_Branch')))
+
+            for id_branch in branches:
+                branch_started = time.perf_counter()
+                own = own_prices.get(id_branch)
+                if own is None:
+                    continue
+
+                with self._measure('Repricing'):
+                    new_prices = self._reprice(own, index, bands.get(id_branch, {}))
+
+                branch_exported = exported_prices.get(id_branch)
+                if branch_exported is None:
+                    continue
+
+                df = self._compare(new_prices, branch_exported)
+                df.insert(0, 'ID_Branch', id_branch)
+                df.insert(0, 'Date', day)
+                deltas.append(df)
+
+                abs_deltas = df['Delta'].abs()
+                summary.append({
+                    'Date': day,
+                    'ID_Branch': id_branch,
+                    'goods': int(len(df)),
+                    'differ': int((abs_deltas > self._differ).sum()),
+                    'max_delta': float(abs_deltas.max()) if len(df) else 0.,
+                    'mean_delta': float(abs_deltas.mean()) if len(df) else 0.,
+                    'seconds': round(time.perf_counter() - branch_started, 4)
+                })
+
+        columns = ['Date', 'ID_Branch', 'ID_Goods', 'PriceReserve', 'Exported', 'Delta']
+        deltas = pd.concat(deltas, ignore_index=True) if deltas else pd.DataFrame([], columns=columns)
+        summary = pd.DataFrame(summary, columns=['Date', 'ID_Branch', 'goods', 'differ', 'max_delta', 'mean_delta',
+                                                 'seconds'])
+        return deltas, summary
+
+    @staticmethod
+    def _roll(state, new_records):
+        """
+        Replaces snapshots of the state with the new ones
+
+        Every append of (Source, ID_Branch, Timestamp) is a whole snapshot, e.g. a competitor's price list,
+        so the latest new snapshot of a branch replaces all its rows and goods missing in it are dropped.
+        """
+
+        if new_records.empty:
+            return state
+
+        latest = new_records.groupby(['Source', 'ID_Branch'], sort=False)['Timestamp'].transform('max')
+        new_records = new_records[new_records['Timestamp'] == latest]
+
+        new_keys = pd.MultiIndex.from_arrays([new_records['Source'], new_records['ID_Branch']]).unique()
+        keys = pd.MultiIndex.from_arrays([state['Source'], state['ID_Branch']])
+        return pd.concat([state[~keys.isin(new_keys)], new_records], ignore_index=True)
+
+    def _get_bands(self, branches):
+        """Competitors of the branches' distance bands, distances are calculated once for all the branches"""
+
+        table = self._pharmacy_table
+        cache = pricing.BranchCache()
+        cache.get_pharmacy_table(self._settings.get_setting('branches_api'), lambda: table)
+
+        rows = table.assign(ID_Branch=table['ID_Branch'].astype(str).str.upper()).drop_duplicates('ID_Branch')
+        rows = rows.set_index('ID_Branch')
+
+        bands = {}
+        for id_branch in branches:
+            if id_branch not in rows.index:
+                print('Error: branch %s is not found' % id_branch)
+                continue
+
+            row = rows.loc[id_branch]
+            goods_pricing = pricing.GoodsPricing(row['Code'], row['SerialNumber'], id_branch, self._settings, cache)
+            bands[id_branch] = goods_pricing.get_band_competitors()
+
+        return bands
+
+    def _reprice(self, own, index, band_competitors):
+        distances = self._settings.get_setting('distances')
+        band_codes = repricing.get_band_codes(index, band_competitors, distances)
+        new_prices = repricing.reprice_goods(
+            own, index, band_codes, self._ratio_matrix, self._settings.get_setting('prices'))
+
+        return pd.Series(new_prices, index=own['ID_Goods'].to_numpy())
+
+    @staticmethod
+    def _compare(new_prices, exported):
+        new_prices = new_prices[~new_prices.index.duplicated(keep='last')]
+        exported = exported.drop_duplicates(subset='ID_Goods', keep='last').set_index('ID_Goods')['PriceReserve']
+
+        df = pd.concat([new_prices.rename('PriceReserve'), exported.astype(float).rename('Exported')],
+                       axis=1, join='inner')
+        df['Delta'] = df['PriceReserve'] - df['Exported']
+        df.index.name = 'ID_Goods'
+        return df.reset_index()
+
+    @contextmanager
+    def _measure(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._timings[stage] = self._timings.get(stage, 0.) + time.perf_counter() - started
+
+
+def read_pharmacy_table(file_name):
+    if file_name.lower().endswith('.pkl'):
+        return pd.read_pickle(file_name)
+    return pd.read_csv(file_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays the pricing on the prices history')
+    parser.add_argument('history', help='prices history folder, <save_path>\\history')
+    parser.add_argument('branches_table', help='pickle or CSV file of the branches table')
+    parser.add_argument('--start', required=True, help='first date, YYYY-MM-DD')
+    parser.add_argument('--end', required=True, help='last date, YYYY-MM-DD')
+    parser.add_argument('--branches', default='', help='comma separated ID_Branch, branches with history by default')
+    parser.add_argument('--settings', default='settings.ini', help='settings file name')
+    parser.add_argument('--set', dest='overrides', action='append', default=[], metavar='NAME=VALUE',
+                        help='overrides a setting, e.g. --set deviation=0.01')
+    parser.add_argument('--output', default='backtest', help='prefix of the deltas and summary CSV files')
+    args = parser.parse_args()
+
+    overrides = {}
+    for override in args.overrides:
+        name, _, value = override.partition('=')
+        overrides[name.strip()] = value
+    settings = pricing.PricingSettings(args.settings).replace(**overrides)
+
+    history = price_history.PriceHistory(args.history)
+    if args.branches:
+        branches = [branch.strip() for branch in args.branches.split(',') if branch.strip()]
+    else:
+        own = history.scan(args.start, pd.Timestamp(args.end) + pd.Timedelta(days=1),
+                           source=price_history.PriceSource.Own)
+        branches = sorted(own['ID_Branch'].unique())
+
+    started = time.perf_counter()
+    backtest = Backtest(history, read_pharmacy_table(args.branches_table), settings)
+    deltas, summary = backtest.run(branches, args.start, args.end)
+
+    deltas.to_csv(args.output + '_deltas.csv', index=False)
+    summary.to_csv(args.output + '_summary.csv', index=False)
+
+    print('Branches: {}, days: {}, compared prices: {}, differ: {}'.format(
+        len(branches), summary['Date'].nunique(), len(deltas), int(summary['differ'].sum())))
+    for stage, seconds in backtest.timings.items():
+        print('{:<12} {:>8.3f} s'.format(stage, seconds))
+    print('Total: {:.3f} s'.format(time.perf_counter() - started))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,84 @@
+"""
+A module for branches' competitor masks
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class BranchIndex:
+    """
+    A class keeps branches of the distances table with their enterprises' codes.
+
+    Enterprises of one exclusion group (e.g. partner chains which are not
+    undercut) share a code, so competitors of a branch are a single comparison
+    of the codes' array without looking up the branches table.
+
+    Attributes:
+        -pharmacy_table - DataFrame with ID_Branch and ID_Enterprise columns
+        -branches - ID_Branch in the distances table's order
+        -exclusion_groups - iterable of enterprises' groups, see parse_groups
+    """
+
+    def __init__(self, pharmacy_table, branches, exclusion_groups=()):
+        self._branches = np.asarray(branches, dtype=object)
+        self._positions = {branch: pos for pos, branch in enumerate(self._branches)}
+
+        enterprises = pharmacy_table.drop_duplicates('ID_Branch').set_index('ID_Branch')['ID_Enterprise']
+        enterprises = enterprises.reindex(self._branches)
+        keys = enterprises.astype(str).str.upper().where(enterprises.notna())
+
+        codes, uniques = pd.factorize(keys)
+
+        # Enterprises of a group take the code of its first enterprise
+        group_codes = np.arange(len(uniques))
+        positions = {enterprise: code for code, enterprise in enumerate(uniques)}
+        for group in exclusion_groups:
+            members = [positions[enterprise] for enterprise in group if enterprise in positions]
+            if members:
+                group_codes[members] = min(members)
+        if len(uniques):
+            codes = np.where(codes < 0, -1, group_codes[codes])
+
+        # Branches without an enterprise compete with everyone
+        is_unknown = codes < 0
+        codes[is_unknown] = codes.max(initial=-1) + 1 + np.arange(is_unknown.sum())
+        self._codes = codes
+
+    @property
+    def branches(self):
+        return self._branches
+
+    @property
+    def codes(self):
+        return self._codes
+
+    def get_competitors_mask(self, id_branch):
+        """A mask of the branches which are competitors of the branch, all of them for an unknown branch"""
+
+        pos = self._positions.get(id_branch)
+        if pos is None:
+            return np.ones(len(self._codes), dtype=bool)
+
+        return self._codes != self._codes[pos]
+
+    @staticmethod
+    def parse_groups(value):
+        """
+        Parses exclusion_groups setting: groups are separated by ';', enterprises of a group by ','
+
+        returns a tuple of frozensets of upper case ID_Enterprise
+        """
+
+        if value == '' or value is None:
+            return ()
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+
+        groups = []
+        for group_str in str(value).split(';'):
+            group = frozenset(el.strip().upper() for el in group_str.split(',') if el.strip())
+            if group:
+                groups.append(group)
+
+        return tuple(groups)
@@ -0,0 +1,103 @@
+"""
+A module for competitors' ranking
+"""
+
+import os
+import json
+
+
+class CompetitorLeadership:
+    """
+    A class keeps price leadership of competitors around a pharmacy.
+
+    A competitor's score is the number of pharmacy's goods for which it had
+    the lowest price in its distance band, older runs fade with the decay.
+    Only fetched competitors can lead, so the exploration share of the places
+    goes to the competitors fetched longest ago and the others get scores too.
+    Scores and runs when competitors were fetched are stored in a JSON file per pharmacy.
+    """
+
+    def __init__(self, file_name, decay=0.8, exploration=0.2):
+        self._file_name = file_name
+        self._decay = decay
+        self._exploration = exploration
+        self._state = None
+
+    @property
+    def scores(self):
+        return self._get_state()['scores']
+
+    @property
+    def fetched(self):
+        """A dict {competitor: the last run it was fetched}"""
+
+        return self._get_state()['fetched']
+
+    def rank(self, competitors):
+        """Sorts competitors by their scores, the best first"""
+
+        scores = self.scores
+        return sorted(competitors, key=lambda competitor: -scores.get(str(competitor).upper(), 0.))
+
+    def select(self, competitors, top_k):
+        """Takes top_k competitors: the best leaders and the exploration share of the rest"""
+
+        ranked = self.rank(competitors)
+        if len(ranked) <= top_k:
+            return ranked
+
+        explored = max(int(round(top_k * self._exploration)), 1) if top_k > 1 and self._exploration > 0 else 0
+        fetched = self.fetched
+        rest = sorted(ranked[top_k - explored:], key=lambda competitor: fetched.get(str(competitor).upper(), -1))
+
+        return ranked[:top_k - explored] + rest[:explored]
+
+    def has_history(self):
+        return bool(self.scores)
+
+    def update(self, leaders, fetched=()):
+        """
+        Adds a run's leadership
+
+        Attributes:
+            -leaders - dict {competitor: number of goods it led}
+            -fetched - competitors whose prices were loaded in the run
+        """
+
+        state = self._get_state()
+        scores = {competitor: score * self._decay for competitor, score in state['scores'].items()}
+        for competitor, count in leaders.items():
+            key = str(competitor).upper()
+            scores[key] = scores.get(key, 0.) + float(count)
+
+        runs = state['runs'] + 1
+        last_fetched = dict(state['fetched'])
+        for competitor in fetched:
+            last_fetched[str(competitor).upper()] = runs
+
+        self._state = {'scores': scores, 'fetched': last_fetched, 'runs': runs}
+        with open(self._file_name, 'w') as file:
+            json.dump(self._state, file)
+
+    def _get_state(self):
+        if self._state is None:
+            self._state = self._load()
+        return self._state
+
+    def _load(self):
+        state = {'scores': {}, 'fetched': {}, 'runs': 0}
+        if not os.path.exists(self._file_name):
+            return state
+
+        try:
+            with open(self._file_name, 'r') as file:
+                data = json.load(file)
+        except (OSError, ValueError) as e:
+            print('Error:', e)
+            return state
+
+        if 'scores' not in data:
+            # Files of older versions keep the scores only
+            data = {'scores': data}
+        state.update(data)
+        return state
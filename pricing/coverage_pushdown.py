@@ -0,0 +1,184 @@
+"""
+A module for server side coverage aggregation
+
+Segment keys with use cases' masks are sent to the server as temporary tables,
+scraped competitors are joined and counted there, only aggregated counts
+come back. ClickHouse uses external tables, SQLite is a local stand-in.
+"""
+
+import sqlite3
+import numpy as np
+import pandas as pd
+
+
+CLICKHOUSE_COMPETITORS_SQL = """
+SELECT
+    country_code AS country
+    , toInt64(article_id) AS article_id
+    , company_name AS competitor
+    , argMax(vendor, update_date) AS vendor
+FROM core_base.competitor_price_log AS cp
+PREWHERE toYear(partition_date) = toYear(toDate('{ref_date}'))
+    AND toWeek(partition_date) <= toWeek(toDate('{ref_date}'))
+    AND competitor_tier IN {tiers}
+WHERE (country_code, toInt64(article_id)) IN (SELECT country, article_id FROM segments)
+GROUP BY country, article_id, competitor
+"""
+
+SQLITE_COMPETITORS_SQL = """
+SELECT country, article_id, competitor, vendor
+FROM competitor_price_log
+"""
+
+COVERAGE_SQL = """
+SELECT
+    {groups}
+    , count(DISTINCT s.article_id) AS deduped
+    {use_cases}
+FROM segments AS s
+INNER JOIN ({source}) AS c
+ON c.country = s.country
+    AND c.article_id = s.article_id
+INNER JOIN tiers AS t
+ON t.country = c.country
+    AND t.competitor = c.competitor
+{where}
+GROUP BY {groups}
+"""
+
+
+class ClickHouseBackend:
+    """Runs coverage queries in ClickHouse with external tables"""
+
+    def __init__(self, pool, source_sql=CLICKHOUSE_COMPETITORS_SQL):
+        """
+        Attributes:
+            -pool - ext_connections.ConnectionPool of ClickHouse connections, see ext_connections.get_pool
+            -source_sql - string, scraped competitors' subquery with {ref_date} and {tiers} parameters
+        """
+
+        self._pool = pool
+        self._source_sql = source_sql
+
+    @property
+    def source_sql(self):
+        return self._source_sql
+
+    @staticmethod
+    def bit_test(column, bit):
+        return 'bitTest({}, {}) = 1'.format(column, bit)
+
+    def execute(self, query, tables):
+        external_tables = []
+        for name, df in tables.items():
+            structure = [(col, self._get_type(df[col])) for col in df.columns]
+            external_tables.append({'name': name, 'structure': structure, 'data': df.to_dict('records')})
+
+        with self._pool.connection() as connection:
+            return connection.execute(query, external_tables=external_tables)
+
+    @staticmethod
+    def _get_type(series):
+        if pd.api.types.is_integer_dtype(series):
+            return 'Int64'
+        if pd.api.types.is_float_dtype(series):
+            return 'Float64'
+        return 'String'
+
+
+class SQLiteBackend:
+    """
+    Runs coverage queries in an embedded SQLite database.
+
+    Scraped competitors are loaded into competitor_price_log table once,
+    so the backend is a local stand-in of ClickHouse for tests.
+    """
+
+    def __init__(self, competitors, connection=None, source_sql=SQLITE_COMPETITORS_SQL):
+        self._connection = sqlite3.connect(':memory:') if connection is None else connection
+        self._source_sql = source_sql
+
+        competitors = competitors[['country', 'article_id', 'competitor', 'vendor']].copy()
+        competitors['article_id'] = pd.to_numeric(competitors['article_id']).astype(np.int64)
+        competitors.to_sql('competitor_price_log', self._connection, if_exists='replace', index=False)
+
+    @property
+    def source_sql(self):
+        return self._source_sql
+
+    @staticmethod
+    def bit_test(column, bit):
+        return '(({} >> {}) & 1) = 1'.format(column, bit)
+
+    def execute(self, query, tables):
+        for name, df in tables.items():
+            df.to_sql(name, self._connection, if_exists='replace', index=False)
+
+        return pd.read_sql_query(query, self._connection)
+
+
+class CoveragePushdown:
+    """
+    A class aggregates scraped coverage on the server side.
+
+    Attributes:
+        -backend - ClickHouseBackend or SQLiteBackend
+        -matrix - selection_coverage.CoverageMatrix, segment keys and use cases' masks
+        -tiers - DataFrame, country and competitor of the chosen tiers
+        -parameters - dict, parameters of the backend's source SQL
+    """
+
+    def __init__(self, backend, matrix, tiers, parameters=None):
+        self._backend = backend
+        self._use_cases = matrix.use_cases
+        self._tables = {
+            'segments': matrix.get_segments(),
+            'tiers': tiers[['country', 'competitor']].drop_duplicates().astype(str)
+        }
+        self._source = backend.source_sql.format(**(parameters or {}))
+
+    def table2(self):
+        """Assumed URLs by competitor and use case"""
+
+        table = self._aggregate(['c.competitor'])
+        return table.rename(columns={'deduped': 'deduped_assumed_urls'})
+
+    def table3(self):
+        """Assumed URLs by vendor and use case"""
+
+        # As in the notebook's pivot, an empty vendor is a vendor and a missing one is not
+        table = self._aggregate(['c.vendor'], 'WHERE c.vendor IS NOT NULL')
+        return table.rename(columns={'deduped': 'deduped_sum'})
+
+    def coverage(self):
+        """Scraped articles per country, competitor and use case"""
+
+        table = self._aggregate(['c.country', 'c.competitor']).drop(columns='deduped')
+        long_table = table.stack().rename('articles').reset_index()
+        long_table = long_table.rename(columns={long_table.columns[2]: 'use_case'})
+        return long_table[long_table['articles'] > 0].reset_index(drop=True)
+
+    def _aggregate(self, groups, where=''):
+        use_cases = ''.join(
+            '\n    , count(DISTINCT CASE WHEN {} THEN s.article_id END) AS uc_{}'.format(
+                self._backend.bit_test('s.mask', bit), bit)
+            for bit, _ in enumerate(self._use_cases)
+        )
+        query = COVERAGE_SQL.format(
+            groups=', '.join(groups),
+            use_cases=use_cases,
+            source=self._source,
+            where=where
+        )
+
+        df = self._backend.execute(query, self._tables)
+
+        index = [group.split('.')[-1] for group in groups]
+        df.columns = index + list(df.columns[len(index):])
+        df = df.rename(columns={'uc_' + str(bit): use_case for bit, use_case in enumerate(self._use_cases)})
+        df = df.set_index(index).sort_index()
+
+        table = df[sorted(self._use_cases)].astype(int)
+        table.columns.name = 'use_case'
+        table['deduped'] = df['deduped'].astype(int)
+        return table
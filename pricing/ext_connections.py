@@ -4,14 +4,75 @@ External connections module
 
 
 from enum import Enum
-import numpy as np
-import pandas as pd
-from clickhouse_driver import Client
-import pyodbc
-import requests
 import xml.etree.ElementTree as ET
-from io import StringIO
+import io
+from contextlib import contextmanager
+from urllib.parse import urlsplit, parse_qs
+import bisect
+import importlib
 import json
+import random
+import threading
+import time
+import tracemalloc
+import zlib
+
+
+class LazyModule:
+    """
+    A module proxy imports the module on the first attribute access.
+
+    Import time and, when measure_memory is set, allocated memory are recorded
+    in load_stats, so drivers of unused backends cost nothing at startup.
+    """
+
+    load_stats = {}
+    measure_memory = False
+    _lock = threading.Lock()
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    @property
+    def is_loaded(self):
+        return self._module is not None
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        return getattr(self.load(), attr)
+
+    def load(self):
+        if self._module is not None:
+            return self._module
+
+        with LazyModule._lock:
+            if self._module is None:
+                trace = LazyModule.measure_memory and not tracemalloc.is_tracing()
+                if trace:
+                    tracemalloc.start()
+
+                start = time.perf_counter()
+                module = importlib.import_module(self._name)
+                seconds = time.perf_counter() - start
+
+                memory = 0
+                if trace:
+                    memory = tracemalloc.get_traced_memory()[0]
+                    tracemalloc.stop()
+
+                LazyModule.load_stats[self._name] = {'seconds': round(seconds, 4), 'memory_kb': memory // 1024}
+                self._module = module
+
+        return self._module
+
+
+np = LazyModule('numpy')
+pd = LazyModule('pandas')
+requests = LazyModule('requests')
+pyodbc = LazyModule('pyodbc')
+clickhouse_driver = LazyModule('clickhouse_driver')
 
 
 class ConnectionType(Enum):
@@ -22,6 +83,51 @@ class ConnectionType(Enum):
     API = 3
 
 
+class BackendRegistry:
+    """
+    A registry of connection backends.
+
+    Every connection type has a connection class and driver modules,
+    the drivers are imported when the backend is used for the first time.
+    """
+
+    def __init__(self):
+        self._backends = {}
+
+    def register(self, connection_type, connection_class, drivers=()):
+        """
+        Attributes:
+            -connection_type - ConnectionType
+            -connection_class - Connection subclass
+            -drivers - tuple of LazyModule, modules the backend needs
+        """
+
+        self._backends[connection_type] = (connection_class, tuple(drivers))
+
+    def get(self, connection_type):
+        """Returns a connection class with loaded drivers"""
+
+        if connection_type not in self._backends:
+            raise KeyError('Unknown connection type: %s' % connection_type)
+
+        connection_class, drivers = self._backends[connection_type]
+        for driver in drivers:
+            driver.load()
+
+        return connection_class
+
+    def create(self, connection_type, *args, **kwargs):
+        return self.get(connection_type)(*args, **kwargs)
+
+    def is_loaded(self, connection_type):
+        _, drivers = self._backends[connection_type]
+        return all(driver.is_loaded for driver in drivers)
+
+    @property
+    def connection_types(self):
+        return list(self._backends)
+
+
 class ConnectionData:
     """Describes connection input data"""
 
@@ -108,12 +214,23 @@ class Connection:
     def connection(self):
         return self._connection
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.disconnect()
+
     def connect(self):
         """Connects to the server"""
 
     def disconnect(self):
         """Disconnects from the server"""
 
+    def ping(self):
+        """Checks whether the connection is alive"""
+
+        return self.connection is not None
+
     def execute(self, query, *pars):
         """
         Executes query with parameters if existed
@@ -160,8 +277,23 @@ class SQL(Connection):
     def disconnect(self):
         """See base class"""
 
-        if self._cursor is pyodbc.Cursor:
+        if isinstance(self._cursor, pyodbc.Cursor):
             self._cursor.close()
+            self._cursor = None
+        if isinstance(self.connection, pyodbc.Connection):
+            self.connection.close()
+            self._connection = None
+
+    def ping(self):
+        """See base class"""
+
+        try:
+            self._run('SELECT 1')
+            self._cursor.fetchall()
+        except pyodbc.Error:
+            return False
+
+        return True
 
     def execute(self, query, *pars):
         """
@@ -182,7 +314,7 @@ class SQL(Connection):
             -*pars - tuple, sequence of parameters
         """
 
-        if self._cursor is pyodbc.Cursor:
+        if isinstance(self._cursor, pyodbc.Cursor):
             self._cursor.close()
         self._cursor = self.connection.cursor()
         self._cursor.execute(query, *pars)
@@ -224,35 +356,52 @@ class ClickHouse(Connection):
         user = con_data.user
         password = con_data.password
 
-        new_connection = Client(host=server, user=user, password=password)
+        new_connection = clickhouse_driver.Client(host=server, user=user, password=password)
         self._connection = new_connection
 
     def disconnect(self):
         """See base class"""
 
-        if self.connection is Client:
+        if isinstance(self.connection, clickhouse_driver.Client):
             self.connection.disconnect()
 
-    def execute(self, query, *pars):
+    def ping(self):
+        """See base class"""
+
+        try:
+            self.connection.execute('SELECT 1')
+        except Exception:
+            return False
+
+        return True
+
+    def execute(self, query, *pars, external_tables=None):
         """
         query - string
         *pars - dict
+        external_tables - list of dicts {'name', 'structure', 'data'}, temporary tables sent with the query
         """
 
-        self._run(query, *pars)
+        self._run(query, *pars, external_tables=external_tables)
         table = self._to_df()
         return table
 
-    def _run(self, query, *pars):
+    def _run(self, query, *pars, external_tables=None):
         """
         Runs a query with parameters if existed
 
         Attributes:
             -query - string, a query to execute
             -*pars - dict, sequence of parameters
+            -external_tables - list of dicts, temporary tables for the query
         """
 
-        self._query_result = self.connection.execute(query, *pars, with_column_types=True)
+        self._query_result = self.connection.execute(
+            query,
+            *pars,
+            with_column_types=True,
+            external_tables=external_tables
+        )
 
     def _to_df(self):
         """Converts a Client data into a DataFrame"""
@@ -270,8 +419,365 @@ class ClickHouse(Connection):
         return table
 
 
+class APIError(Exception):
+    """A request failed after all the policy's attempts"""
+
+
+class CircuitOpenError(APIError):
+    """A request is rejected without sending, the host's circuit is open"""
+
+
+class LatencyHistogram:
+    """Counts requests' durations in buckets of fixed upper bounds, seconds"""
+
+    bounds = (0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60.)
+
+    def __init__(self):
+        self._counts = [0] * (len(self.bounds) + 1)
+        self._errors = 0
+        self._total = 0.
+
+    @property
+    def count(self):
+        return sum(self._counts)
+
+    def record(self, seconds, ok=True):
+        self._counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self._total += seconds
+        if not ok:
+            self._errors += 1
+
+    def quantile(self, q):
+        """An upper bound of the bucket with the q-th quantile, inf when it's above the last bound"""
+
+        count = self.count
+        if not count:
+            return 0.
+
+        rank = q * count
+        cumulative = 0
+        for ind, bucket in enumerate(self._counts):
+            cumulative += bucket
+            if cumulative >= rank:
+                return self.bounds[ind] if ind < len(self.bounds) else float('inf')
+
+        return float('inf')
+
+    def as_dict(self):
+        count = self.count
+        labels = ['<=' + str(bound) for bound in self.bounds] + ['>' + str(self.bounds[-1])]
+        return {
+            'count': count,
+            'errors': self._errors,
+            'mean': round(self._total / count, 4) if count else 0.,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            'buckets': dict(zip(labels, self._counts))
+        }
+
+
+class CircuitBreaker:
+    """
+    A class stops requests to a failing host.
+
+    After failure_threshold failures in a row the circuit opens and requests
+    are rejected for reset_after seconds, then one trial request is let through:
+    its success closes the circuit, its failure opens it again.
+    """
+
+    def __init__(self, failure_threshold=5, reset_after=30.):
+        self._failure_threshold = failure_threshold
+        self._reset_after = reset_after
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    def configure(self, failure_threshold, reset_after):
+        self._failure_threshold = failure_threshold
+        self._reset_after = reset_after
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def allow(self):
+        if self._opened_at is None:
+            return True
+        if self._trial or time.monotonic() - self._opened_at < self._reset_after:
+            return False
+
+        self._trial = True
+        return True
+
+    def record_success(self):
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    def record_failure(self):
+        self._failures += 1
+        if self._trial or self._failures >= self._failure_threshold:
+            self._opened_at = time.monotonic()
+        self._trial = False
+
+
+class RequestPolicy:
+    """
+    Timeouts, retries and circuit breakers of API requests.
+
+    A request is retried on connection errors, timeouts and retry_statuses
+    with a random delay up to backoff * 2 ** attempt seconds. Every resource has
+    its circuit breaker: the host and the values of resource_params in the query,
+    e.g. a competitor's ?sn=, so one failing competitor doesn't stop the others.
+    Durations are recorded per endpoint (host and path without the query).
+    Connections with equal settings share a policy, so are breakers and histograms.
+    """
+
+    retry_statuses = (429, 500, 502, 503, 504)
+    resource_params = ('sn',)
+
+    def __init__(self, connect_timeout=5., read_timeout=30., retries=2, backoff=0.5, max_backoff=5.,
+                 failure_threshold=5, reset_after=30.):
+        self._lock = threading.Lock()
+        self._breakers = {}
+        self._histograms = {}
+        self._transfers = {}
+        self.configure(connect_timeout, read_timeout, retries, backoff, max_backoff, failure_threshold, reset_after)
+
+    def configure(self, connect_timeout=5., read_timeout=30., retries=2, backoff=0.5, max_backoff=5.,
+                  failure_threshold=5, reset_after=30.):
+        """Changes the policy's parameters, breakers' states and histograms are kept"""
+
+        with self._lock:
+            self.connect_timeout = float(connect_timeout)
+            self.read_timeout = float(read_timeout)
+            self.retries = int(retries)
+            self.backoff = float(backoff)
+            self.max_backoff = float(max_backoff)
+            self.failure_threshold = int(failure_threshold)
+            self.reset_after = float(reset_after)
+            for breaker in self._breakers.values():
+                breaker.configure(self.failure_threshold, self.reset_after)
+
+    @property
+    def timeout(self):
+        return self.connect_timeout, self.read_timeout
+
+    def request(self, session, method, url, read=None, **kwargs):
+        """
+        Sends a request with the policy
+
+        Attributes:
+            -read - callable(requests.Response), reads a streamed body, its network errors are retried too,
+                other errors are raised and counted as the host's failures
+
+        returns a successful requests.Response or the read's result, raises APIError otherwise
+        """
+
+        parts = urlsplit(url)
+        host = self._get_resource(parts)
+        endpoint = parts.netloc + parts.path
+
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1))))
+
+            if not self._allow(host):
+                raise CircuitOpenError('Circuit is open: %s' % host)
+
+            start = time.perf_counter()
+            respond = None
+            ok = False
+            try:
+                respond = session.request(method=method, url=url, timeout=self.timeout, stream=read is not None,
+                                          **kwargs)
+                if respond.status_code in self.retry_statuses:
+                    error = APIError('%s %s: HTTP %s' % (method, endpoint, respond.status_code))
+                    continue
+
+                # Client errors are not the host's failures
+                if not respond.ok:
+                    ok = True
+                    raise APIError('%s %s: HTTP %s' % (method, endpoint, respond.status_code))
+
+                if read is None:
+                    # The caller reads and closes the response
+                    result, respond = respond, None
+                else:
+                    result = read(respond)
+                ok = True
+            except (requests.exceptions.RequestException, zlib.error, OSError) as e:
+                error = APIError('%s %s: %s' % (method, endpoint, e))
+                continue
+            finally:
+                # Every attempt is recorded, a failed read ends a half-open circuit's trial too
+                self._record(host, endpoint, time.perf_counter() - start, ok)
+                if respond is not None:
+                    respond.close()
+
+            return result
+
+        raise error
+
+    def get_stats(self):
+        """
+        Requests' latencies per endpoint and open circuits
+
+        returns a dict {'endpoints': {endpoint: histogram dict}, 'open_circuits': list of hosts}
+        """
+
+        with self._lock:
+            return {
+                'endpoints': {endpoint: hist.as_dict() for endpoint, hist in self._histograms.items()},
+                'transfers': {endpoint: dict(transfer) for endpoint, transfer in self._transfers.items()},
+                'open_circuits': [host for host, breaker in self._breakers.items() if breaker.is_open]
+            }
+
+    def record_transfer(self, url, compressed_bytes, uncompressed_bytes):
+        """Adds bytes received from the network and decompressed bytes of the endpoint"""
+
+        parts = urlsplit(url)
+        endpoint = parts.netloc + parts.path
+        with self._lock:
+            transfer = self._transfers.get(endpoint)
+            if transfer is None:
+                transfer = self._transfers[endpoint] = {'responses': 0, 'compressed': 0, 'uncompressed': 0}
+            transfer['responses'] += 1
+            transfer['compressed'] += compressed_bytes
+            transfer['uncompressed'] += uncompressed_bytes
+
+    def _get_resource(self, parts):
+        params = parse_qs(parts.query)
+        values = ['%s=%s' % (name, params[name][0]) for name in self.resource_params if name in params]
+        return parts.netloc + ('?' + '&'.join(values) if values else '')
+
+    def _allow(self, host):
+        with self._lock:
+            return self._get_breaker(host).allow()
+
+    def _record(self, host, endpoint, seconds, ok):
+        with self._lock:
+            hist = self._histograms.get(endpoint)
+            if hist is None:
+                hist = self._histograms[endpoint] = LatencyHistogram()
+            hist.record(seconds, ok)
+
+            breaker = self._get_breaker(host)
+            if ok:
+                breaker.record_success()
+            else:
+                breaker.record_failure()
+
+    def _get_breaker(self, host):
+        breaker = self._breakers.get(host)
+        if breaker is None:
+            breaker = self._breakers[host] = CircuitBreaker(self.failure_threshold, self.reset_after)
+        return breaker
+
+
+class DecodedStream(io.RawIOBase):
+    """
+    A readable stream of a response's body decompressed on the fly.
+
+    The body is read from the socket in chunks without decoding,
+    gzip and deflate are decompressed by bounded pieces, so neither
+    the compressed nor the decompressed body is kept in memory whole.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, raw, encoding=''):
+        """
+        Attributes:
+            -raw - urllib3 response of requests.Response.raw
+            -encoding - string, Content-Encoding header
+        """
+
+        super().__init__()
+        self._raw = raw
+        self._encoding = (encoding or '').strip().lower()
+        self._decompressor = None
+        if self._encoding == 'gzip':
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self._encoding == 'deflate':
+            self._decompressor = zlib.decompressobj(zlib.MAX_WBITS)
+        self._is_first = True
+        self._pending = b''
+        self._buffer = b''
+        self._position = 0
+        self._eof = False
+        self.compressed_bytes = 0
+        self.uncompressed_bytes = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self._position >= len(self._buffer):
+            if not self._fill():
+                return 0
+
+        size = min(len(buffer), len(self._buffer) - self._position)
+        buffer[:size] = self._buffer[self._position:self._position + size]
+        self._position += size
+        self.uncompressed_bytes += size
+        return size
+
+    def _fill(self):
+        if not self._pending:
+            if self._eof:
+                return False
+
+            chunk = self._raw.read(self.chunk_size, decode_content=False)
+            if not chunk:
+                self._eof = True
+                self._set_buffer(self._decompressor.flush() if self._decompressor is not None else b'')
+                return bool(self._buffer)
+
+            self.compressed_bytes += len(chunk)
+            if self._decompressor is None:
+                self._set_buffer(chunk)
+                return True
+            self._pending = chunk
+
+        self._set_buffer(self._decompress(self._pending))
+        return True
+
+    def _decompress(self, data):
+        try:
+            result = self._decompressor.decompress(data, self.chunk_size * 4)
+        except zlib.error:
+            if not (self._is_first and self._encoding == 'deflate'):
+                raise
+            # Some servers send raw deflate without the zlib header
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            result = self._decompressor.decompress(data, self.chunk_size * 4)
+
+        self._is_first = False
+        self._pending = self._decompressor.unconsumed_tail
+        return result
+
+    def _set_buffer(self, data):
+        self._buffer = data
+        self._position = 0
+
+
 class API(Connection):
-    def __init__(self, server):
+    policy = RequestPolicy()
+    accept_encoding = 'gzip, deflate'
+    # Columns parsed as dates besides *_at, *_time and timestamp*
+    _date_columns = ('date', 'datetime', 'modified')
+
+    def __init__(self, server, policy=None):
+        """
+        Attributes:
+            -policy - RequestPolicy, the class' shared policy by default
+        """
+
+        if policy is not None:
+            self.policy = policy
         super().__init__(
             connection_type=ConnectionType.API,
             server=server,
@@ -300,20 +806,18 @@ class API(Connection):
         """
         query - string
         *pars - dict
-        """
 
-        content_type = 'csv'
-        if len(pars) > 2:
-            content_type = pars[2]
+        raises APIError when the request fails
+        """
 
         self._run(query, *pars)
-        table = self._to_df(content_type=content_type)
+        table = self._query_result
 
         return table
 
     def _run(self, query, *pars):
         """
-        Runs a query with parameters if existed
+        Runs a query with parameters if existed, the response is converted into a DataFrame
 
         Attributes:
             -query - string, a query to execute
@@ -327,71 +831,436 @@ class API(Connection):
         user = con_data.user
         password = con_data.password
 
-        with self.connection as session:
-            url = '{}/{}'.format(server, query)
-            url = query
-            method = 'GET'
-            if pars:
-                method = pars[0]
-            headers = {}
-            if len(pars) > 1:
-                headers = pars[1]
-            respond = session.request(method=method, url=url, headers=headers)
-            if respond.ok:
-                self._query_result = respond.text
-            else:
-                self._query_result = ''
+        # The session is kept open, so its connections are reused by next queries
+        session = self.connection
+        url = '{}/{}'.format(server, query)
+        url = query
+        method = 'GET'
+        if pars:
+            method = pars[0]
+        headers = {}
+        if len(pars) > 1:
+            headers = pars[1]
+        content_type = 'csv'
+        if len(pars) > 2:
+            content_type = pars[2]
 
-    def _to_df(self, content_type='csv'):
-        """Converts a Client data into a DataFrame"""
+        headers = dict(headers)
+        headers.setdefault('Accept-Encoding', self.accept_encoding)
 
-        if not self.query_result:
-            return pd.DataFrame()
+        def read(respond):
+            stream = DecodedStream(respond.raw, respond.headers.get('Content-Encoding', ''))
+            try:
+                df = self._to_df(stream, content_type, self._get_charset(respond.headers.get('Content-Type', '')))
+            except (ValueError, LookupError, TypeError) as e:
+                # A malformed body isn't retried, the same body would come again
+                raise APIError('%s %s: the response is not parsed: %s' % (method, url, e))
+            finally:
+                respond.close()
+            self.policy.record_transfer(url, stream.compressed_bytes, stream.uncompressed_bytes)
+            return df
 
-        df = None
+        self._query_result = None
+        self._query_result = self.policy.request(session, method, url, read=read, headers=headers)
+
+    @staticmethod
+    def _get_charset(content_type):
+        """The charset parameter of a Content-Type header, '' when it's not set"""
+
+        for param in content_type.split(';')[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'charset':
+                return value.strip().strip('"\'')
+
+        return ''
+
+    @staticmethod
+    def _to_df(stream, content_type='csv', encoding=None):
+        """
+        Converts a response's body stream into a DataFrame
+
+        Attributes:
+            -encoding - string, the response's charset, UTF-8 by default
+
+        raises ValueError when the body isn't parsed
+        """
 
         if content_type == 'csv':
-            data = StringIO(self.query_result)
-            df = pd.read_csv(data, sep='\t')
-        elif content_type == 'json':
-            data = json.loads(self.query_result)
-            data = json.dumps(data['Items'])
-            df = pd.read_json(data)
+            reader = io.TextIOWrapper(io.BufferedReader(stream), encoding=encoding or 'utf-8')
+            try:
+                return pd.read_csv(reader, sep='\t')
+            except pd.errors.EmptyDataError:
+                return pd.DataFrame()
+
+        body = stream.read()
+        if not body:
+            return pd.DataFrame()
+
+        # Without a charset JSON is UTF-8, UTF-16 or UTF-32 detected by json
+        data = json.loads(body.decode(encoding) if encoding else body)
+        del body
+
+        df = None
+        if content_type == 'json':
+            df = API._from_records(data['Items'])
         elif content_type == 'json_detailed':
-            data = json.loads(self.query_result)
-            data = json.dumps(data['response']['items'])
-            df = pd.read_json(data)
+            df = API._from_records(data['response']['items'])
+
+        return df
+
+    @staticmethod
+    def _from_records(records):
+        """
+        A DataFrame of JSON records, types are inferred column by column like pandas.read_json does:
+        numeric strings are numbers and date columns (DateTime, Date, *_at, *_time) are datetimes
+        """
+
+        df = pd.DataFrame.from_records(records)
+        for col in df.columns:
+            values = df[col]
+            if not pd.api.types.is_object_dtype(values) and not pd.api.types.is_string_dtype(values):
+                continue
+
+            name = str(col).lower()
+            is_date = name.endswith(('_at', '_time')) or name.startswith('timestamp') or name in API._date_columns
+            try:
+                df[col] = pd.to_datetime(values) if is_date else pd.to_numeric(values)
+            except (ValueError, TypeError, OverflowError):
+                # Not numbers or dates, the column is kept as it is
+                continue
 
         return df
 
 
+backends = BackendRegistry()
+backends.register(ConnectionType.SQLServer, SQL, (pyodbc, np, pd))
+backends.register(ConnectionType.ClickHouseServer, ClickHouse, (clickhouse_driver, np, pd))
+backends.register(ConnectionType.API, API, (requests, pd))
+
+
+def get_import_report():
+    """
+    Measures the module's startup: imports every backend's drivers
+
+    returns a dict {module: {'seconds', 'memory_kb'}} of lazily loaded modules
+    """
+
+    LazyModule.measure_memory = True
+    for connection_type in backends.connection_types:
+        try:
+            backends.get(connection_type)
+        except ImportError as e:
+            print('Error:', e)
+
+    return dict(LazyModule.load_stats)
+
+
+class ConnectionPool:
+    """
+    A class keeps a bounded set of warm connections.
+
+    Connections are created by the factory on demand up to max_size,
+    an idle connection is checked with ping before reuse and closed
+    after max_idle seconds without use.
+
+    Usage:
+        with pool.connection() as connection:
+            df = connection.execute(query)
+    """
+
+    def __init__(self, factory, max_size=4, max_idle=300., check_after=30.):
+        """
+        Attributes:
+            -factory - callable, creates a new connected Connection
+            -max_size - int, maximum number of open connections
+            -max_idle - float, seconds an idle connection is kept
+            -check_after - float, idle seconds after which a connection is pinged before reuse
+        """
+
+        self._factory = factory
+        self._max_size = max_size
+        self._max_idle = max_idle
+        self._check_after = check_after
+        self._idle = []
+        self._size = 0
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    @max_size.setter
+    def max_size(self, new_size):
+        with self._condition:
+            self._max_size = new_size
+            self._condition.notify_all()
+
+    @property
+    def size(self):
+        return self._size
+
+    @contextmanager
+    def connection(self, timeout=None):
+        connection = self.acquire(timeout=timeout)
+        broken = True
+        try:
+            yield connection
+            broken = False
+        finally:
+            self.release(connection, broken=broken)
+
+    def acquire(self, timeout=None):
+        """Takes an idle connection or creates a new one, waits when the pool is exhausted"""
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                self._evict_idle()
+                if self._idle:
+                    connection, released = self._idle.pop()
+                    break
+                if self._size < self._max_size:
+                    self._size += 1
+                    connection, released = None, None
+                    break
+
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError('No free connections in the pool')
+                self._condition.wait(remaining)
+
+        if connection is not None and time.monotonic() - released > self._check_after and not connection.ping():
+            self._close(connection)
+            connection = None
+
+        if connection is None:
+            try:
+                connection = self._factory()
+            except Exception:
+                with self._condition:
+                    self._size -= 1
+                    self._condition.notify()
+                raise
+
+        return connection
+
+    def release(self, connection, broken=False):
+        """Returns a connection to the pool, a broken one is closed"""
+
+        if broken:
+            self._close(connection)
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            return
+
+        with self._condition:
+            if self._size > self._max_size:
+                self._size -= 1
+                self._close(connection)
+            else:
+                self._idle.append((connection, time.monotonic()))
+            self._condition.notify()
+
+    def close(self):
+        with self._condition:
+            idle = self._idle
+            self._idle = []
+            self._size -= len(idle)
+
+        for connection, _ in idle:
+            self._close(connection)
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        expired = [item for item in self._idle if now - item[1] > self._max_idle]
+        if not expired:
+            return
+
+        self._idle = [item for item in self._idle if now - item[1] <= self._max_idle]
+        self._size -= len(expired)
+        for connection, _ in expired:
+            self._close(connection)
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.disconnect()
+        except Exception as e:
+            print('Error:', e)
+
+
+# Pools of the process per backend and connection data
+pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(connection_type, *args, max_size=4, max_idle=300.):
+    """
+    Returns the process' pool of connections of the backend, one pool per connection arguments
+
+    Attributes:
+        -connection_type - ConnectionType
+        -*args - arguments of the backend's connection class, e.g. server, port, user, password of SQL
+        -max_size, max_idle - parameters of a new pool
+
+    Usage:
+        with get_pool(ConnectionType.ClickHouseServer, server, port, user, password).connection() as connection:
+            df = connection.execute(query)
+    """
+
+    key = (connection_type,) + args
+    with _pools_lock:
+        pool = pools.get(key)
+        if pool is None:
+            pool = pools[key] = ConnectionPool(lambda: backends.create(connection_type, *args), max_size=max_size,
+                                               max_idle=max_idle)
+
+    return pool
+
+
 class Parser:
+    chunk_size = 50000
+
     @staticmethod
-    def parse_xml(xml_file):
+    def parse_xml(xml_file, columns=None, dtypes=None, reducer=None):
         """
         Parse the input XML file and store the result in a pandas DataFrame.
+
+        Chunks of iter_xml are split into columns as they're parsed and every column is concatenated
+        and released on its own, so the whole file isn't kept twice, as chunks and as the result.
+
+        Attributes:
+            -xml_file - file name or file object
+            -columns - list of known attributes, the discovery of attributes is skipped
+            -dtypes - dict {column: dtype}, numpy integers are read as nullable ones (Int64)
+            -reducer - callable(DataFrame), reduces every chunk, e.g. filters the needed rows
+        """
+
+        cols = list(columns) if columns is not None else []
+        parts = {col: [] for col in cols}
+        lengths = []
+        count = 0
+        # A chunk is split when the next one is parsed, a single chunk is returned as it is
+        pending = None
+        for chunk in Parser.iter_xml(xml_file, columns, dtypes):
+            if reducer is not None:
+                chunk = reducer(chunk)
+            if pending is not None:
+                Parser._add_parts(parts, cols, lengths, pending)
+            pending = chunk
+            count += 1
+
+        if count == 1:
+            return pending
+        if pending is not None:
+            Parser._add_parts(parts, cols, lengths, pending)
+            pending = None
+
+        data = {}
+        for col in cols:
+            col_parts = parts.pop(col)
+            data[col] = pd.concat(col_parts, ignore_index=True) if col_parts else pd.Series([], dtype=object)
+
+        out_df = pd.DataFrame(data, columns=cols, copy=False)
+        return Parser._set_types(out_df, dtypes)
+
+    @staticmethod
+    def iter_xml(xml_file, columns=None, dtypes=None, chunk_size=None):
         """
+        Parse the input XML file incrementally, every child of the root is a row.
 
-        tree = ET.parse(xml_file)
-        root = tree.getroot()
+        Parsed elements are cleared, so memory is bounded by the chunk's size
+        whatever the file's size is.
 
-        temp_dict = {}
-        for node in root:
-            for key, value in node.attrib.items():
-                temp_dict[key] = 1
+        returns a generator of DataFrames with chunk_size rows at most,
+        without columns the chunk has the attributes found so far
+        """
 
-        cols = [key for key, value in temp_dict.items()]
+        chunk_size = chunk_size or Parser.chunk_size
+        cols = list(columns) if columns is not None else []
+        known = set(cols)
+        discover = columns is None
 
         rows = []
-        for node in root:
-            if node is None:
+        root = None
+        depth = 0
+        for event, node in ET.iterparse(xml_file, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = node
+                depth += 1
+                continue
+
+            depth -= 1
+            if depth != 1:
+                continue
+
+            attrib = node.attrib
+            if discover:
+                for key in attrib:
+                    if key not in known:
+                        known.add(key)
+                        cols.append(key)
+            rows.append([attrib.get(col) for col in cols])
+
+            node.clear()
+            if len(rows) >= chunk_size:
+                yield Parser._make_chunk(rows, cols, dtypes)
+                rows = []
+                root.clear()
+
+        if rows:
+            yield Parser._make_chunk(rows, cols, dtypes)
+
+    @staticmethod
+    def _add_parts(parts, cols, lengths, chunk):
+        """Adds copies of a chunk's columns, the chunk isn't referenced by them"""
+
+        for col in chunk.columns:
+            if col not in parts:
+                # An attribute found in this chunk, previous chunks miss it
+                cols.append(col)
+                parts[col] = [pd.Series([None] * length, dtype=object) for length in lengths]
+            parts[col].append(chunk[col].reset_index(drop=True).copy())
+
+        for col in cols:
+            if col not in chunk.columns:
+                parts[col].append(pd.Series([None] * len(chunk), dtype=object))
+        lengths.append(len(chunk))
+
+    @staticmethod
+    def _make_chunk(rows, cols, dtypes):
+        # Rows parsed before a new attribute was found are shorter
+        width = len(cols)
+        rows = [row + [None] * (width - len(row)) if len(row) < width else row for row in rows]
+        return Parser._set_types(pd.DataFrame(rows, columns=cols), dtypes)
+
+    @staticmethod
+    def _set_types(df, dtypes):
+        if not dtypes:
+            return df
+
+        for col, dtype in dtypes.items():
+            if col not in df.columns:
                 continue
 
-            res = [node.attrib.get(col) for col in cols]
-            rows.append({cols[i]: res[i] for i, _ in enumerate(cols)})
+            dtype = pd.api.types.pandas_dtype(dtype)
+            if pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype):
+                if isinstance(dtype, np.dtype) and dtype.kind in 'iu':
+                    # Numpy integers can't hold missed values, every chunk gets the nullable integers
+                    dtype = pd.api.types.pandas_dtype(('UInt' if dtype.kind == 'u' else 'Int') + str(dtype.itemsize * 8))
+                df[col] = pd.to_numeric(df[col], errors='coerce').astype(dtype)
+            else:
+                df[col] = df[col].astype(dtype)
 
-        out_df = pd.DataFrame(rows, columns=cols)
-        return out_df
+        return df
 
     @staticmethod
     def df_to_xml(df, full_path, item_name='item'):
@@ -414,3 +1283,10 @@ class Parser:
     def df_to_csv(df, full_path):
         df.to_csv(full_path, index=False)
 
+
+if __name__ == '__main__':
+    start = time.perf_counter()
+    report = get_import_report()
+    for name, stats in sorted(report.items(), key=lambda item: -item[1]['seconds']):
+        print('{:<20} {:>8.3f} s {:>10} KB'.format(name, stats['seconds'], stats['memory_kb']))
+    print('Total drivers\' load: {:.3f} s'.format(time.perf_counter() - start))
@@ -0,0 +1,165 @@
+"""
+A module for parallel repricing of goods of one pharmacy
+
+Goods are partitioned by the hash of ID_Goods between processes of a pool.
+The competitors' price index and the goods' current prices are put into
+shared memory once, every process reads its partition from there and writes
+new prices into a shared output array, nothing big is pickled.
+"""
+
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+
+import price_index
+import repricing
+
+
+class SharedArrays:
+    """
+    Numpy arrays in one block of shared memory.
+
+    The creator owns the block and unlinks it on close, processes attach to it
+    by the spec.
+    """
+
+    def __init__(self, arrays=None, spec=None):
+        if spec is None:
+            layout = []
+            offset = 0
+            for name, arr in arrays.items():
+                arr = np.ascontiguousarray(arr)
+                layout.append((name, arr.dtype.str, arr.shape, offset))
+                offset += max(arr.nbytes, 1)
+
+            self._shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+            self._owner = True
+            self._spec = (self._shm.name, layout)
+            self._set_views()
+            for name, arr in arrays.items():
+                self._views[name][...] = arr
+        else:
+            # Processes of the pool share the creator's resource tracker, the block is unlinked once
+            self._shm = shared_memory.SharedMemory(name=spec[0])
+            self._owner = False
+            self._spec = spec
+            self._set_views()
+
+    @property
+    def spec(self):
+        return self._spec
+
+    def __getitem__(self, name):
+        return self._views[name]
+
+    def close(self):
+        self._views = {}
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+    def _set_views(self):
+        self._views = {}
+        for name, dtype, shape, offset in self._spec[1]:
+            self._views[name] = np.ndarray(shape, dtype=dtype, buffer=self._shm.buf, offset=offset)
+
+
+def _reprice_partition(spec, start, end, band_codes, ratio_matrix, price_bands):
+    arrays = SharedArrays(spec=spec)
+    try:
+        band_min_prices = price_index.get_band_min_prices(
+            arrays['positions'][start:end],
+            arrays['starts'],
+            arrays['ends'],
+            arrays['branch_codes'],
+            arrays['prices'],
+            band_codes
+        )
+        arrays['output'][start:end] = repricing.reprice(
+            arrays['base'][start:end], arrays['reserve'][start:end], band_min_prices, ratio_matrix, price_bands)
+    finally:
+        arrays.close()
+
+    return end - start
+
+
+class GoodsPool:
+    """
+    A pool of processes repricing goods of a pharmacy.
+
+    Price lists shorter than min_goods are repriced in the calling thread,
+    starting the processes costs more than the work.
+    """
+
+    min_goods = 5000
+
+    def __init__(self, workers):
+        self._workers = max(int(workers), 1)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def workers(self):
+        return self._workers
+
+    def reprice_goods(self, pharmacy_prices, index, band_codes, ratio_matrix, price_bands):
+        """
+        New reserve prices of a pharmacy's price list, see repricing.reprice_goods
+
+        returns an array of new reserve prices in the rows' order
+        """
+
+        if self.workers < 2 or index is None or len(pharmacy_prices) < self.min_goods:
+            return repricing.reprice_goods(pharmacy_prices, index, band_codes, ratio_matrix, price_bands)
+
+        new_prices = pharmacy_prices['PriceReserve'].to_numpy(dtype=float).copy()
+        is_linked, base_prices, reserve_prices = repricing.get_current_prices(pharmacy_prices)
+        if not is_linked.any():
+            return new_prices
+
+        # Rows are ordered by partitions, every process gets a contiguous slice
+        goods = pharmacy_prices['ID_Goods'].to_numpy()[is_linked]
+        partitions = pd.util.hash_array(goods.astype(str)) % np.uint64(self.workers)
+        order = np.argsort(partitions, kind='stable')
+        bounds = np.searchsorted(partitions[order], np.arange(self.workers + 1, dtype=np.uint64))
+
+        arrays = dict(index.arrays)
+        arrays['positions'] = index.get_positions(goods[order])
+        arrays['base'] = base_prices[order]
+        arrays['reserve'] = reserve_prices[order]
+        arrays['output'] = np.zeros(len(order))
+
+        band_codes = [np.asarray(codes) for codes in band_codes]
+        ratio_matrix = np.asarray(ratio_matrix, dtype=float)
+        shared = SharedArrays(arrays)
+        try:
+            executor = self._get_executor()
+            futures = [
+                executor.submit(_reprice_partition, shared.spec, int(bounds[ind]), int(bounds[ind + 1]),
+                                band_codes, ratio_matrix, tuple(price_bands))
+                for ind in range(self.workers) if bounds[ind] < bounds[ind + 1]
+            ]
+            for future in futures:
+                future.result()
+
+            linked_prices = np.empty(len(order))
+            linked_prices[order] = shared['output']
+        finally:
+            shared.close()
+
+        new_prices[is_linked] = linked_prices
+        return new_prices
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor
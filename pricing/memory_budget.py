@@ -0,0 +1,165 @@
+"""
+A module for memory budgeted calculations
+
+The budget limits concurrent calculations by the process's resident memory.
+"""
+
+import os
+import sys
+import threading
+
+
+def get_rss():
+    """Resident memory of the process in bytes, 0 when it's unknown"""
+
+    try:
+        with open('/proc/self/statm', 'r') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError, IndexError):
+        pass
+
+    if sys.platform == 'win32':
+        return _get_windows_rss()
+
+    try:
+        import resource
+    except ImportError:
+        return 0
+
+    # Only the peak is known, kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _get_windows_rss():
+    import ctypes
+    from ctypes import wintypes
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [
+            ('cb', wintypes.DWORD),
+            ('PageFaultCount', wintypes.DWORD),
+            ('PeakWorkingSetSize', ctypes.c_size_t),
+            ('WorkingSetSize', ctypes.c_size_t),
+            ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+            ('QuotaPagedPoolUsage', ctypes.c_size_t),
+            ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+            ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+            ('PagefileUsage', ctypes.c_size_t),
+            ('PeakPagefileUsage', ctypes.c_size_t)
+        ]
+
+    counters = ProcessMemoryCounters()
+    counters.cb = ctypes.sizeof(counters)
+    process = ctypes.windll.kernel32.GetCurrentProcess()
+    if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+        return 0
+
+    return counters.WorkingSetSize
+
+
+class BudgetExceededError(MemoryError):
+    """A calculation's data doesn't fit its share of the budget"""
+
+
+def get_frame_bytes(df):
+    return 0 if df is None else int(df.memory_usage(index=True, deep=True).sum())
+
+
+class PeakRSS:
+    """
+    Measures the peak resident memory of the process while the block runs
+
+    Memory is shared by all the threads of the process, concurrent calculations
+    are included in the peak: it's the process's peak, not the block's one.
+    growth is the peak above the memory at the start, the closest estimate of the block's memory.
+
+    Usage:
+        with PeakRSS() as rss:
+            pricing.execute()
+        rss.peak, rss.growth
+    """
+
+    def __init__(self, interval=0.05):
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self.start = 0
+        self.peak = 0
+
+    @property
+    def growth(self):
+        """Bytes the peak is above the memory at the start"""
+
+        return max(self.peak - self.start, 0)
+
+    def __enter__(self):
+        self.start = self.peak = get_rss()
+        self._thread = threading.Thread(target=self._sample, name='PeakRSS', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, get_rss())
+
+    def _sample(self):
+        while not self._stop.wait(self._interval):
+            self.peak = max(self.peak, get_rss())
+
+
+class MemoryBudget:
+    """
+    Admits calculations while the process fits the budget.
+
+    A calculation starts when the resident memory and the estimated growth
+    of a calculation are within the budget, one calculation always runs.
+    The estimate is the biggest recently observed growth of a calculation.
+
+    Attributes:
+        -budget - bytes
+    """
+
+    _decay = 0.8
+
+    def __init__(self, budget):
+        self._budget = int(budget)
+        self._condition = threading.Condition()
+        self._running = 0
+        self._estimate = 0
+
+    @property
+    def budget(self):
+        return self._budget
+
+    @property
+    def estimate(self):
+        return self._estimate
+
+    def acquire(self):
+        with self._condition:
+            # Memory is freed without notifications, it's checked again periodically
+            while self._running and get_rss() + self._estimate > self._budget:
+                self._condition.wait(0.1)
+            self._running += 1
+
+    def release(self, growth=0):
+        with self._condition:
+            self._running -= 1
+            self._estimate = max(int(growth), int(self._estimate * self._decay))
+            self._condition.notify_all()
+
+    def run(self, calculate):
+        """Runs calculate() within the budget, returns a tuple (result, PeakRSS)"""
+
+        self.acquire()
+        rss = PeakRSS()
+        try:
+            with rss:
+                result = calculate()
+        finally:
+            self.release(rss.growth)
+
+        return result, rss
+
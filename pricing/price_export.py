@@ -0,0 +1,174 @@
+"""
+A module for prices' export modes
+"""
+
+import os
+import json
+import pandas as pd
+
+
+class ExportMode:
+    """Possible export modes"""
+
+    Full = 'full'
+    Delta = 'delta'
+
+
+class PriceExport:
+    """
+    A class decides which offers of a pharmacy are written to the export file.
+
+    In full mode every offer is exported. In delta mode only offers whose values
+    differ from the last export are written, removed offers are exported
+    with zero quantity before them, and every N-th export is a full snapshot.
+    Offers are matched by Code and their order among offers of the same Code,
+    so offers with a repeated Code are exported too.
+    The last exported prices are kept per branch next to the archives,
+    the exports history is described by a manifest for consumers.
+    """
+
+    _keys = ('Code', '_Occurrence')
+
+    def __init__(self, save_path, serial_number, mode=ExportMode.Full, snapshot_every=0):
+        self._save_path = save_path
+        self._serial_number = serial_number
+        self._mode = mode or ExportMode.Full
+        self._snapshot_every = int(snapshot_every or 0)
+        self._manifest = None
+        self._removed = 0
+
+    @property
+    def mode(self):
+        return self._mode
+
+    @property
+    def state_path(self):
+        return os.path.join(self._save_path, 'state_' + str(self._serial_number) + '.pkl')
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self._save_path, 'manifest_' + str(self._serial_number) + '.json')
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            self._manifest = self._read_manifest()
+        return self._manifest
+
+    def select(self, prices):
+        """
+        Chooses offers to export
+
+        returns a tuple (kind, DataFrame), kind is 'full' or 'delta'
+        """
+
+        if self.mode != ExportMode.Delta:
+            return ExportMode.Full, prices
+
+        previous = self._read_state()
+        if previous is None or self._is_snapshot_due():
+            return ExportMode.Full, prices
+
+        return ExportMode.Delta, self._get_delta(previous, prices)
+
+    def commit(self, kind, file_name, date, prices, exported):
+        """
+        Stores the exported prices as the new state and updates the manifest
+
+        Attributes:
+            -kind - string, 'full' or 'delta'
+            -file_name - string, a name of the written archive
+            -date - datetime, prices' date
+            -prices - DataFrame, all current prices of the pharmacy
+            -exported - DataFrame, offers written into the archive
+        """
+
+        if self.mode != ExportMode.Delta:
+            return
+
+        prices.to_pickle(self.state_path)
+
+        manifest = self.manifest
+        entry = {
+            'file': file_name,
+            'date': date.strftime('%Y%m%d%H%M%S'),
+            'rows': int(len(exported))
+        }
+        if kind == ExportMode.Full:
+            manifest['snapshot'] = entry
+            manifest['deltas'] = []
+        else:
+            entry['base'] = manifest['snapshot']['file'] if manifest.get('snapshot') else ''
+            entry['removed'] = self._removed
+            manifest['deltas'].append(entry)
+
+        manifest['exports_since_snapshot'] = len(manifest['deltas'])
+        with open(self.manifest_path, 'w') as file:
+            json.dump(manifest, file, indent=2)
+
+    def _is_snapshot_due(self):
+        if not self.manifest.get('snapshot'):
+            return True
+        if not self._snapshot_every:
+            return False
+
+        return len(self.manifest['deltas']) + 1 >= self._snapshot_every
+
+    def _get_delta(self, previous, prices):
+        keys = list(self._keys)
+        current = self._with_occurrence(prices)
+        previous = self._with_occurrence(previous)
+        compared = [col for col in prices.columns if col not in keys and col in previous.columns]
+
+        # Keys are unique, so the left merge keeps the current offers' rows and order
+        merged = current.merge(previous[keys + compared], on=keys, how='left', suffixes=('', '_previous'),
+                               indicator=True)
+        is_changed = (merged['_merge'] == 'left_only').to_numpy(copy=True)
+        for col in compared:
+            values, old_values = merged[col], merged[col + '_previous']
+            is_changed |= (values.ne(old_values) & ~(values.isna() & old_values.isna())).to_numpy()
+
+        changed = prices[is_changed]
+
+        is_kept = previous[keys].merge(current[keys], on=keys, how='left', indicator=True)['_merge'] == 'both'
+        removed = previous[~is_kept.to_numpy()].drop(columns=keys[1])
+        if 'Quantity' in removed.columns:
+            removed['Quantity'] = 0
+        self._removed = len(removed)
+
+        # Removed offers go first, a consumer keyed by Code gets the current offer last
+        delta = pd.concat([removed, changed], sort=False, ignore_index=True)
+        return delta[prices.columns]
+
+    def _with_occurrence(self, prices):
+        """Numbers offers of the same Code in their order"""
+
+        key, occurrence = self._keys
+        return prices.assign(**{occurrence: prices.groupby(key, dropna=False, sort=False).cumcount().to_numpy()})
+
+    def _read_state(self):
+        if not os.path.exists(self.state_path):
+            return None
+
+        try:
+            return pd.read_pickle(self.state_path)
+        except (OSError, ValueError) as e:
+            print('Error:', e)
+            return None
+
+    def _read_manifest(self):
+        manifest = {
+            'serial_number': self._serial_number,
+            'snapshot': None,
+            'deltas': [],
+            'exports_since_snapshot': 0
+        }
+
+        if os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path, 'r') as file:
+                    manifest.update(json.load(file))
+            except (OSError, ValueError) as e:
+                print('Error:', e)
+
+        return manifest
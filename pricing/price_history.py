@@ -0,0 +1,348 @@
+"""
+A module for own and competitors' prices history
+"""
+
+import os
+import datetime
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+
+class PriceSource:
+    """Possible sources of history's prices"""
+
+    Own = 'own'
+    Competitor = 'competitor'
+    Exported = 'exported'
+
+
+class PriceHistory:
+    """
+    An append-only store of observed prices keyed by (ID_Branch, ID_Goods, Timestamp).
+
+    Every append writes new files into partitions of the observations' dates,
+    files are never changed later, so readers don't lock them and loaded
+    files are cached. Queries read only partitions of the asked dates.
+    A partition with more than compact_files appended files is compacted:
+    they are merged into one file, see compact().
+    """
+
+    columns = ['Source', 'ID_Branch', 'ID_Goods', 'Timestamp', 'Price', 'PriceReserve']
+    compact_files = 32
+    _date_format = '%Y%m%d'
+    _compacted_prefix = 'compact_'
+    _lock_name = 'compact.lock'
+    _lock_timeout = 600.
+    _cached_files = 256
+    _appended_keys = 100000
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._files = {}
+        self._appended = OrderedDict()
+
+    @property
+    def path(self):
+        return self._path
+
+    def append(self, prices, source, timestamp=None):
+        """
+        Stores observed prices
+
+        Observations are stamped with the prices' DateTime, rows of (ID_Branch, source, DateTime)
+        appended before by the process are skipped, e.g. cached prices of a competitor of several pharmacies.
+
+        Attributes:
+            -prices - DataFrame with ID_Branch, ID_Goods, Price and optional PriceReserve and DateTime columns
+            -source - string, PriceSource value
+            -timestamp - datetime of the observation without DateTime, now by default
+
+        returns a list of the written files' names, empty when there is nothing to store
+        """
+
+        if prices is None or prices.empty:
+            return []
+
+        df = pd.DataFrame({
+            'Source': source,
+            'ID_Branch': prices['ID_Branch'].astype(str).str.upper().to_numpy(),
+            'ID_Goods': prices['ID_Goods'].astype(str).to_numpy(),
+            'Timestamp': self._get_timestamps(prices, timestamp or datetime.datetime.now()),
+            'Price': pd.to_numeric(prices['Price'], errors='coerce').astype(float).to_numpy(),
+            'PriceReserve': self._get_reserve(prices)
+        }, columns=self.columns)
+        df = self._drop_appended(df.dropna(subset=['Price']), source)
+
+        file_names = []
+        for date, part_df in df.groupby(df['Timestamp'].dt.normalize(), sort=True):
+            part_df = part_df.astype({'Source': 'category', 'ID_Branch': 'category', 'ID_Goods': 'category'})
+
+            partition = os.path.join(self._path, date.strftime(self._date_format))
+            os.makedirs(partition, exist_ok=True)
+
+            file_name = os.path.join(partition, '{}_{}_{}_{}.pkl'.format(
+                source, time.time_ns(), os.getpid(), threading.get_ident()))
+            self._write(part_df.reset_index(drop=True), file_name)
+            file_names.append(file_name)
+
+            if self.compact_files and len(self._get_files(partition)[1]) > self.compact_files:
+                self.compact(date)
+
+        return file_names
+
+    def compact(self, date, full=False):
+        """
+        Merges files of a date's partition
+
+        Appended files are merged into a new compacted file, compacted files are merged too
+        when there are more than compact_files of them, so rows of a day are rewritten a few times only.
+        With full all the files are merged, e.g. for partitions of past days.
+        Merged files are deleted after the new file is written, readers missing a deleted file
+        list the partition again. A partition is compacted by one process at a time.
+
+        returns the name of the written file, None when nothing is merged
+        """
+
+        partition = os.path.join(self._path, date.strftime(self._date_format))
+        lock_name = os.path.join(partition, self._lock_name)
+        try:
+            lock = os.open(lock_name, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_name) > self._lock_timeout:
+                    # A lock of a crashed process, the partition is compacted by the next append
+                    os.remove(lock_name)
+            except OSError:
+                pass
+            return None
+
+        try:
+            compacted, appended = self._get_files(partition)
+            merged = appended + (compacted if full or len(compacted) > self.compact_files else [])
+            if len(merged) < 2:
+                return None
+
+            frames = [self._read_file(os.path.join(partition, name)) for name in merged]
+            frames = [df for df in frames if df is not None]
+            if not frames:
+                return None
+
+            df = pd.concat(frames, ignore_index=True)
+            df = df.astype({'Source': 'category', 'ID_Branch': 'category', 'ID_Goods': 'category'})
+
+            file_name = os.path.join(partition, '{}{}_{}.pkl'.format(self._compacted_prefix, time.time_ns(), os.getpid()))
+            self._write(df, file_name)
+            for name in merged:
+                os.remove(os.path.join(partition, name))
+            with self._lock:
+                for name in merged:
+                    self._files.pop(os.path.join(partition, name), None)
+
+            return file_name
+        finally:
+            os.close(lock)
+            os.remove(lock_name)
+
+    def scan(self, start, end, branches=None, goods=None, source=None):
+        """
+        Prices observed from start to end inclusive, sorted by Timestamp
+
+        Attributes:
+            -start, end - datetime
+            -branches, goods - lists of ID_Branch and ID_Goods, all by default
+            -source - string, PriceSource value, all sources by default
+        """
+
+        frames = []
+        for date in self._get_dates(start, end):
+            df = self._read_partition(date, branches, goods, source)
+            if df is not None:
+                frames.append(df)
+
+        if not frames:
+            return self._get_empty()
+
+        df = pd.concat(frames, ignore_index=True)
+        df = df[(df['Timestamp'] >= pd.Timestamp(start)) & (df['Timestamp'] <= pd.Timestamp(end))]
+        return df.sort_values('Timestamp', kind='mergesort').reset_index(drop=True)
+
+    def latest(self, as_of, branches=None, goods=None, source=None, lookback_days=31):
+        """
+        The last price of every (Source, ID_Branch, ID_Goods) observed not later than as_of
+
+        Partitions are read from as_of backwards, older partitions of a found key are skipped.
+        The walk stops when every asked (branch, good) pair of the source is found
+        or lookback_days partitions are read.
+        """
+
+        wanted = None
+        if branches is not None and goods is not None and source is not None:
+            wanted = len(set(str(branch).upper() for branch in branches)) * len(set(str(item) for item in goods))
+
+        frames = []
+        found = None
+        as_of = pd.Timestamp(as_of)
+        for days in range(lookback_days + 1):
+            date = (as_of - pd.Timedelta(days=days)).to_pydatetime()
+            df = self._read_partition(date, branches, goods, source)
+            if df is None:
+                continue
+
+            df = df[df['Timestamp'] <= as_of]
+            keys = pd.MultiIndex.from_arrays([df['Source'], df['ID_Branch'], df['ID_Goods']])
+            if found is not None:
+                # Observations of a later partition are newer
+                is_new = ~keys.isin(found)
+                df = df[is_new]
+                keys = keys[is_new]
+            if df.empty:
+                continue
+
+            frames.append(df)
+            found = keys.unique() if found is None else found.append(keys).unique()
+            if wanted is not None and len(found) >= wanted:
+                break
+
+        if not frames:
+            return self._get_empty()
+
+        df = pd.concat(frames, ignore_index=True).sort_values('Timestamp', kind='mergesort')
+        df = df.drop_duplicates(subset=['Source', 'ID_Branch', 'ID_Goods'], keep='last')
+        return df.reset_index(drop=True)
+
+    def get_partitions(self):
+        """Dates of the stored partitions"""
+
+        if not os.path.isdir(self._path):
+            return []
+
+        dates = []
+        for name in sorted(os.listdir(self._path)):
+            try:
+                dates.append(datetime.datetime.strptime(name, self._date_format))
+            except ValueError:
+                continue
+        return dates
+
+    def _get_dates(self, start, end):
+        start = pd.Timestamp(start).normalize()
+        end = pd.Timestamp(end).normalize()
+        return [date for date in self.get_partitions() if start <= pd.Timestamp(date) <= end]
+
+    def _read_partition(self, date, branches, goods, source):
+        partition = os.path.join(self._path, date.strftime(self._date_format))
+        if not os.path.isdir(partition):
+            return None
+
+        error = None
+        for _ in range(3):
+            try:
+                return self._read_files(partition, branches, goods, source)
+            except FileNotFoundError as e:
+                # The files are merged by a compaction, its file is listed now
+                error = e
+
+        print('Error:', error)
+        return None
+
+    def _read_files(self, partition, branches, goods, source):
+        compacted, appended = self._get_files(partition)
+        frames = []
+        for name in compacted + appended:
+            df = self._read_file(os.path.join(partition, name))
+            if df is None:
+                continue
+
+            if source is not None:
+                df = df[df['Source'] == source]
+            if branches is not None:
+                df = df[df['ID_Branch'].isin([str(branch).upper() for branch in branches])]
+            if goods is not None:
+                df = df[df['ID_Goods'].isin([str(item) for item in goods])]
+            if not df.empty:
+                frames.append(df.astype({'Source': str, 'ID_Branch': str, 'ID_Goods': str}))
+
+        if not frames:
+            return None
+
+        return pd.concat(frames, ignore_index=True)
+
+    def _read_file(self, file_name):
+        with self._lock:
+            df = self._files.get(file_name)
+        if df is not None:
+            return df
+
+        try:
+            df = pd.read_pickle(file_name)
+        except FileNotFoundError:
+            raise
+        except (OSError, ValueError) as e:
+            print('Error:', e)
+            return None
+
+        with self._lock:
+            if len(self._files) >= self._cached_files:
+                self._files.pop(next(iter(self._files)))
+            self._files[file_name] = df
+
+        return df
+
+    def _get_files(self, partition):
+        """Names of a partition's compacted and appended files"""
+
+        if not os.path.isdir(partition):
+            return [], []
+
+        names = sorted(name for name in os.listdir(partition) if name.endswith('.pkl'))
+        compacted = [name for name in names if name.startswith(self._compacted_prefix)]
+        appended = [name for name in names if not name.startswith(self._compacted_prefix)]
+        return compacted, appended
+
+    @staticmethod
+    def _write(df, file_name):
+        df.to_pickle(file_name + '.tmp')
+        os.replace(file_name + '.tmp', file_name)
+
+    def _drop_appended(self, df, source):
+        keys = pd.MultiIndex.from_arrays([df['ID_Branch'], df['Timestamp']])
+        with self._lock:
+            appended = []
+            for key in keys.unique():
+                if (source,) + key in self._appended:
+                    appended.append(key)
+                else:
+                    self._appended[(source,) + key] = True
+            while len(self._appended) > self._appended_keys:
+                self._appended.popitem(last=False)
+
+        if not appended:
+            return df
+
+        return df[~keys.isin(appended)]
+
+    def _get_empty(self):
+        return pd.DataFrame([], columns=self.columns)
+
+    @staticmethod
+    def _get_timestamps(prices, default):
+        if 'DateTime' not in prices.columns:
+            return np.full(len(prices), np.datetime64(default, 'ns'))
+
+        timestamps = pd.to_datetime(prices['DateTime'], errors='coerce')
+        if timestamps.dt.tz is not None:
+            # Naive times are local
+            timestamps = timestamps.dt.tz_convert(datetime.datetime.now().astimezone().tzinfo).dt.tz_localize(None)
+
+        return timestamps.fillna(pd.Timestamp(default)).astype('datetime64[ns]').to_numpy()
+
+    @staticmethod
+    def _get_reserve(prices):
+        if 'PriceReserve' not in prices.columns:
+            return np.full(len(prices), np.nan)
+
+        return pd.to_numeric(prices['PriceReserve'], errors='coerce').astype(float).to_numpy()
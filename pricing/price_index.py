@@ -0,0 +1,191 @@
+"""
+A module for competitors' minimum prices index
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class MinPriceIndex:
+    """
+    A class keeps minimum competitors' prices per (ID_Goods, ID_Branch).
+
+    Rows are sorted by goods, so prices of a good are one slice of the arrays
+    and "minimum price of good G across branches S" is a masked minimum
+    of the slice. Branches are stored as integer codes.
+    """
+
+    def __init__(self, prices_df):
+        """
+        Attributes:
+            -prices_df - DataFrame with ID_Goods, ID_Branch, Price columns
+        """
+
+        df = MinPriceIndex._reduce(prices_df)
+        branch_codes, branches = pd.factorize(df['ID_Branch'])
+        self._set_arrays(df['ID_Goods'].to_numpy(), branch_codes, df['Price'].to_numpy(dtype=float),
+                         {branch: code for code, branch in enumerate(branches)})
+
+    def __len__(self):
+        return len(self._prices)
+
+    @property
+    def arrays(self):
+        """Numeric arrays of the index: a good's rows are starts[pos]:ends[pos] of branch_codes and prices"""
+
+        return {
+            'starts': self._starts,
+            'ends': self._ends,
+            'branch_codes': self._branch_codes,
+            'prices': self._prices
+        }
+
+    def extend(self, prices_df, removed=()):
+        """
+        Returns a new index with prices of more branches
+
+        Rows of the removed branches are dropped, so prices of a reloaded branch replace its older ones.
+        Codes of the index's branches are kept, the index itself isn't changed.
+        """
+
+        df = MinPriceIndex._reduce(prices_df)
+        branches = dict(self._branches)
+        for branch in df['ID_Branch'].unique():
+            branches.setdefault(branch, len(branches))
+
+        removed_codes = [self._branches[branch] for branch in removed if branch in self._branches]
+        is_kept = ~np.isin(self._branch_codes, removed_codes)
+        parts = [(np.repeat(self._goods, self._ends - self._starts)[is_kept], self._branch_codes[is_kept],
+                  self._prices[is_kept])]
+        if not df.empty:
+            new_part = (df['ID_Goods'].to_numpy(), df['ID_Branch'].map(branches).to_numpy(dtype=int),
+                        df['Price'].to_numpy(dtype=float))
+            # An empty part would change the goods' dtype
+            parts = [part for part in parts if len(part[0])] + [new_part]
+        goods, branch_codes, prices = (np.concatenate(arrays) for arrays in zip(*parts))
+
+        # Both parts are sorted by goods, a stable sort merges them
+        order = np.argsort(goods, kind='stable')
+        index = MinPriceIndex.__new__(MinPriceIndex)
+        index._set_arrays(goods[order], branch_codes[order], prices[order], branches)
+        return index
+
+    def get_positions(self, goods):
+        """Positions of goods in the index, -1 when a good has no prices"""
+
+        goods = np.asarray(goods)
+        positions = np.full(len(goods), -1, dtype=np.int64)
+        if not len(self._goods):
+            return positions
+
+        try:
+            pos = np.minimum(np.searchsorted(self._goods, goods), len(self._goods) - 1)
+        except TypeError:
+            return positions
+        is_found = self._goods[pos] == goods
+
+        positions[is_found] = pos[is_found]
+        return positions
+
+    def get_branch_codes(self, branches):
+        """Converts ID_Branch values to the index's codes, unknown branches are skipped"""
+
+        return np.array([self._branches[branch] for branch in branches if branch in self._branches], dtype=int)
+
+    def get_min_price(self, id_goods, branch_codes):
+        """
+        Minimum price of a good across branches
+
+        returns 0 when no branch has the good
+        """
+
+        try:
+            pos = np.searchsorted(self._goods, id_goods)
+        except TypeError:
+            return 0
+        if pos >= len(self._goods) or self._goods[pos] != id_goods or not len(branch_codes):
+            return 0
+
+        start, end = self._starts[pos], self._ends[pos]
+        mask = np.isin(self._branch_codes[start:end], branch_codes)
+        if not mask.any():
+            return 0
+
+        return self._prices[start:end][mask].min()
+
+    def get_min_prices(self, goods, branch_codes):
+        """
+        Minimum prices of many goods across branches
+
+        returns an array of minimum prices in the goods' order, 0 when no branch has a good
+        """
+
+        goods = np.asarray(goods)
+        result = np.zeros(len(goods))
+        if not len(self._goods):
+            return result
+
+        mask = np.isin(self._branch_codes, branch_codes)
+        masked_prices = np.where(mask, self._prices, np.inf)
+        min_prices = np.minimum.reduceat(masked_prices, self._starts)
+
+        try:
+            pos = np.minimum(np.searchsorted(self._goods, goods), len(self._goods) - 1)
+        except TypeError:
+            return result
+        is_found = self._goods[pos] == goods
+
+        result[is_found] = min_prices[pos[is_found]]
+        result[np.isinf(result)] = 0
+        return result
+
+    def _set_arrays(self, goods, branch_codes, prices, branches):
+        is_first = np.ones(len(goods), dtype=bool)
+        is_first[1:] = goods[1:] != goods[:-1]
+
+        self._goods = goods[is_first]
+        self._starts = np.flatnonzero(is_first)
+        self._ends = np.append(self._starts[1:], len(goods))
+
+        self._branch_codes = branch_codes
+        self._branches = branches
+        self._prices = prices
+
+    @staticmethod
+    def _reduce(prices_df):
+        df = prices_df[['ID_Goods', 'ID_Branch', 'Price']].dropna()
+        return df.groupby(['ID_Goods', 'ID_Branch'], sort=True)['Price'].min().reset_index()
+
+
+def get_band_min_prices(positions, starts, ends, branch_codes, prices, band_codes):
+    """
+    Minimum prices of goods per distance band from the index's arrays
+
+    Attributes:
+        -positions - positions of goods in the index, -1 when a good has no prices
+        -starts, ends, branch_codes, prices - MinPriceIndex.arrays
+        -band_codes - list of branch codes' arrays per band
+
+    returns an array (goods, bands), 0 when no branch of a band has a good
+    """
+
+    result = np.zeros((len(positions), len(band_codes)))
+    is_found = positions >= 0
+    if not is_found.any():
+        return result
+
+    unique_positions, inverse = np.unique(positions[is_found], return_inverse=True)
+    slice_starts = starts[unique_positions]
+    lengths = ends[unique_positions] - slice_starts
+    offsets = np.cumsum(lengths) - lengths
+    rows = np.repeat(slice_starts - offsets, lengths) + np.arange(lengths.sum())
+
+    slice_codes = branch_codes[rows]
+    slice_prices = prices[rows]
+    for band, codes in enumerate(band_codes):
+        masked_prices = np.where(np.isin(slice_codes, codes), slice_prices, np.inf)
+        min_prices = np.minimum.reduceat(masked_prices, offsets)
+        min_prices[np.isinf(min_prices)] = 0
+        result[is_found, band] = min_prices[inverse]
+
+    return result
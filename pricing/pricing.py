@@ -1,14 +1,85 @@
 """
 A module for pharmacies' pricing
+
+numpy, pandas, requests and the modules built on them are imported
+on first use, so the GUI and short runs start without loading them.
 """
 
-import numpy as np
-import pandas as pd
 import ext_connections as ext_con
+import schedule_checkpoint
+import task_leases
+import competitor_ranking
+import archive_writer
+import sampling_profiler
 import os
-import requests
-import zipfile
+import json
+import hashlib
+import functools
+from collections import OrderedDict
+import socket
 import datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+np = ext_con.LazyModule('numpy')
+pd = ext_con.LazyModule('pandas')
+requests = ext_con.LazyModule('requests')
+price_export = ext_con.LazyModule('price_export')
+price_index = ext_con.LazyModule('price_index')
+price_history = ext_con.LazyModule('price_history')
+repricing = ext_con.LazyModule('repricing')
+goods_parallel = ext_con.LazyModule('goods_parallel')
+branch_index = ext_con.LazyModule('branch_index')
+task_scheduler = ext_con.LazyModule('task_scheduler')
+memory_budget = ext_con.LazyModule('memory_budget')
+
+
+# Warm API connections shared by all the calculations of the process
+api_pool = ext_con.ConnectionPool(lambda: ext_con.TabletkiAPI(), max_size=8)
+
+
+# Request policies per API settings, calculations with other settings don't change them
+api_policies = {}
+_api_policies_lock = threading.Lock()
+
+
+def get_api_policy(settings):
+    """Returns the policy of timeouts, retries and circuit breakers of the settings' API requests"""
+
+    def get_number(name, default):
+        value = settings.get_setting(name)
+        return default if value == '' else value
+
+    parameters = (
+        ('connect_timeout', get_number('api_connect_timeout', 5.)),
+        ('read_timeout', get_number('api_read_timeout', 30.)),
+        ('retries', get_number('api_retries', 2)),
+        ('failure_threshold', get_number('api_breaker_failures', 5)),
+        ('reset_after', get_number('api_breaker_reset', 30.))
+    )
+    with _api_policies_lock:
+        policy = api_policies.get(parameters)
+        if policy is None:
+            policy = api_policies[parameters] = ext_con.RequestPolicy(**dict(parameters))
+
+    return policy
+
+
+@contextmanager
+def api_connection(settings):
+    """A pooled API connection with the policy of the settings"""
+
+    with api_pool.connection() as connection:
+        connection.policy = get_api_policy(settings)
+        yield connection
+
+
+def get_api_stats(settings):
+    """API requests' latencies per endpoint and resources with open circuits of the settings' policy"""
+
+    return get_api_policy(settings).get_stats()
 
 
 class PricingSettings:
@@ -22,105 +93,507 @@ class PricingSettings:
     4. A price per distance unit in UAH // 2
     5. A starting deviation // 0.005
 
+    Settings are parsed and validated once and can't be changed,
+    replace() returns a new object. Equal settings have equal hashes,
+    so they are used as keys of calculated tables' caches.
+
     *First realization involves manual settings input
     """
 
-    _settings = {}
+    _bands = ('prices', 'distances')
+    _required = ('prices', 'distances', 'save_path', 'auth', 'branches_api', 'tasks_api', 'tasks_delete_api',
+                 'prices_api', 'prices_all_api')
+    _numbers = ('default_unit', 'default_unit_price', 'deviation', 'price_difference', 'max_threads',
+                'full_snapshot_every', 'ack_batch_size', 'goods_workers', 'api_connect_timeout', 'api_read_timeout',
+                'api_retries', 'api_breaker_failures', 'api_breaker_reset', 'max_failed_competitors',
+                'archive_level', 'archive_writers', 'archive_queue', 'profile_threshold', 'profile_interval',
+                'task_max_wait', 'memory_budget')
+
+    def __init__(self, file_name='settings.ini', values=None):
+        """
+        Attributes:
+            -file_name - string, a settings file in the current directory
+            -values - dict, settings' values, the file isn't read when they're set
+        """
+
+        if values is None:
+            curr_dir = os.getcwd()
+            if curr_dir[-1] != '\\':
+                curr_dir += '\\'
+
+            full_name = curr_dir + file_name
+            values = dict(PricingSettings._read_file(full_name, os.path.getmtime(full_name)))
+
+        settings = {}
+        for key, value in values.items():
+            if isinstance(value, str):
+                value = PricingSettings.parse_value(value)
+            if isinstance(value, list):
+                value = tuple(value)
+            settings[key] = value
+
+        PricingSettings._validate(settings)
+
+        object.__setattr__(self, '_settings', settings)
+        object.__setattr__(self, '_hash', None)
+
+    def __setattr__(self, key, value):
+        raise AttributeError('Settings can\'t be changed, use replace()')
+
+    def __reduce__(self):
+        return PricingSettings, ('', self._settings)
+
+    def __str__(self):
+        return str(self._settings)
+
+    def __bool__(self):
+        """Checks the required settings only, 0 and '' are valid values of optional ones"""
+
+        return all(self._settings.get(key, '') not in ('', None, ()) for key in PricingSettings._required)
 
-    def __init__(self, file_name='settings.ini'):
-        curr_dir = os.getcwd()
-        if curr_dir[-1] != '\\':
-            curr_dir += '\\'
+    def __eq__(self, other):
+        return isinstance(other, PricingSettings) and self._settings == other._settings
 
-        file_name = curr_dir + file_name
+    def __hash__(self):
+        if self._hash is None:
+            object.__setattr__(self, '_hash', int(self.fingerprint[:15], 16))
+        return self._hash
+
+    @property
+    def fingerprint(self):
+        """A stable hash of the settings' values"""
+
+        text = json.dumps(self._settings, sort_keys=True)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def get_setting(self, name):
+        return self._settings.get(name, '')
+
+    def replace(self, **overrides):
+        """Returns new settings with overridden values, a string value is parsed like the file's one"""
+
+        values = dict(self._settings)
+        values.update(overrides)
+        return PricingSettings(values=values)
+
+    @staticmethod
+    def parse_value(value_str):
+        value_str = value_str.strip()
+        if not value_str:
+            # No parameter at all
+            return ''
+
+        try:
+            if value_str[-1] == ']':
+                # Parameter array of numbers
+                value_str = value_str[1:-1]
+                arr_str = value_str.split(',')
+                value = tuple(float(number_str.strip()) for number_str in arr_str)
+            else:
+                # Parameter number
+                value = float(value_str)
+        except ValueError as e:
+            # Parameter string
+            value = value_str
+
+        return value
+
+    @staticmethod
+    @functools.lru_cache(maxsize=16)
+    def _read_file(file_name, mtime):
+        """Parses a settings file once per its modification time"""
+
+        values = []
         with open(file_name, 'r') as file:
             for line in file.readlines():
                 set_arr = line.split('=')
                 key = set_arr[0].strip()
+                if not key:
+                    continue
                 value_str = line.replace(key + '=', '').strip()
 
-                if value_str:
-                    try:
-                        if value_str[-1] == ']':
-                            # Parameter array of numbers
-                            value_str = value_str[1:-1]
-                            arr_str = value_str.split(',')
-                            value = [float(number_str.strip()) for number_str in arr_str]
-                        else:
-                            # Parameter number
-                            value = float(value_str)
-                    except ValueError as e:
-                        # Parameter string
-                        value = value_str
-                else:
-                    # No parameter at all
-                    value = ''
-
-                self._settings[key] = value
+                values.append((key, PricingSettings.parse_value(value_str)))
 
-    def __str__(self):
-        return str(self._settings)
+        return tuple(values)
 
-    def __bool__(self):
-        is_configured = True
-        for element in self._settings.items():
-            if not element[1]:
-                is_configured = False
-                break
+    @staticmethod
+    def _validate(settings):
+        for key in PricingSettings._bands:
+            bands = settings.get(key, '')
+            if bands == '':
+                continue
 
-        return is_configured
+            if not isinstance(bands, tuple) or not all(isinstance(el, (int, float)) for el in bands):
+                raise ValueError('Setting %s must be a list of numbers: %s' % (key, bands))
+            if any(el <= 0 for el in bands) or any(b <= a for a, b in zip(bands, bands[1:])):
+                raise ValueError('Setting %s must be positive and ascending: %s' % (key, bands))
 
-    def get_setting(self, name):
-        return self._settings.get(name, '')
+        for key in PricingSettings._numbers:
+            value = settings.get(key, '')
+            if value != '' and (isinstance(value, bool) or not isinstance(value, (int, float))):
+                raise ValueError('Setting %s must be a number: %s' % (key, value))
 
 
 class PricingSchedule:
-    _tasks = pd.DataFrame([])
+    """
+    A class runs pricing tasks of the tasks API.
+
+    When lease_db setting is set, several nodes share the tasks:
+    every task is claimed through a lease table, the node prices branches
+    of its own regions first (shard_node of shard_nodes, region_cell degrees)
+    and then free tasks of other regions, including expired leases of crashed nodes.
+
+    Tasks are ordered by task_scheduler.TaskScheduler: overdue tasks first,
+    then big branches and their neighbours, see task_times for wait and run seconds.
+    """
+
+    _tasks = None
+    _is_scheduled = False
     _default_settings = None
+    _cache = None
+    _leases = None
+    _sharding = None
+    _worker = ''
+    _task_times = None
 
     def __init__(self):
+        self._tasks = pd.DataFrame([])
         self._default_settings = PricingSettings()
+        self._cache = BranchCache()
+        self._task_times = []
         self._set_schedule()
+        self._set_sharding()
 
     @property
     def default_settings(self):
         return self._default_settings
 
+    @property
+    def task_times(self):
+        """A list of dicts with ID_Branch, wait and run seconds, the process's peak memory and memory growth
+        of the last run's calculations"""
+
+        return list(self._task_times)
+
     def run(self):
         if not self.default_settings:
             return
 
         print('Starting... ', datetime.datetime.now())
 
-        success_ids = []
+        checkpoint = self._get_checkpoint()
+        if self._is_scheduled:
+            # Without the tasks table the checkpoint is kept for the next run
+            checkpoint.keep_only(
+                checkpoint.task_key(task['ID_Branch'], task.get('DateTime', '')) for _, task in self._tasks.iterrows()
+            )
+
+        ack_batch_size = int(self.default_settings.get_setting('ack_batch_size') or 1)
+        success_ids = self._get_unacknowledged(checkpoint)
+        pending = []
         ind = 0
         count = len(self._tasks)
-        for row in self._tasks.iterrows():
-            ind += 1
-            task = row[1]
-
-            pharm_id = task['ID_Branch']
-            ent_str = task['Code']
-            sn_str = task['SerialNumber']
-            if not ent_str or not sn_str:
-                continue
+        writer = self._get_writer()
+        scheduler = self._get_scheduler()
+        self._task_times = []
+        try:
+            for task_key, task in self._claim_tasks(checkpoint, scheduler):
+                ind += 1
+
+                pharm_id = task['ID_Branch']
+                ent_str = task['Code']
+                sn_str = task['SerialNumber']
+                task_date = task.get('DateTime', '')
+                if not ent_str or not sn_str:
+                    self._release_task(task_key)
+                    continue
+
+                str_info = 'Pharmacy %s/%s (%s): ' % (ind, count, sn_str)
+
+                if checkpoint.is_done(pharm_id, task_date):
+                    print(str_info, 'Already priced')
+                    if not checkpoint.is_acknowledged(pharm_id, task_date):
+                        success_ids.append(pharm_id)
+                    self._complete_task(task_key)
+                else:
+                    print(str_info, 'Calculating')
+
+                    enterprise_code = int(ent_str)
+                    serial_number = int(sn_str)
+
+                    new_pricing = GoodsPricing(enterprise_code, serial_number, pharm_id, self.default_settings,
+                                               cache=self._cache)
+                    # A task waits since its DateTime, 0 when it's unknown
+                    wait = task_scheduler.TaskScheduler.get_age(task_date, pd.Timestamp.now())
+                    started = time.perf_counter()
+                    with memory_budget.PeakRSS() as rss:
+                        success, keeper = self._execute(task_key, new_pricing, writer)
+                    self._add_task_time(scheduler, pharm_id, wait, time.perf_counter() - started, success, rss)
+                    if new_pricing.profile is not None:
+                        print(str_info, 'Slow calculation profile', new_pricing.profile['file'])
+                    if success:
+                        pending.append((task_key, pharm_id, task_date, str_info, new_pricing, keeper))
+                    else:
+                        self._release_task(task_key)
+                        print(str_info, 'Failure')
+
+                success_ids.extend(self._collect_archives(checkpoint, pending))
+                if len(success_ids) >= ack_batch_size:
+                    success_ids = self._acknowledge(checkpoint, success_ids)
+        finally:
+            # Queued archives are written even when the run fails
+            writer.close()
+            for item in pending:
+                self._stop_keeper(item[-1])
+        success_ids.extend(self._collect_archives(checkpoint, pending))
+        self._acknowledge(checkpoint, success_ids)
+        scheduler.estimates.save()
+        self._print_task_times()
+
+        print('Finished... ', datetime.datetime.now())
+
+    def _get_unacknowledged(self, checkpoint):
+        """
+        Tasks the node has done in the lease table, but which are still scheduled,
+        e.g. the node crashed before acknowledging them
+
+        returns a list of ID_Branch to acknowledge
+        """
+
+        if self._leases is None or not self._is_scheduled:
+            return []
+
+        tasks = {}
+        for _, task in self._tasks.iterrows():
+            tasks[checkpoint.task_key(task['ID_Branch'], task.get('DateTime', ''))] = task
+
+        return [tasks[task_key]['ID_Branch'] for task_key in self._leases.get_done(tasks, self._worker)]
+
+    def _get_scheduler(self):
+        settings = self.default_settings
+        save_path = settings.get_setting('save_path') or os.getcwd()
+
+        file_name = 'task_runtimes.json'
+        if self._leases is not None:
+            file_name = 'task_runtimes_' + self._worker + '.json'
+
+        # Branches of one cell share competitors of the largest distance band
+        distances = settings.get_setting('distances') or (2000,)
+        cell_size = max(distances) / 111000.
+
+        return task_scheduler.TaskScheduler(
+            task_scheduler.RuntimeEstimates(save_path + '\\' + file_name),
+            cell_size=cell_size,
+            max_wait=float(settings.get_setting('task_max_wait') or 3600)
+        )
+
+    def _add_task_time(self, scheduler, pharm_id, wait, run, success, rss=None):
+        self._task_times.append({
+            'ID_Branch': pharm_id,
+            'wait': round(wait, 3),
+            'run': round(run, 3),
+            # Concurrent tasks share the process's memory, growth is the closest estimate of the task's memory
+            'process_peak_rss_mb': round(rss.peak / 2 ** 20, 1) if rss else 0.,
+            'rss_growth_mb': round(rss.growth / 2 ** 20, 1) if rss else 0.,
+            'success': success
+        })
+        if success:
+            scheduler.estimates.update(pharm_id, run)
+
+    def _print_task_times(self):
+        if not self._task_times:
+            return
+
+        df = pd.DataFrame(self._task_times)
+        print('Tasks: %s, wait mean/max: %.1f/%.1f s, run mean/max: %.1f/%.1f s, '
+              'process peak memory: %.1f MB, max memory growth: %.1f MB' % (
+                len(df), df['wait'].mean(), df['wait'].max(), df['run'].mean(), df['run'].max(),
+                df['process_peak_rss_mb'].max(), df['rss_growth_mb'].max()))
+
+    def _get_checkpoint(self):
+        save_path = self.default_settings.get_setting('save_path')
+        if not save_path:
+            save_path = os.getcwd()
+
+        file_name = 'schedule_checkpoint.json'
+        if self._leases is not None:
+            # Nodes sharing save_path keep their own checkpoints
+            file_name = 'schedule_checkpoint_' + self._worker + '.json'
+
+        return schedule_checkpoint.ScheduleCheckpoint(save_path + '\\' + file_name)
+
+    def _set_sharding(self):
+        settings = self.default_settings
+        lease_db = settings.get_setting('lease_db')
+        if not lease_db:
+            return
 
-            str_info = 'Pharmacy %s/%s (%s): ' % (ind, count, sn_str)
-            print(str_info, 'Calculating')
+        # A stable name: a restarted node finds its checkpoint and leases
+        self._worker = socket.gethostname() + '_' + str(int(settings.get_setting('shard_node') or 1))
+        self._leases = task_leases.LeaseTable(
+            lease_db,
+            ttl=float(settings.get_setting('lease_ttl') or 300),
+            done_ttl=float(settings.get_setting('lease_done_ttl') or 86400)
+        )
+        self._sharding = task_leases.RegionSharding(
+            settings.get_setting('shard_node') or 1,
+            settings.get_setting('shard_nodes') or 1,
+            settings.get_setting('region_cell') or 0.5
+        )
+
+    def _claim_tasks(self, checkpoint, scheduler):
+        """
+        Yields tuples (task key, task) to run
+
+        Without leases all the tasks are yielded in the scheduler's order, otherwise the next task
+        is claimed in the lease table: own regions' tasks go first.
+        """
+
+        tasks = {}
+        for _, task in self._tasks.iterrows():
+            tasks[checkpoint.task_key(task['ID_Branch'], task.get('DateTime', ''))] = task
+
+        coordinates = self._get_coordinates()
+        order = scheduler.order(
+            {task_key: (task['ID_Branch'], task.get('DateTime', '')) for task_key, task in tasks.items()},
+            coordinates
+        )
+        tasks = {task_key: tasks[task_key] for task_key in order}
+
+        if self._leases is None:
+            for task_key, task in tasks.items():
+                yield task_key, task
+            return
+
+        own_keys, other_keys = self._split_by_region(tasks, coordinates)
+
+        tried = set()
+        while True:
+            candidates = [key for key in own_keys if key not in tried]
+            task_key = self._leases.claim(candidates, self._worker)
+            if task_key is None:
+                candidates = [key for key in other_keys if key not in tried]
+                task_key = self._leases.claim(candidates, self._worker)
+            if task_key is None:
+                break
+
+            tried.add(task_key)
+            yield task_key, tasks[task_key]
+
+    def _get_coordinates(self):
+        """returns a dict {upper case ID_Branch: (lat, lng)}"""
+
+        url_pharmacies = self.default_settings.get_setting('branches_api')
+        pharm_df = self._cache.get_pharmacy_table(
+            url_pharmacies,
+            lambda: GoodsPricing.load_pharmacy_table(self.default_settings)
+        )
 
-            enterprise_code = int(ent_str)
-            serial_number = int(sn_str)
+        coordinates = {}
+        if pharm_df is not None:
+            for pharm_id, lat, lng in zip(pharm_df.ID_Branch, pharm_df.Lat, pharm_df.Lng):
+                coordinates[str(pharm_id).upper()] = (lat, lng)
 
-            new_pricing = GoodsPricing(enterprise_code, serial_number, pharm_id, self.default_settings)
-            if new_pricing.execute():
-                success_ids.append(pharm_id)
-                print(str_info, 'Success')
+        return coordinates
+
+    def _split_by_region(self, tasks, coordinates):
+        own_keys = []
+        other_keys = []
+        for task_key, task in tasks.items():
+            lat_lng = coordinates.get(str(task['ID_Branch']).upper())
+            if lat_lng is None or self._sharding.is_own(*lat_lng):
+                own_keys.append(task_key)
             else:
+                other_keys.append(task_key)
+
+        return own_keys, other_keys
+
+    def _execute(self, task_key, new_pricing, writer=None):
+        """
+        Calculates a task under its lease
+
+        returns a tuple (success, LeaseKeeper renewing the lease until the task's archive is written or None)
+        """
+
+        if self._leases is None:
+            return new_pricing.execute(writer=writer), None
+
+        keeper = self._leases.keep(task_key, self._worker).start()
+        try:
+            success = new_pricing.execute(writer=writer)
+        except BaseException:
+            keeper.stop()
+            raise
+
+        if not success or keeper.is_lost:
+            keeper.stop()
+            return False, None
+
+        return True, keeper
+
+    @staticmethod
+    def _stop_keeper(keeper):
+        if keeper is not None:
+            keeper.stop()
+
+    def _get_writer(self):
+        settings = self.default_settings
+        return archive_writer.ArchiveWriter(
+            workers=int(settings.get_setting('archive_writers') or 1),
+            queue_size=int(settings.get_setting('archive_queue') or 1)
+        )
+
+    def _collect_archives(self, checkpoint, pending):
+        """
+        Finishes tasks whose archives are written, a task is done when its archive is written
+
+        returns a list of finished ids to acknowledge, pending is left with unfinished tasks
+        """
+
+        success_ids = []
+        for item in list(pending):
+            task_key, pharm_id, task_date, str_info, new_pricing, keeper = item
+            future = new_pricing.archive_future
+            if future is not None and not future.done():
+                continue
+
+            pending.remove(item)
+            self._stop_keeper(keeper)
+            if (future is not None and future.exception() is not None) or (keeper is not None and keeper.is_lost):
+                self._release_task(task_key)
                 print(str_info, 'Failure')
+                continue
 
-        self._del_schedule(success_ids)
+            checkpoint.set_done(pharm_id, task_date, new_pricing.archive_name)
+            success_ids.append(pharm_id)
+            self._complete_task(task_key)
+            print(str_info, 'Success')
 
-        print('Finished... ', datetime.datetime.now())
+        return success_ids
+
+    def _complete_task(self, task_key):
+        if self._leases is not None:
+            self._leases.complete(task_key, self._worker)
+
+    def _release_task(self, task_key):
+        if self._leases is not None:
+            self._leases.release(task_key, self._worker)
+
+    def _acknowledge(self, checkpoint, pharm_ids):
+        """
+        Deletes finished tasks from pool
+
+        returns a list of ids which are not acknowledged yet
+        """
+
+        if not pharm_ids:
+            return []
+
+        if not self._del_schedule(pharm_ids):
+            return pharm_ids
+
+        checkpoint.set_acknowledged(pharm_ids)
+        return []
 
     def _set_schedule(self):
         """Gets DataFrame of current tasks"""
@@ -136,15 +609,24 @@ class PricingSchedule:
         method = 'GET'
         content_type = 'json'
 
-        connection = ext_con.TabletkiAPI()
-        result_table = connection.execute(url_tasks, method, headers, content_type)
-        connection.disconnect()
+        try:
+            with api_connection(settings) as connection:
+                result_table = connection.execute(url_tasks, method, headers, content_type)
+        except ext_con.APIError as e:
+            print('Error:', e)
+            return
 
         if result_table is None or result_table.empty:
             return
 
-        result_table.sort_values(by='DateTime')
+        if 'ID_Branch' not in result_table.columns:
+            print('Error: tasks have no ID_Branch column')
+            return
+
+        if 'DateTime' in result_table.columns:
+            result_table = result_table.sort_values(by='DateTime', kind='mergesort').reset_index(drop=True)
         self._tasks = result_table
+        self._is_scheduled = True
 
     def _del_schedule(self, pharm_ids):
         """Deletes task from pool"""
@@ -171,7 +653,8 @@ class PricingSchedule:
         json_data = {'Items': items}
 
         try:
-            respond = requests.post(url=url_tasks_delete, headers=headers, json=json_data)
+            respond = requests.post(url=url_tasks_delete, headers=headers, json=json_data,
+                                    timeout=get_api_policy(settings).timeout)
             if respond.status_code != 200:
                 return False
 
@@ -182,13 +665,293 @@ class PricingSchedule:
         except ConnectionResetError as e:
             print('Error:', e)
             return False
-        except requests.exceptions.ConnectionError as e:
+        except requests.exceptions.RequestException as e:
             print('Error:', e)
             return False
 
         return True
 
 
+class PricingRunner:
+    """
+    A class runs pricing of many pharmacies in a pool of workers.
+
+    All the pharmacies share one BranchCache, so branches and distances
+    are loaded once per run. Every pharmacy is reported with its timings
+    the process's peak memory and the memory growth while it's calculated. With memory_budget setting (MB) a pharmacy
+    starts only when the process has memory for it.
+    """
+
+    def __init__(self, settings, workers=0, cache=None, top_k_report=False):
+        self._settings = settings
+        self._top_k_report = top_k_report
+        if not workers:
+            workers = int(settings.get_setting('max_threads') or 1)
+        self._workers = workers
+        self._cache = BranchCache() if cache is None else cache
+        self._budget = None
+        budget = settings.get_setting('memory_budget')
+        if budget:
+            self._budget = memory_budget.MemoryBudget(budget * 2 ** 20)
+
+        if api_pool.max_size < workers:
+            api_pool.max_size = workers
+
+    @property
+    def settings(self):
+        return self._settings
+
+    @property
+    def workers(self):
+        return self._workers
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def run(self, tasks, on_result=None):
+        """
+        Prices pharmacies
+
+        Attributes:
+            -tasks - iterable of tuples (enterprise code, serial number, ID_Branch)
+            -on_result - callable(dict), receives every pharmacy's result when it's ready
+
+        returns a list of results' dicts in the tasks order
+        """
+
+        tasks = list(tasks)
+        count = len(tasks)
+        settings = self.settings
+
+        # Archives are written by the writer's threads, workers go on to the next pharmacies
+        writer = archive_writer.ArchiveWriter(
+            workers=int(settings.get_setting('archive_writers') or 1),
+            queue_size=int(settings.get_setting('archive_queue') or 1)
+        )
+        with writer, ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self._run_task, task, writer) for task in tasks]
+
+            results = []
+            for ind, future in enumerate(futures):
+                result, archive_future = future.result()
+                if archive_future is not None:
+                    try:
+                        archive_future.result()
+                    except Exception as e:
+                        result['success'] = False
+                        result['error'] = str(e)
+                results.append(result)
+
+                str_info = 'Pharmacy %s/%s (%s): ' % (ind + 1, count, result['serial_number'])
+                print(str_info, 'Success' if result['success'] else 'Failure')
+
+                if on_result is not None:
+                    on_result(result)
+
+        return results
+
+    def _run_task(self, task, writer=None):
+        enterprise_code, serial_number, pharm_id = task
+
+        result = {
+            'enterprise': enterprise_code,
+            'serial_number': serial_number,
+            'ID_Branch': pharm_id,
+            'success': False,
+            'error': '',
+            'seconds': 0.,
+            'stages': {}
+        }
+
+        start = time.perf_counter()
+        new_pricing = GoodsPricing(enterprise_code, serial_number, pharm_id, self.settings, cache=self.cache)
+
+        def calculate():
+            try:
+                result['success'] = new_pricing.execute(writer=writer)
+                if result['success'] and self._top_k_report:
+                    result['top_k'] = new_pricing.compare_with_all_competitors()
+            except Exception as e:
+                result['error'] = str(e)
+
+        if self._budget is None:
+            with memory_budget.PeakRSS() as rss:
+                calculate()
+        else:
+            _, rss = self._budget.run(calculate)
+
+        result['seconds'] = round(time.perf_counter() - start, 3)
+        result['process_peak_rss_mb'] = round(rss.peak / 2 ** 20, 1)
+        result['rss_growth_mb'] = round(rss.growth / 2 ** 20, 1)
+        result['stages'] = new_pricing.timings
+        result['failed_competitors'] = new_pricing.failed_competitors
+        result['archive'] = new_pricing.archive_name
+        if new_pricing.profile is not None:
+            result['profile'] = new_pricing.profile
+
+        return result, new_pricing.archive_future
+
+
+class BranchCache:
+    """
+    A cache of branches and distances between them.
+
+    One instance is shared by consecutive calculations of a session,
+    so the branches table is downloaded and the distances are calculated only once.
+    Competitors' prices are kept for prices_ttl seconds, pharmacies with overlapping competitors
+    don't download them again. Expired ones are evicted, at most max_branch_prices of the latest are kept.
+    One minimum price index of the cached prices is shared by all the pharmacies,
+    it's extended with prices of new and reloaded competitors.
+    Distances of single branch pairs are memoized, the max_pairs least recently used are kept.
+    Branch indexes with enterprises' codes are built once for every exclusion groups' setting.
+    """
+
+    def __init__(self, prices_ttl=600., max_pairs=100000, max_branch_prices=1000):
+        self._lock = threading.Lock()
+        self._index_lock = threading.Lock()
+        self._pharmacy_tables = {}
+        self._distance_tables = {}
+        self._branch_indexes = {}
+        self._prices_ttl = prices_ttl
+        self._branch_prices = {}
+        # The shared index and load times of its branches' prices
+        self._price_index = None
+        self._indexed = {}
+        self._max_branch_prices = max_branch_prices
+        self._max_pairs = max_pairs
+        self._pair_distances = OrderedDict()
+
+    def get_pharmacy_table(self, url, loader):
+        """Returns the branches table for the API url, loads it on the first call"""
+
+        return self._get(self._pharmacy_tables, url, loader)
+
+    def get_distance_table(self, url, calculator):
+        """Returns the distances table for the branches of the API url"""
+
+        return self._get(self._distance_tables, url, calculator)
+
+    def get_branch_index(self, url, exclusion_groups, builder):
+        """Returns a branch_index.BranchIndex of the branches of the API url"""
+
+        return self._get(self._branch_indexes, (url, exclusion_groups), builder)
+
+    def get_branch_prices(self, id_branch, loader):
+        """Returns a competitor's prices, loads them when they're missed or expired"""
+
+        return self._get_fresh(self._branch_prices, id_branch, loader, self._max_branch_prices)
+
+    def get_price_index(self, branches, converter):
+        """
+        Returns the minimum price index of the cached competitors' prices
+
+        Prices of the branches loaded since the index was built replace their older rows,
+        evicted branches are dropped. The index has prices of other pharmacies' competitors too,
+        a pharmacy queries it with its competitors' branch codes.
+
+        Attributes:
+            -branches - ID_Branch of competitors, their prices are loaded by get_branch_prices
+            -converter - callable(list of DataFrame), converts loaded prices to the index's input
+        """
+
+        with self._index_lock:
+            with self._lock:
+                index, indexed = self._price_index, self._indexed
+                loaded = {branch: self._branch_prices[branch] for branch in branches if branch in self._branch_prices}
+                evicted = [branch for branch in indexed if branch not in self._branch_prices]
+
+            changed = {branch: item for branch, item in loaded.items() if indexed.get(branch) != item[1]}
+            if index is not None and not changed and not evicted:
+                return index
+
+            prices_df = converter([df for df, _ in changed.values()])
+            if index is None:
+                index = price_index.MinPriceIndex(prices_df)
+            else:
+                index = index.extend(prices_df, removed=evicted + list(changed))
+
+            indexed = {branch: loaded_time for branch, loaded_time in indexed.items() if branch not in evicted}
+            indexed.update((branch, loaded_time) for branch, (_, loaded_time) in changed.items())
+            with self._lock:
+                self._price_index, self._indexed = index, indexed
+
+        return index
+
+    def get_pair_distances(self, pairs, calculator):
+        """
+        Returns distances of branch pairs, missed pairs are calculated together
+
+        Attributes:
+            -pairs - list of tuples (ID_Branch, ID_Branch)
+            -calculator - callable(list of missed pairs), returns their distances
+        """
+
+        keys = [tuple(sorted((str(id_1).upper(), str(id_2).upper()))) for id_1, id_2 in pairs]
+        distances = {}
+        with self._lock:
+            for key in keys:
+                if key in self._pair_distances:
+                    self._pair_distances.move_to_end(key)
+                    distances[key] = self._pair_distances[key]
+
+        missed = list(OrderedDict.fromkeys(key for key in keys if key not in distances))
+        if missed:
+            calculated = calculator(missed)
+            with self._lock:
+                for key, distance in zip(missed, calculated):
+                    distances[key] = distance
+                    if distance is not None:
+                        self._pair_distances[key] = distance
+                while len(self._pair_distances) > self._max_pairs:
+                    self._pair_distances.popitem(last=False)
+
+        return [distances[key] for key in keys]
+
+    def clear(self):
+        with self._index_lock, self._lock:
+            self._pharmacy_tables.clear()
+            self._distance_tables.clear()
+            self._branch_indexes.clear()
+            self._branch_prices.clear()
+            self._price_index = None
+            self._indexed = {}
+            self._pair_distances.clear()
+
+    def _get_fresh(self, storage, key, loader, max_size):
+        now = time.monotonic()
+        with self._lock:
+            item = storage.get(key)
+        if item is not None and now - item[1] <= self._prices_ttl:
+            return item[0]
+
+        value = loader()
+        if value is not None:
+            with self._lock:
+                # Items are ordered by their load time, the oldest first
+                storage.pop(key, None)
+                storage[key] = (value, now)
+                for old_key, (_, loaded) in list(storage.items()):
+                    if len(storage) <= max_size and now - loaded <= self._prices_ttl:
+                        break
+                    del storage[old_key]
+
+        return value
+
+    def _get(self, storage, key, loader):
+        with self._lock:
+            value = storage.get(key)
+        if value is not None:
+            return value
+
+        value = loader()
+        if value is not None:
+            with self._lock:
+                value = storage.setdefault(key, value)
+
+        return value
+
+
 class GoodsPricing:
     """
     A class for pharmacies' goods pricing.
@@ -201,6 +964,16 @@ class GoodsPricing:
     - Manual prices/distances segmentation with value per N meters coefficients usage in algorithm
     """
 
+    # Columns of competitors' prices of the API
+    _api_prices_columns = ['govcode', 'govid', 'innercode', 'price', 'priceReserve', 'ID_Branch', 'DateTime']
+
+    # Objects shared by the calculations of all the threads, created under _shared_lock
+    _shared_lock = threading.Lock()
+    _ratio_tables = {}
+    _histories = {}
+    _profilers = {}
+    _goods_pools = {}
+
     _enterprise_code = 0
     _serial_number = 0
     _id_pharmacy = ''
@@ -208,18 +981,45 @@ class GoodsPricing:
     _ratio_table = None
     _pharmacy_table = None
     _distance_table = None
+    _branch_index = None
     _pharmacy_prices = None
     _competitors_prices = None
     _new_prices = None
     _min_date = None
+    _cache = None
+    _progress = None
+    _cancel_event = None
+    _timings = None
+    _stage = None
+    _archive_name = ''
+    _band_competitors = None
+    _price_index = None
+    _failed_competitors = None
+    _is_comparison = False
+    _archive_future = None
+    _profile = None
+
+    def __init__(self, ent_code, pharmacy_code, pharmacy_id, settings=None, cache=None, progress=None,
+                 cancel_event=None):
+        """
+        Attributes:
+            -cache - BranchCache, branches and distances shared between calculations
+            -progress - callable(stage, current, total), receives calculation progress
+            -cancel_event - threading.Event, stops the calculation when set
+        """
 
-    def __init__(self, ent_code, pharmacy_code, pharmacy_id, settings=None):
         self._enterprise_code = ent_code
         self._serial_number = pharmacy_code
         self._id_pharmacy = pharmacy_id.upper()
         self._settings = settings
         if self.settings is None or not self.settings:
             self._settings = PricingSettings()
+        self._cache = cache
+        self._progress = progress
+        self._cancel_event = cancel_event
+        self._timings = {}
+        self._stage = None
+        self._failed_competitors = []
 
     @property
     def enterprise_code(self):
@@ -261,13 +1061,74 @@ class GoodsPricing:
     def distance_table(self):
         return self._distance_table
 
-    def execute(self, new_settings=None):
+    @property
+    def archive_name(self):
+        """A full path of the last saved archive"""
+
+        return self._archive_name
+
+    @property
+    def timings(self):
+        """Seconds spent on every calculation stage"""
+
+        return {stage: round(seconds, 3) for stage, seconds in self._timings.items()}
+
+    @property
+    def archive_future(self):
+        """A Future of the archive written in the background, None when it's written synchronously"""
+
+        return self._archive_future
+
+    @property
+    def stage(self):
+        """The current calculation stage, '' when nothing is calculated"""
+
+        stage = self._stage
+        return '' if stage is None else stage[0]
+
+    @property
+    def profile(self):
+        """A dict with the collapsed stacks' file and seconds of stages and functions of the last slow execute"""
+
+        return self._profile
+
+    @property
+    def is_cancelled(self):
+        return self._cancel_event is not None and self._cancel_event.is_set()
+
+    def execute(self, new_settings=None, writer=None):
+        """
+        Calculates and saves new prices
+
+        With profile_threshold setting the calculation is profiled, stacks of
+        the ones slower than the threshold are written for flamegraphs.
+
+        Attributes:
+            -writer - archive_writer.ArchiveWriter, the archive is written in the background,
+                archive_future reports when it's written
+        """
+
+        self._profile = None
+        profiler = GoodsPricing._get_profiler(new_settings or self.settings)
+        if profiler is None:
+            return self._execute(new_settings, writer)
+
+        with profiler.record(self.serial_number, stage=lambda: self.stage) as recording:
+            success = self._execute(new_settings, writer)
+        self._save_profile(recording, profiler.modules)
+
+        return success
+
+    def _execute(self, new_settings, writer):
         if not self.recalculate(new_settings=new_settings):
             return False
         if not self.make_pricing():
             return False
-        if not self.save_prices():
+
+        self._report('Saving', 0, 1)
+        if not self.save_prices(writer):
             return False
+        self._report('Done', 1, 1)
 
         return True
 
@@ -278,147 +1139,303 @@ class GoodsPricing:
         if not self.settings:
             return False
 
-        if not self._calculate_ratio_table():
-            return False
-        if not self._calculate_pharmacy_table():
-            return False
-        if not self._calculate_distance_table():
-            return False
-        if not self._set_current_pharmacy_prices():
-            return False
+        stages = (
+            ('Ratios', self._calculate_ratio_table),
+            ('Branches', self._calculate_pharmacy_table),
+            ('Distances', self._calculate_distance_table),
+            ('Pharmacy prices', self._set_current_pharmacy_prices)
+        )
+        for ind, (stage, calculate) in enumerate(stages):
+            self._report(stage, ind, len(stages))
+            if self.is_cancelled or not calculate():
+                return False
+        self._report('Done', 0, 0)
 
         return True
 
     def make_pricing(self):
-        if not self._calculate_pharmacies_prices():
+        self._report('Competitors prices', 0, 0)
+        if self.is_cancelled or not self._calculate_pharmacies_prices():
             return False
-        if not self._set_new_pharmacy_prices():
+        self._report('Goods', 0, 0)
+        if self.is_cancelled or not self._set_new_pharmacy_prices():
             return False
+        self._report('Done', 0, 0)
 
         return True
 
-    def save_prices(self):
+    def save_prices(self, writer=None):
+        """
+        Writes the prices' archive
+
+        Attributes:
+            -writer - archive_writer.ArchiveWriter, the archive is written synchronously when it's None
+        """
+
         prices = self.new_prices
         if prices.empty:
             return False
 
-        save_path = self.settings.get_setting('save_path')
-        if not save_path:
-            save_path = os.getcwd()
-
-        save_path += '\\' + str(self.enterprise_code)
-        if not os.path.exists(save_path):
-            try:
-                os.mkdir(save_path)
-            except OSError:
-                print('Creation of the directory %s failed' % save_path)
-
-        file_name_no_ext = 'rest_' + str(self.serial_number) + '_' + self._min_date.strftime('%Y%m%d%H%M%S')
+        save_path = self._get_save_path()
+        if writer is not None:
+            # The export state of the pharmacy is committed by its previous archive
+            writer.wait(self._archive_key)
+
+        export = price_export.PriceExport(
+            save_path,
+            self.serial_number,
+            self.settings.get_setting('export_mode'),
+            self.settings.get_setting('full_snapshot_every')
+        )
+        # ID_Goods is kept for the history only, the export state and the offers don't have it
+        exported = prices.assign(ID_Branch=self.id_pharmacy)
+        prices = prices.drop(columns='ID_Goods')
+        kind, offers = export.select(prices)
+        self._archive_future = None
+        if offers.empty:
+            # Nothing has changed since the last export
+            self._archive_name = ''
+            self._save_history(exported, price_history.PriceSource.Exported)
+            return True
+
+        prefix = 'rest_' if kind == price_export.ExportMode.Full else 'delta_'
+        file_name_no_ext = prefix + str(self.serial_number) + '_' + self._min_date.strftime('%Y%m%d%H%M%S')
         file_name = file_name_no_ext + '.xml'
         full_path = save_path + '\\' + file_name
-        ext_con.TabletkiParser.df_to_xml(prices, full_path, 'Offer')
-
         archive_name = save_path + '\\' + file_name_no_ext + '.zip'
-        with zipfile.ZipFile(archive_name, 'w', zipfile.ZIP_DEFLATED) as z_file:
-            z_file.write(full_path)
-
-        if os.path.exists(full_path):
-            os.remove(full_path)
+        codec = self.settings.get_setting('archive_codec') or archive_writer.ArchiveCodec.Deflate
+        level = self.settings.get_setting('archive_level')
+        level = None if level == '' else int(level)
+        min_date = self._min_date
+
+        def write():
+            ext_con.TabletkiParser.df_to_xml(offers.reset_index(drop=True), full_path, 'Offer')
+            archive_writer.write_archive(archive_name, full_path, codec, level)
+
+            if os.path.exists(full_path):
+                os.remove(full_path)
+
+            export.commit(kind, file_name_no_ext + '.zip', min_date, prices, offers)
+            # Prices are exported when their archive is written
+            self._save_history(exported, price_history.PriceSource.Exported)
+            return archive_name
+
+        self._archive_name = archive_name
+        if writer is None:
+            write()
+        else:
+            self._archive_future = writer.submit(self._archive_key, write)
 
         return True
 
+    @property
+    def _archive_key(self):
+        """Archives of a pharmacy are written in order, serial numbers of enterprises may repeat"""
+
+        return self.enterprise_code, self.serial_number
+
+    def get_band_competitors(self):
+        """
+        Competitors of the pharmacy's distance bands, prices are not downloaded
+
+        returns a dict {band distance: list of ID_Branch}, empty when the pharmacy is not found
+        """
+
+        for calculate in (self._calculate_ratio_table, self._calculate_pharmacy_table, self._calculate_distance_table):
+            if not calculate():
+                return {}
+
+        return self._get_band_competitors()
+
+    def compare_with_all_competitors(self):
+        """
+        Reports how the competitors' cap (competitors_top_k setting) changes prices
+
+        Prices are calculated again with all competitors of the bands
+        and compared to the current new prices. The pricing's state is restored
+        afterwards, the comparison isn't saved to the history and the leadership.
+
+        returns a dict with goods count, differing prices and fetched competitors, empty when it's not calculated
+        """
+
+        if self.new_prices is None:
+            return {}
+
+        capped_prices = self.new_prices
+        capped_fetched = len(set().union(*self._band_competitors.values()))
+        state = (self._band_competitors, self._competitors_prices, self._price_index, self._failed_competitors)
+
+        self._is_comparison = True
+        try:
+            self._band_competitors = self._get_band_competitors(top_k=0)
+            fetched = self._get_fetched_competitors()
+            all_fetched = len(set(fetched))
+            self._failed_competitors = []
+            try:
+                self._competitors_prices = self._get_pharmacies_prices(pharmacies=fetched)
+            except memory_budget.BudgetExceededError as e:
+                print('Error:', e)
+                return {}
+            if self.is_cancelled or not self._check_failed_competitors(fetched):
+                return {}
+            self._set_price_index(fetched)
+            if not self._set_new_pharmacy_prices():
+                return {}
+            all_prices = self.new_prices
+        finally:
+            self._is_comparison = False
+            self._new_prices = capped_prices
+            self._band_competitors, self._competitors_prices, self._price_index, self._failed_competitors = state
+
+        deltas = (capped_prices['PriceReserve'] - all_prices['PriceReserve']).abs()
+        report = {
+            'goods': int(len(deltas)),
+            'differ': int((deltas > 0.005).sum()),
+            'max_delta': float(deltas.max()) if len(deltas) else 0.,
+            'fetched_capped': capped_fetched,
+            'fetched_all': all_fetched
+        }
+        print('Top K report:', report)
+
+        return report
+
     @staticmethod
     def distances_in_meters(lats, lngs):
-        # approximate radius of Earth in meters
-        radius = 6373000.0
+        """Distances between all the points, a matrix (n, n) of int meters"""
 
-        lats = np.radians(lats)
-        lngs = np.radians(lngs)
+        lats = np.asarray(lats, dtype=float)
+        lngs = np.asarray(lngs, dtype=float)
 
-        lat_matrix_1 = np.array([lats for _ in range(len(lats))])
-        lat_matrix_2 = lat_matrix_1.T
+        return GoodsPricing._haversine(lats[np.newaxis, :], lngs[np.newaxis, :], lats[:, np.newaxis],
+                                       lngs[:, np.newaxis])
 
-        lng_matrix_1 = np.array([lngs for _ in range(len(lngs))])
-        lng_matrix_2 = lng_matrix_1.T
+    @staticmethod
+    def pair_distances_in_meters(lats_1, lngs_1, lats_2, lngs_2):
+        """
+        Distances between points of pairs, only the asked pairs are calculated
 
-        dlat = lat_matrix_2 - lat_matrix_1
-        dlon = lng_matrix_2 - lng_matrix_1
+        Attributes:
+            -lats_1, lngs_1, lats_2, lngs_2 - arrays of the pairs' coordinates
 
-        # Haversine formula
-        a = np.sin(dlat / 2) ** 2 + np.cos(lat_matrix_1) * np.cos(lat_matrix_2) * np.sin(dlon / 2) ** 2
-        c = 2 * np.arctan2(a ** 0.5, (-1 * a + 1) ** 0.5)
+        returns an array of int meters
+        """
 
-        distance = radius * c
-        distance = distance.astype(int)
-
-        return distance
+        return GoodsPricing._haversine(
+            np.asarray(lats_1, dtype=float),
+            np.asarray(lngs_1, dtype=float),
+            np.asarray(lats_2, dtype=float),
+            np.asarray(lngs_2, dtype=float)
+        )
 
     @staticmethod
     def get_distance(lat1, lng1, lat2, lng2):
-        lats = [lat1, lat2]
-        lngs = [lng1, lng2]
-        distances = GoodsPricing.distances_in_meters(lats, lngs)
+        return int(GoodsPricing.pair_distances_in_meters([lat1], [lng1], [lat2], [lng2])[0])
 
-        return distances[0][1]
+    def get_branch_distances(self, pairs):
+        """
+        Distances between branches of pairs
 
-    def _as_code(self, pharm_id):
-        df = self.pharmacy_table
-        row = df[(df['ID_Branch'] == pharm_id)]
-        return '' if row.empty else row['SerialNumber'].iloc[0]
+        The distances table is used when it's calculated, otherwise the pairs are
+        calculated from the branches' coordinates and memoized by the cache.
 
-    def _get_ratio(self, price_range, distance_range):
-        return 0 if not self.settings else self.ratio_table[distance_range][price_range]
+        Attributes:
+            -pairs - list of tuples (ID_Branch, ID_Branch)
 
-    def _get_ratio_matrix(self):
-        settings = self.settings
+        returns a list of int meters, None for a pair with an unknown branch
+        """
 
-        if not settings:
-            return None
+        if self.distance_table is not None:
+            # Branches are looked up case-insensitively like the memoized pairs
+            table = self.distance_table
+            labels = {str(label).upper(): label for label in table.index}
+            distances = []
+            for id_1, id_2 in pairs:
+                label_1, label_2 = labels.get(str(id_1).upper()), labels.get(str(id_2).upper())
+                distances.append(None if label_1 is None or label_2 is None else int(table.at[label_1, label_2]))
+            return distances
 
-        prices = settings.get_setting('prices')
-        distances = settings.get_setting('distances')
-        def_unit = settings.get_setting('default_unit')
-        unit_price = settings.get_setting('default_unit_price')
-        deviation = settings.get_setting('deviation')
+        if self._cache is None:
+            return self._calculate_pair_distances(pairs)
 
-        ratio_matrix = []
+        return self._cache.get_pair_distances(pairs, self._calculate_pair_distances)
 
-        pre_price_value = 0
-        for price_value in prices:
-            price_sum = price_value + pre_price_value
+    def get_branch_distance(self, id_pharmacy_1, id_pharmacy_2):
+        return self.get_branch_distances([(id_pharmacy_1, id_pharmacy_2)])[0]
 
-            pre_dist_value = 0
-            new_list = []
-            for distance_value in distances:
-                if pre_dist_value == 0:
-                    ratio = 1 - deviation
-                else:
-                    dist_sum = distance_value + pre_dist_value
-                    ratio = 1 + (dist_sum * unit_price) / (price_sum * def_unit)
+    def _calculate_pair_distances(self, pairs):
+        pharm_df = self.pharmacy_table
+        if pharm_df is None:
+            return [None] * len(pairs)
+
+        coordinates = pharm_df.assign(ID_Branch=pharm_df['ID_Branch'].astype(str).str.upper())
+        coordinates = coordinates.drop_duplicates('ID_Branch').set_index('ID_Branch')[['Lat', 'Lng']]
+
+        ids_1 = pd.Index([str(id_1).upper() for id_1, _ in pairs])
+        ids_2 = pd.Index([str(id_2).upper() for _, id_2 in pairs])
+        points_1 = coordinates.reindex(ids_1).to_numpy()
+        points_2 = coordinates.reindex(ids_2).to_numpy()
+        is_known = ~(np.isnan(points_1).any(axis=1) | np.isnan(points_2).any(axis=1))
+
+        distances = [None] * len(pairs)
+        if is_known.any():
+            known = GoodsPricing.pair_distances_in_meters(
+                points_1[is_known, 0], points_1[is_known, 1], points_2[is_known, 0], points_2[is_known, 1])
+            for pos, distance in zip(np.flatnonzero(is_known), known):
+                distances[pos] = int(distance)
+
+        return distances
+
+    @staticmethod
+    def _haversine(lats_1, lngs_1, lats_2, lngs_2):
+        # approximate radius of Earth in meters
+        radius = 6373000.0
+
+        lats_1 = np.radians(lats_1)
+        lngs_1 = np.radians(lngs_1)
+        lats_2 = np.radians(lats_2)
+        lngs_2 = np.radians(lngs_2)
 
-                new_list.append(ratio)
-                pre_dist_value = distance_value
+        dlat = lats_2 - lats_1
+        dlon = lngs_2 - lngs_1
 
-            ratio_matrix.append(new_list)
-            pre_price_value = price_value
+        # Haversine formula
+        a = np.sin(dlat / 2) ** 2 + np.cos(lats_1) * np.cos(lats_2) * np.sin(dlon / 2) ** 2
+        c = 2 * np.arctan2(a ** 0.5, (-1 * a + 1) ** 0.5)
+
+        distance = radius * c
+        distance = distance.astype(int)
+
+        return distance
 
-        return ratio_matrix
+    def _as_code(self, pharm_id):
+        df = self.pharmacy_table
+        row = df[(df['ID_Branch'] == pharm_id)]
+        return '' if row.empty else row['SerialNumber'].iloc[0]
+
+    def _get_ratio_matrix(self):
+        if not self.settings:
+            return None
+
+        return repricing.get_ratio_matrix(self.settings)
 
     def _calculate_ratio_table(self):
         if not self.settings:
             self._ratio_table = None
             return False
 
-        matrix = self._get_ratio_matrix()
-        prices = self.settings.get_setting('prices')
-        distances = self.settings.get_setting('distances')
+        def calculate():
+            matrix = self._get_ratio_matrix()
+            prices = self.settings.get_setting('prices')
+            distances = self.settings.get_setting('distances')
+
+            price_index = list(prices)
+            distance_columns = list(distances)
+            arr = np.array(matrix)
 
-        price_index = list(prices)
-        distance_columns = list(distances)
-        arr = np.array(matrix)
+            return pd.DataFrame(arr, index=price_index, columns=distance_columns)
 
-        df = pd.DataFrame(arr, index=price_index, columns=distance_columns)
-        self._ratio_table = df
+        # Ratio tables depend on settings only and are shared by all the calculations
+        self._ratio_table = GoodsPricing._get_shared(GoodsPricing._ratio_tables, self.settings, calculate)
 
         return True
 
@@ -428,6 +1445,20 @@ class GoodsPricing:
             self._distance_table = None
             return False
 
+        if self._cache is None:
+            table = self._load_distance_table()
+        else:
+            url_pharmacies = self.settings.get_setting('branches_api')
+            table = self._cache.get_distance_table(url_pharmacies, self._load_distance_table)
+
+        self._distance_table = table
+        self._branch_index = None
+
+        return True
+
+    def _load_distance_table(self):
+        pharm_df = self.pharmacy_table
+
         branches = pharm_df.ID_Branch.tolist()
         lats = pharm_df.Lat.tolist()
         lngs = pharm_df.Lng.tolist()
@@ -435,21 +1466,41 @@ class GoodsPricing:
         distances = GoodsPricing.distances_in_meters(lats, lngs)
 
         table = pd.DataFrame(distances, index=branches, columns=branches)
-        self._distance_table = table
-
-        return True
+        return table
 
     def _calculate_pharmacy_table(self):
-        settings = self.settings
+        if self._cache is None:
+            df = GoodsPricing.load_pharmacy_table(self.settings)
+        else:
+            url_pharmacies = self.settings.get_setting('branches_api')
+            df = self._cache.get_pharmacy_table(url_pharmacies, lambda: GoodsPricing.load_pharmacy_table(self.settings))
+
+        self._pharmacy_table = df
+        if df is None:
+            return False
+
+        if not self._id_pharmacy:
+            # The pharmacy is set by the enterprise and serial number only
+            row = df[(df['Code'] == self.enterprise_code) & (df['SerialNumber'] == self.serial_number)]
+            self._id_pharmacy = '' if row.empty else str(row['ID_Branch'].iloc[0]).upper()
+
+        return bool(self._id_pharmacy)
+
+    @staticmethod
+    def load_pharmacy_table(settings):
+        """Downloads the branches table"""
+
         url_pharmacies = settings.get_setting('branches_api')
 
-        connection = ext_con.TabletkiAPI()
-        df = connection.execute(url_pharmacies)
-        connection.disconnect()
+        try:
+            with api_connection(settings) as connection:
+                df = connection.execute(url_pharmacies)
+        except ext_con.APIError as e:
+            print('Error:', e)
+            return None
 
         if 'Lat' and 'Lng' and 'ID_Branch' not in df.columns:
-            self._pharmacy_table = None
-            return False
+            return None
 
         # Divider for Latitude and Longitude from ClickHouse
         divider = 100000000.
@@ -460,23 +1511,179 @@ class GoodsPricing:
         df['Code'] = df['Code'].astype(int)
         df['SerialNumber'] = df['SerialNumber'].astype(int)
 
-        self._pharmacy_table = df
-
-        return True
+        return df
 
     def _calculate_pharmacies_prices(self):
         if not self.settings:
             return False
 
-        distance_tuple = self.settings.get_setting('distances')
-        last_dist = distance_tuple[-1]
+        self._band_competitors = self._get_band_competitors()
+
+        fetched = self._get_fetched_competitors()
+        self._failed_competitors = []
+        try:
+            all_prices = self._get_pharmacies_prices(pharmacies=fetched)
+        except memory_budget.BudgetExceededError as e:
+            # Prices without a part of the competitors would be skewed, the pharmacy isn't priced
+            print('Error:', e)
+            return False
+        if not self._check_failed_competitors(fetched):
+            return False
 
-        nearest_competitors = tuple(self._get_nearest_competitors(0, last_dist))
-        all_prices = self._get_pharmacies_prices(pharmacies=nearest_competitors)
         self._competitors_prices = all_prices
+        self._set_price_index(fetched)
+
+        if self.settings.get_setting('competitors_ranking') == 'leadership':
+            self._update_leadership()
+
+        return True
+
+    @property
+    def failed_competitors(self):
+        return list(self._failed_competitors)
+
+    def _check_failed_competitors(self, fetched):
+        """
+        Checks the share of competitors whose prices are not loaded
+
+        New prices are not calculated when it's above max_failed_competitors setting,
+        the minimum prices would be skewed by the missed competitors.
+        """
+
+        if not fetched or not self._failed_competitors:
+            return True
+
+        max_failed = self.settings.get_setting('max_failed_competitors')
+        max_failed = 0.2 if max_failed == '' else max_failed
+        failed_share = len(self._failed_competitors) / len(fetched)
+        if failed_share > max_failed:
+            print('Error: prices of %s of %s competitors are not loaded' % (len(self._failed_competitors), len(fetched)))
+            return False
 
         return True
 
+    def _set_price_index(self, fetched):
+        prices_df = self.competitors_prices
+        if prices_df is None:
+            self._price_index = None
+            return
+
+        if self._cache is None or self._get_memory_limit() or self.is_cancelled or self._failed_competitors:
+            # Prices of a memory budgeted calculation are reduced to its goods and prices of
+            # a cancelled or partly failed fetch are incomplete, such an index isn't shared
+            self._price_index = price_index.MinPriceIndex(prices_df)
+        else:
+            self._price_index = self._cache.get_price_index(fetched, GoodsPricing._concat_prices)
+
+    @property
+    def _top_k(self):
+        return int(self.settings.get_setting('competitors_top_k') or 0)
+
+    def _get_band_competitors(self, top_k=None):
+        """
+        Competitors of every distance band
+
+        With top_k only K competitors of a band are taken: the nearest ones,
+        or the best price leaders when competitors_ranking setting is 'leadership'.
+
+        returns a dict {band distance: list of ID_Branch}
+        """
+
+        if top_k is None:
+            top_k = self._top_k
+
+        leadership = None
+        if top_k and self.settings.get_setting('competitors_ranking') == 'leadership':
+            leadership = self._get_leadership()
+            if not leadership.has_history():
+                leadership = None
+
+        distances = self.distance_table[self.id_pharmacy]
+
+        competitors_dict = {}
+        prev_dist = 0
+        distance_tuple = self.settings.get_setting('distances')
+        for dist in distance_tuple:
+            nearest_competitors = self._get_nearest_competitors(prev_dist, dist)
+            if top_k and len(nearest_competitors) > top_k:
+                nearest_competitors = sorted(nearest_competitors, key=lambda pharm_id: distances[pharm_id])
+                if leadership is not None:
+                    nearest_competitors = leadership.select(nearest_competitors, top_k)
+                else:
+                    nearest_competitors = nearest_competitors[:top_k]
+
+            competitors_dict[dist] = nearest_competitors
+            prev_dist = dist
+
+        return competitors_dict
+
+    def _get_fetched_competitors(self):
+        fetched = []
+        for competitors in self._band_competitors.values():
+            fetched.extend(competitors)
+
+        return tuple(fetched)
+
+    def _get_leadership(self):
+        file_name = self._get_save_path() + '\\leadership_' + str(self.serial_number) + '.json'
+        return competitor_ranking.CompetitorLeadership(file_name)
+
+    def _update_leadership(self):
+        """Counts goods for which every competitor had the lowest price in its band"""
+
+        prices_df = self.competitors_prices
+        if prices_df is None or prices_df.empty or self.pharmacy_prices is None:
+            return
+
+        prices_df = prices_df[prices_df['ID_Goods'].isin(self.pharmacy_prices['ID_Goods'])].reset_index(drop=True)
+
+        leaders = {}
+        for competitors in self._band_competitors.values():
+            band_df = prices_df[prices_df['ID_Branch'].isin(competitors)]
+            if band_df.empty:
+                continue
+
+            winners = band_df.loc[band_df.groupby('ID_Goods')['Price'].idxmin(), 'ID_Branch']
+            for competitor, count in winners.value_counts().items():
+                leaders[competitor] = leaders.get(competitor, 0) + int(count)
+
+        self._get_leadership().update(leaders, self._get_fetched_competitors())
+
+    def get_history(self):
+        """Returns the prices history of the save path, None when price_history setting is off"""
+
+        if not self.settings.get_setting('price_history'):
+            return None
+
+        save_path = self.settings.get_setting('save_path') or os.getcwd()
+        # One history per save path, its deduplication state is shared by the threads
+        return GoodsPricing._get_shared(GoodsPricing._histories, save_path,
+                                        lambda: price_history.PriceHistory(save_path + '\\history'))
+
+    def _save_history(self, prices, source):
+        history = self.get_history()
+        if history is None or self._is_comparison:
+            return
+
+        try:
+            history.append(prices, source)
+        except OSError as e:
+            print('Error:', e)
+
+    def _get_save_path(self):
+        save_path = self.settings.get_setting('save_path')
+        if not save_path:
+            save_path = os.getcwd()
+
+        save_path += '\\' + str(self.enterprise_code)
+        if not os.path.exists(save_path):
+            try:
+                os.mkdir(save_path)
+            except OSError:
+                print('Creation of the directory %s failed' % save_path)
+
+        return save_path
+
     def _set_current_pharmacy_prices(self):
         settings = self.settings
         if not settings:
@@ -495,9 +1702,19 @@ class GoodsPricing:
         method = 'GET'
         content_type = 'json'
 
-        connection = ext_con.TabletkiAPI()
+        try:
+            with api_connection(settings) as connection:
+                result_table = connection.execute(url_prices_by_pharm, method, headers, content_type)
+        except ext_con.APIError as e:
+            print('Error:', e)
+            result_table = None
+
+        columns = ('ID_Goods', 'Price', 'PriceReserve', 'Quantity', 'DateTime')
+        if result_table is None or result_table.empty or not all(col in result_table.columns for col in columns):
+            self._pharmacy_prices = None
+            self._min_date = None
+            return False
 
-        result_table = connection.execute(url_prices_by_pharm, method, headers, content_type)
         result_table['Quantity'] = result_table['Quantity'].str.replace(',', '.')
         result_table['Quantity'] = result_table['Quantity'].astype(float)
         result_table['Price'] = result_table['Price'].str.replace(',', '.')
@@ -505,11 +1722,13 @@ class GoodsPricing:
         result_table['PriceReserve'] = result_table['PriceReserve'].str.replace(',', '.')
         result_table['PriceReserve'] = result_table['PriceReserve'].astype(float)
 
-        connection.disconnect()
-
         self._pharmacy_prices = result_table
         self._min_date = min(result_table['DateTime'])
 
+        # Own prices are one snapshot stamped with the time they were loaded, like competitors' ones
+        self._save_history(result_table.assign(ID_Branch=self.id_pharmacy).drop(columns='DateTime'),
+                           price_history.PriceSource.Own)
+
         return True
 
     def _get_pharmacies_prices(self, pharmacies):
@@ -519,179 +1738,243 @@ class GoodsPricing:
         settings = self.settings
         url_all_prices = settings.get_setting('prices_all_api')
 
-        connection = ext_con.TabletkiAPI()
+        frames = [pd.DataFrame([], columns=GoodsPricing._api_prices_columns)]
 
-        cols = ['govcode', 'govid', 'innercode', 'price', 'priceReserve', 'ID_Branch']
-        data = []
-        res_df = pd.DataFrame(data, columns=cols)
+        # With memory_budget setting prices are processed by chunks reduced to the minimum price index's input,
+        # the reduced prices and the index built from them must fit the calculation's memory
+        limit = self._get_memory_limit()
+        chunk_bytes = limit // 4 if limit else 0
+        chunks = []
+        pending_bytes = 0
+        reduced_bytes = 0
 
         max_len = len(pharmacies)
-        for id_pharmacy in pharmacies:
-            index = pharmacies.index(id_pharmacy)
+        with api_connection(settings) as connection:
+            for index, id_pharmacy in enumerate(pharmacies):
+                if self.is_cancelled:
+                    break
+
+                self._report('Competitors prices', index, max_len)
+
+                code = self._as_code(id_pharmacy)
+                url_all_prices_by_pharm = url_all_prices + '/?sn=' + str(code)
+
+                def load_prices():
+                    branch_df = connection.execute(url_all_prices_by_pharm, 'GET', {}, 'json_detailed')
+                    branch_df['ID_Branch'] = id_pharmacy
+                    # The time of the observation, cached prices keep it
+                    branch_df['DateTime'] = pd.Timestamp.now()
+                    return branch_df
+
+                try:
+                    if self._cache is None or limit:
+                        # A budgeted calculation doesn't keep whole price lists in the shared cache
+                        df = load_prices()
+                    else:
+                        df = self._cache.get_branch_prices(id_pharmacy, load_prices)
+                except ext_con.APIError as e:
+                    # A failed competitor is skipped, its prices are not mixed in as an empty frame
+                    print('Error:', e)
+                    self._failed_competitors.append(id_pharmacy)
+                    continue
+
+                if not df.empty:
+                    frames.append(df)
+                    pending_bytes += memory_budget.get_frame_bytes(df)
+
+                print('Pharmacies: ' + str(index) + ' / ' + str(max_len))
+
+                if chunk_bytes and pending_bytes >= chunk_bytes:
+                    reduced_bytes += self._add_prices_chunk(chunks, frames, limit - reduced_bytes)
+                    frames = frames[:1]
+                    pending_bytes = 0
+
+        if not chunk_bytes:
+            return self._to_prices_frame(frames)
+
+        self._add_prices_chunk(chunks, frames, limit - reduced_bytes)
+        return pd.concat(chunks, ignore_index=True)
+
+    def _to_prices_frame(self, frames):
+        res_df = GoodsPricing._concat_prices(frames)
+        self._save_history(res_df, price_history.PriceSource.Competitor)
+
+        return res_df.drop(columns='DateTime')
 
-            code = self._as_code(id_pharmacy)
-            url_all_prices_by_pharm = url_all_prices + '/?sn=' + str(code)
+    @staticmethod
+    def _concat_prices(frames):
+        """Concatenates competitors' prices of the API and names their columns"""
 
-            df = connection.execute(url_all_prices_by_pharm, 'GET', {}, 'json_detailed')
-            df['ID_Branch'] = id_pharmacy
+        res_df = pd.concat(frames, sort=False).reindex(columns=GoodsPricing._api_prices_columns)
+        res_df.columns = ['GoodsCode', 'ID_Goods', 'InnerCode', 'Price', 'PriceReserve', 'ID_Branch', 'DateTime']
+        res_df['Price'] = res_df['Price'].astype(float)
+        res_df['PriceReserve'] = res_df['PriceReserve'].astype(float)
 
-            res_df = res_df.append(df, sort=False)
+        return res_df
 
-            print('Pharmacies: ' + str(index) + ' / ' + str(max_len))
+    def _add_prices_chunk(self, chunks, frames, limit):
+        """
+        Adds a reduced chunk of prices
 
-        connection.disconnect()
+        returns bytes of the reduced chunk, raises memory_budget.BudgetExceededError
+        when the reduced prices and their index don't fit the rest of the calculation's memory
+        """
 
-        res_df.columns = ['GoodsCode', 'ID_Goods', 'InnerCode', 'Price', 'PriceReserve', 'ID_Branch']
-        res_df['Price'] = res_df['Price'].astype(float)
-        res_df['PriceReserve'] = res_df['PriceReserve'].astype(float)
+        chunk = self._reduce_prices_chunk(frames)
+        chunk_bytes = memory_budget.get_frame_bytes(chunk)
+        # The index takes about as much memory as its input
+        if 2 * chunk_bytes > limit:
+            raise memory_budget.BudgetExceededError(
+                'competitors\' prices of the pharmacy don\'t fit the memory budget of %.1f MB, '
+                'increase memory_budget or decrease max_threads' % (self._get_memory_limit() / 2 ** 20))
 
-        return res_df
+        chunks.append(chunk)
+        return chunk_bytes
 
-    def _set_new_pharmacy_prices(self):
-        if self.pharmacy_prices is None:
-            return False
+    def _reduce_prices_chunk(self, frames):
+        """
+        Minimum prices of every competitor for the pharmacy's goods only, other goods don't change its prices
 
-        goods = self.pharmacy_prices.ID_Goods
-        data = []
+        returns a DataFrame with ID_Goods, ID_Branch, Price columns, the input of the minimum price index
+        """
 
-        competitors_dict = {}
-        prev_dist = 0
-        distance_tuple = self.settings.get_setting('distances')
-        for dist in distance_tuple:
-            nearest_competitors = self._get_nearest_competitors(prev_dist, dist)
-            competitors_dict[dist] = nearest_competitors
-            prev_dist = dist
+        res_df = self._to_prices_frame(frames)
+        if self.pharmacy_prices is not None:
+            res_df = res_df[res_df['ID_Goods'].isin(self.pharmacy_prices['ID_Goods'])]
 
-        max_len = len(goods)
-        ind = 0
-        for _, row in self.pharmacy_prices.iterrows():
-            id_goods = row.ID_Goods
-            inner_code = row.OuterCode
-            name = row.Name
-            producer = row.Producer
-            price = row.Price
-            new_price = row.PriceReserve
-            quantity = row.Quantity
-
-            ind += 1
-
-            if ind % 10 == 0:
-                print('Goods: ' + str(ind) + ' / ' + str(max_len))
-
-            id_goods_no_link = '00000000-0000-0000-0000-000000000000'
-            id_goods_link_not_needed = '50000000-0000-0000-0000-000000000000'
-            if id_goods and id_goods not in (id_goods_no_link, id_goods_link_not_needed):
-                curr_base_price = self._get_current_price(id_goods, 'base')
-                curr_reserve_price = self._get_current_price(id_goods, 'reserve')
-                new_price = self._get_new_price(id_goods, curr_base_price, curr_reserve_price, competitors_dict)
-
-            row = [inner_code, name, producer, price, new_price, quantity]
-            data.append(row)
-
-        df = pd.DataFrame(data, columns=['Code', 'Name', 'Producer', 'Price', 'PriceReserve', 'Quantity'])
-        self._new_prices = df
+        # A competitor's prices are loaded whole into one chunk, so its pairs are unique across chunks
+        res_df = res_df[['ID_Goods', 'ID_Branch', 'Price']].dropna()
+        return res_df.groupby(['ID_Goods', 'ID_Branch'], sort=False)['Price'].min().reset_index()
 
-        return True
+    def _get_memory_limit(self):
+        """Bytes of memory_budget setting per concurrent calculation, 0 without the budget"""
 
-    def _get_price_range(self, price):
-        if not self.settings:
+        budget = self.settings.get_setting('memory_budget')
+        if not budget:
             return 0
 
-        price_ranges = self.settings.get_setting('prices')
-        fit_range = [el for el in price_ranges if el > price]
-        if fit_range:
-            curr_range = fit_range[0]
-        else:
-            curr_range = price_ranges[-1]
+        workers = int(self.settings.get_setting('max_threads') or 1)
+        return int(budget * 2 ** 20 / max(workers, 1))
+
+    def _set_new_pharmacy_prices(self):
+        if self.pharmacy_prices is None:
+            return False
+
+        prices = self.pharmacy_prices
+        self._report('Goods', 0, len(prices))
+        if self.is_cancelled:
+            return False
 
-        return curr_range
+        distances = self.settings.get_setting('distances')
+        index = None if self.competitors_prices is None else self._price_index
+        band_codes = repricing.get_band_codes(index, self._band_competitors, distances)
+        new_prices = self._get_goods_pool().reprice_goods(
+            prices, index, band_codes, self.ratio_table.to_numpy(), self.settings.get_setting('prices'))
+
+        data = {
+            'Code': prices['OuterCode'].to_numpy(),
+            'Name': prices['Name'].to_numpy(),
+            'Producer': prices['Producer'].to_numpy(),
+            'Price': prices['Price'].to_numpy(),
+            'PriceReserve': new_prices,
+            'Quantity': prices['Quantity'].to_numpy(),
+            'ID_Goods': prices['ID_Goods'].to_numpy()
+        }
+        print('Goods: ' + str(len(prices)) + ' / ' + str(len(prices)))
 
-    def _get_new_price(self, id_goods, base_price, reserve_price, competitors_dict=None):
-        if self.competitors_prices is None:
-            return reserve_price
+        df = pd.DataFrame(data, columns=['Code', 'Name', 'Producer', 'Price', 'PriceReserve', 'Quantity', 'ID_Goods'])
+        self._new_prices = df
+
+        return True
 
-        if not base_price:
-            base_price = reserve_price
+    @staticmethod
+    def _get_profiler(settings):
+        """Returns the profiler of profile_interval setting, None when profile_threshold setting is off"""
 
-        price_range = self._get_price_range(reserve_price)
+        if not settings or settings.get_setting('profile_threshold') == '':
+            return None
 
-        prices_df = self.competitors_prices
-        slice_filter_by_goods = (prices_df['ID_Goods'] == id_goods)
-        goods_prices_df = prices_df[slice_filter_by_goods]
+        interval = float(settings.get_setting('profile_interval') or 0.01)
+        return GoodsPricing._get_shared(GoodsPricing._profilers, interval,
+                                        lambda: sampling_profiler.SamplingProfiler(interval))
 
-        new_prices = []
-        distance_tuple = self.settings.get_setting('distances')
-        for dist in distance_tuple:
-            nearest_competitors = competitors_dict[dist]
+    def _save_profile(self, recording, modules):
+        if recording.seconds < float(self.settings.get_setting('profile_threshold')):
+            return
 
-            slice_filter_by_competitors = goods_prices_df['ID_Branch'].isin(nearest_competitors)
-            competitors_prices = goods_prices_df[slice_filter_by_competitors].Price
-            if competitors_prices.empty:
-                min_comp_price = 0
-            else:
-                min_comp_price = min(competitors_prices)
+        save_path = self.settings.get_setting('save_path') or os.getcwd()
+        profile_path = save_path + '\\profiles'
+        file_name = profile_path + '\\{}_{}.folded'.format(
+            self.serial_number, datetime.datetime.now().strftime('%Y%m%d%H%M%S'))
 
-            ratio = self._get_ratio(price_range, dist)
+        try:
+            os.makedirs(profile_path, exist_ok=True)
+            recording.write(file_name)
+        except OSError as e:
+            print('Error:', e)
+            file_name = ''
+
+        self._profile = {
+            'file': file_name,
+            'seconds': round(recording.seconds, 3),
+            'samples': recording.samples,
+            'stages': recording.get_stages(),
+            'functions': recording.get_functions(modules)
+        }
 
-            new_price = round(min_comp_price * ratio, 2)
-            if new_price:
-                new_prices.append(new_price)
+    def _get_goods_pool(self):
+        """Returns the processes' pool of goods_workers setting, pools are shared by all the calculations"""
 
-        if not new_prices:
-            min_new_price = base_price
-        else:
-            min_new_price = min(new_prices)
+        workers = int(self.settings.get_setting('goods_workers') or 1)
+        return GoodsPricing._get_shared(GoodsPricing._goods_pools, workers, lambda: goods_parallel.GoodsPool(workers))
 
-        max_reserve_price = max([reserve_price, min_new_price])
-        final_price = min([base_price, max_reserve_price])
+    @staticmethod
+    def _get_shared(storage, key, create):
+        """Returns a value of a class level storage, it's created once when several threads miss it"""
 
-        return final_price
+        with GoodsPricing._shared_lock:
+            value = storage.get(key)
+            if value is None:
+                value = storage[key] = create()
 
-    def _get_current_price(self, id_goods, price_type='base'):
-        prices = self.pharmacy_prices
-        row = prices[(prices['ID_Goods'] == id_goods)]
-        if row.empty:
-            return 0
+        return value
 
-        if price_type == 'base':
-            if isinstance(row.Price, pd.Series):
-                price = max(row.Price)
-            else:
-                price = row.Price
-        elif price_type == 'reserve':
-            if isinstance(row.PriceReserve, pd.Series):
-                price = max(row.PriceReserve)
-            else:
-                price = row.PriceReserve
-        else:
-            price = 0
+    def _report(self, stage, current, total):
+        now = time.perf_counter()
+        if self._stage is not None:
+            prev_stage, started = self._stage
+            self._timings[prev_stage] = self._timings.get(prev_stage, 0.) + now - started
+        self._stage = None if stage == 'Done' else (stage, now)
 
-        return price
+        if self._progress is not None and stage != 'Done':
+            self._progress(stage, current, total)
 
     def _get_nearest_competitors(self, min_dist, max_dist):
-        pharm_table = self.pharmacy_table
+        index = self._get_branch_index()
+        competitors_mask = index.get_competitors_mask(self.id_pharmacy)
 
-        enterprise_id = self._get_pharmacy_enterprise(self.id_pharmacy)
-        competitors = pharm_table[pharm_table['ID_Enterprise'] != enterprise_id].ID_Branch
+        # Filtering all pharmacies for current one within distance range
+        distances = self.distance_table[self.id_pharmacy].to_numpy()
+        band_mask = (distances >= int(min_dist)) & (distances < int(max_dist))
 
-        dist_table = self.distance_table
+        return index.branches[competitors_mask & band_mask].tolist()
 
-        # Filtering all pharmacies for current one within distance range
-        my_filter = dist_table[self.id_pharmacy].isin(range(int(min_dist), int(max_dist)))
-        nearest_pharmacies = dist_table[my_filter][self.id_pharmacy]
-        nearest_competitors = list(set(nearest_pharmacies.index).intersection(set(competitors)))
+    def _get_branch_index(self):
+        """Branches of the distances table with enterprises' codes, enterprises of an exclusion group share a code"""
 
-        return nearest_competitors
+        if self._branch_index is None:
+            exclusion_groups = branch_index.BranchIndex.parse_groups(self.settings.get_setting('exclusion_groups'))
 
-    def _get_pharmacy_enterprise(self, id_pharmacy):
-        pharm_table = self.pharmacy_table
-        curr_pharm_df = pharm_table[pharm_table['ID_Branch'] == id_pharmacy]
-        if curr_pharm_df.empty:
-            return ''
+            def build():
+                return branch_index.BranchIndex(self.pharmacy_table, self.distance_table.index, exclusion_groups)
 
-        enterprise_id = curr_pharm_df.iloc[0].ID_Enterprise
+            if self._cache is None:
+                self._branch_index = build()
+            else:
+                url_pharmacies = self.settings.get_setting('branches_api')
+                self._branch_index = self._cache.get_branch_index(url_pharmacies, exclusion_groups, build)
 
-        return enterprise_id
+        return self._branch_index
 
     def _distance_between(self, id_pharmacy_1, id_pharmacy_2):
-        return 0 if self.distance_table is None else self.distance_table[id_pharmacy_1][id_pharmacy_2]
+        return self.get_branch_distance(id_pharmacy_1, id_pharmacy_2) or 0
@@ -0,0 +1,143 @@
+"""
+A module for vectorized repricing of goods
+
+New prices of all goods of a pharmacy are calculated with array operations,
+so the live pricing and backtests share one implementation.
+"""
+
+import numpy as np
+
+
+# Goods without a link to the reference book keep their reserve prices
+UNLINKED_GOODS = ('00000000-0000-0000-0000-000000000000', '50000000-0000-0000-0000-000000000000')
+
+
+def get_ratio_matrix(settings):
+    """
+    Ratios of competitors' prices by price range (rows) and distance band (columns)
+
+    returns a list of lists
+    """
+
+    prices = settings.get_setting('prices')
+    distances = settings.get_setting('distances')
+    def_unit = settings.get_setting('default_unit')
+    unit_price = settings.get_setting('default_unit_price')
+    deviation = settings.get_setting('deviation')
+
+    ratio_matrix = []
+
+    pre_price_value = 0
+    for price_value in prices:
+        price_sum = price_value + pre_price_value
+
+        pre_dist_value = 0
+        new_list = []
+        for distance_value in distances:
+            if pre_dist_value == 0:
+                ratio = 1 - deviation
+            else:
+                dist_sum = distance_value + pre_dist_value
+                ratio = 1 + (dist_sum * unit_price) / (price_sum * def_unit)
+
+            new_list.append(ratio)
+            pre_dist_value = distance_value
+
+        ratio_matrix.append(new_list)
+        pre_price_value = price_value
+
+    return ratio_matrix
+
+
+def get_price_ranges(prices, price_bands):
+    """Positions of the price ranges: the first band greater than the price, the last band otherwise"""
+
+    positions = np.searchsorted(np.asarray(price_bands, dtype=float), prices, side='right')
+    return np.minimum(positions, len(price_bands) - 1)
+
+
+def reprice(base_prices, reserve_prices, band_min_prices, ratio_matrix, price_bands):
+    """
+    New prices of goods
+
+    Attributes:
+        -base_prices, reserve_prices - arrays of current prices, a zero base price is the reserve one
+        -band_min_prices - array (goods, distance bands), minimum competitors' prices, 0 when there are none
+        -ratio_matrix - array (price ranges, distance bands)
+        -price_bands - upper bounds of the price ranges
+
+    returns an array of new prices: the cheapest competitor's price with the band's ratio,
+    limited by the reserve price from below and the base price from above
+    """
+
+    reserve_prices = np.asarray(reserve_prices, dtype=float)
+    base_prices = np.asarray(base_prices, dtype=float)
+    base_prices = np.where(base_prices == 0, reserve_prices, base_prices)
+
+    ratios = np.asarray(ratio_matrix, dtype=float)[get_price_ranges(reserve_prices, price_bands)]
+    new_prices = np.round(np.asarray(band_min_prices, dtype=float) * ratios, 2)
+    new_prices = np.where(new_prices != 0, new_prices, np.inf).min(axis=1)
+    new_prices = np.where(np.isinf(new_prices), base_prices, new_prices)
+
+    return np.minimum(base_prices, np.maximum(reserve_prices, new_prices))
+
+
+def reprice_goods(pharmacy_prices, index, band_codes, ratio_matrix, price_bands):
+    """
+    New reserve prices of a pharmacy's price list
+
+    Attributes:
+        -pharmacy_prices - DataFrame with ID_Goods, Price, PriceReserve columns
+        -index - price_index.MinPriceIndex of competitors' prices, None when there are no competitors
+        -band_codes - list of the index's branch codes per distance band
+        -ratio_matrix - array (price ranges, distance bands)
+        -price_bands - upper bounds of the price ranges
+
+    returns an array of new reserve prices in the rows' order
+    """
+
+    new_prices = pharmacy_prices['PriceReserve'].to_numpy(dtype=float).copy()
+
+    is_linked, base_prices, reserve_prices = get_current_prices(pharmacy_prices)
+    if not is_linked.any():
+        return new_prices
+
+    if index is None:
+        new_prices[is_linked] = reserve_prices
+        return new_prices
+
+    linked_goods = pharmacy_prices['ID_Goods'].to_numpy()[is_linked]
+    band_min_prices = np.column_stack([index.get_min_prices(linked_goods, codes) for codes in band_codes])
+    new_prices[is_linked] = reprice(base_prices, reserve_prices, band_min_prices, ratio_matrix, price_bands)
+
+    return new_prices
+
+
+def get_current_prices(pharmacy_prices):
+    """
+    Current prices of goods linked to the reference book
+
+    returns a tuple (is_linked mask of the rows, base prices, reserve prices of the linked rows)
+    """
+
+    goods = pharmacy_prices['ID_Goods']
+    is_linked = (goods.notna() & (goods != '') & ~goods.isin(UNLINKED_GOODS)).to_numpy()
+    if not is_linked.any():
+        return is_linked, np.zeros(0), np.zeros(0)
+
+    # Duplicated goods are priced by their highest current prices
+    grouped = pharmacy_prices.groupby('ID_Goods')
+    base_prices = grouped['Price'].transform('max').to_numpy(dtype=float)[is_linked]
+    reserve_prices = grouped['PriceReserve'].transform('max').to_numpy(dtype=float)[is_linked]
+
+    return is_linked, base_prices, reserve_prices
+
+
+def get_band_codes(index, band_competitors, distances):
+    """Converts competitors of the distance bands to the index's branch codes in the bands' order"""
+
+    if index is None:
+        return []
+
+    return [index.get_branch_codes(band_competitors.get(dist, [])) for dist in distances]
+
@@ -0,0 +1,193 @@
+"""
+A module for sampling profiling of pricing runs
+
+One background thread takes stacks of the recorded threads every interval,
+the recorded code isn't instrumented. Stacks are kept in the collapsed
+format of flamegraph tools: frames from the root separated by ';' and
+the milliseconds, e.g. "Goods;pricing:execute;pricing:make_pricing 120".
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+
+class Recording:
+    """
+    Samples of one thread taken between start and stop of a recording
+
+    Attributes:
+        -label - string, a name of the recording, e.g. a pharmacy's serial number
+        -stage - callable without arguments, returns the current pipeline stage or ''
+    """
+
+    def __init__(self, label, thread_id, stage=None, interval=0.01):
+        self.label = label
+        self.thread_id = thread_id
+        self.stage = stage
+        self.interval = interval
+        self.started = time.perf_counter()
+        self.seconds = 0.
+        self.active = True
+        self.samples = 0
+        self._stacks = Counter()
+
+    @property
+    def stacks(self):
+        """A dict {collapsed stack: seconds}"""
+
+        return dict(self._stacks)
+
+    def add(self, stack, seconds):
+        self.samples += 1
+        self._stacks[stack] += seconds
+
+    def get_stages(self):
+        """Estimated seconds of every pipeline stage"""
+
+        stages = Counter()
+        for stack, seconds in self._stacks.items():
+            stages[stack.split(';', 1)[0]] += seconds
+
+        return {stage: round(seconds, 3) for stage, seconds in stages.most_common()}
+
+    def get_functions(self, modules=None, top=20):
+        """
+        Estimated inclusive seconds of the functions, the slowest first
+
+        Attributes:
+            -modules - names of modules to report, e.g. ('pricing', 'ext_connections'), all by default
+        """
+
+        functions = Counter()
+        for stack, seconds in self._stacks.items():
+            frames = set(stack.split(';')[1:])
+            for frame in frames:
+                if modules is None or frame.split(':', 1)[0] in modules:
+                    functions[frame] += seconds
+
+        return {frame: round(seconds, 3) for frame, seconds in functions.most_common(top)}
+
+    def write(self, file_name):
+        """Writes the collapsed stacks, the file is an input of flamegraph.pl or speedscope"""
+
+        with open(file_name, 'w') as file:
+            for stack, seconds in sorted(self._stacks.items()):
+                file.write('%s %s\n' % (stack, max(int(round(seconds * 1000)), 1)))
+
+        return file_name
+
+
+class SamplingProfiler:
+    """
+    A sampling profiler of threads.
+
+    The sampling thread runs only while there are active recordings, a sample
+    of a thread costs one walk of its stack, so intervals of 5-10 ms don't slow
+    the recorded threads. The sampling thread is late when the recorded ones
+    hold the GIL, so a sample is weighted by the time passed since the previous one.
+    Frames below the outermost frame of the focus modules (thread pools' plumbing) are dropped.
+
+    Usage:
+        profiler = SamplingProfiler(interval=0.01)
+        with profiler.record('pharmacy 15', stage=lambda: pricing.stage) as recording:
+            pricing.execute()
+        recording.write('15.folded')
+    """
+
+    def __init__(self, interval=0.01, modules=('pricing', 'ext_connections')):
+        self._interval = max(float(interval), 0.001)
+        self._modules = tuple(modules)
+        self._lock = threading.Lock()
+        self._recordings = []
+        self._thread = None
+
+    @property
+    def interval(self):
+        return self._interval
+
+    @property
+    def modules(self):
+        return self._modules
+
+    def start(self, label, stage=None):
+        """Starts a recording of the calling thread"""
+
+        recording = Recording(label, threading.get_ident(), stage, self._interval)
+        with self._lock:
+            self._recordings.append(recording)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._sample, name='SamplingProfiler', daemon=True)
+                self._thread.start()
+
+        return recording
+
+    def stop(self, recording):
+        with self._lock:
+            if recording in self._recordings:
+                self._recordings.remove(recording)
+            recording.active = False
+        recording.seconds = time.perf_counter() - recording.started
+
+        return recording
+
+    @contextmanager
+    def record(self, label, stage=None):
+        """A context manager of a recording of the calling thread"""
+
+        recording = self.start(label, stage)
+        try:
+            yield recording
+        finally:
+            self.stop(recording)
+
+    def _sample(self):
+        sampled = time.perf_counter()
+        while True:
+            time.sleep(self._interval)
+            now = time.perf_counter()
+            with self._lock:
+                recordings = list(self._recordings)
+                if not recordings:
+                    self._thread = None
+                    return
+
+            frames = sys._current_frames()
+            for recording in recordings:
+                frame = frames.get(recording.thread_id)
+                if frame is None or not recording.active:
+                    continue
+
+                stage = ''
+                if recording.stage is not None:
+                    try:
+                        stage = recording.stage() or ''
+                    except Exception:
+                        stage = ''
+                seconds = now - max(sampled, recording.started)
+                recording.add(self._collapse(frame, stage or 'Other'), seconds)
+
+            sampled = now
+            del frames
+
+    def _collapse(self, frame, stage):
+        names = []
+        focus = None
+        while frame is not None:
+            code = frame.f_code
+            module = os.path.splitext(os.path.basename(code.co_filename))[0]
+            if module in self._modules:
+                focus = len(names)
+            names.append(module + ':' + code.co_name)
+            frame = frame.f_back
+
+        if focus is not None:
+            names = names[:focus + 1]
+        names.append(stage)
+        names.reverse()
+
+        return ';'.join(name.replace(';', ',').replace(' ', '_') for name in names)
+
@@ -0,0 +1,82 @@
+"""
+A module for schedule runs' checkpoints
+"""
+
+import os
+import json
+
+
+class ScheduleCheckpoint:
+    """
+    A class persists the progress of a schedule run.
+
+    Every finished task is stored by its branch and task timestamp together
+    with the produced archive and the acknowledgement flag, so a restarted run
+    skips tasks that are already priced and only acknowledges them.
+    """
+
+    def __init__(self, file_name):
+        self._file_name = file_name
+        self._tasks = {}
+        self._load()
+
+    @property
+    def file_name(self):
+        return self._file_name
+
+    @staticmethod
+    def task_key(pharm_id, task_date):
+        return str(pharm_id).upper() + '|' + str(task_date)
+
+    def is_done(self, pharm_id, task_date):
+        """Checks whether the task is priced and its archive still exists"""
+
+        task = self._tasks.get(self.task_key(pharm_id, task_date))
+        if task is None:
+            return False
+
+        archive = task.get('archive', '')
+        return not archive or os.path.exists(archive)
+
+    def is_acknowledged(self, pharm_id, task_date):
+        task = self._tasks.get(self.task_key(pharm_id, task_date))
+        return task is not None and task.get('acknowledged', False)
+
+    def set_done(self, pharm_id, task_date, archive):
+        self._tasks[self.task_key(pharm_id, task_date)] = {
+            'ID_Branch': pharm_id,
+            'archive': archive,
+            'acknowledged': False
+        }
+        self.save()
+
+    def set_acknowledged(self, pharm_ids):
+        pharm_ids = {str(pharm_id).upper() for pharm_id in pharm_ids}
+        for task in self._tasks.values():
+            if str(task['ID_Branch']).upper() in pharm_ids:
+                task['acknowledged'] = True
+        self.save()
+
+    def keep_only(self, task_keys):
+        """Forgets tasks which are not in the current schedule anymore"""
+
+        task_keys = set(task_keys)
+        self._tasks = {key: task for key, task in self._tasks.items() if key in task_keys}
+        self.save()
+
+    def save(self):
+        temp_name = self.file_name + '.tmp'
+        with open(temp_name, 'w') as file:
+            json.dump({'tasks': self._tasks}, file, indent=2)
+        os.replace(temp_name, self.file_name)
+
+    def _load(self):
+        if not os.path.exists(self.file_name):
+            return
+
+        try:
+            with open(self.file_name, 'r') as file:
+                self._tasks = json.load(file).get('tasks', {})
+        except (OSError, ValueError) as e:
+            print('Error:', e)
+            self._tasks = {}
@@ -0,0 +1,172 @@
+"""
+A module for selections' coverage calculation
+
+Segment membership of every (country, article) is kept as a bit mask of use cases,
+scraped coverage as index arrays of (country, article) keys and competitors,
+so counts are calculated with array operations without a long-format frame
+of (country, article, use case) rows.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class CoverageMatrix:
+    """
+    A class calculates selections' coverage counts.
+
+    Attributes:
+        -segments - DataFrame, country, article_id and 0/1 use cases' columns
+        -percentiles - dict {prefix: DataFrame}, top articles with in_last column
+        -tiers - DataFrame, country and competitor of the chosen tiers
+        -competitors - DataFrame, scraped country, article_id, competitor, vendor;
+            None when the coverage is aggregated on the server side
+    """
+
+    _max_use_cases = 64
+
+    def __init__(self, segments, percentiles, tiers, competitors=None):
+        self._use_cases = []
+        self._keys = None
+        self._masks = None
+        self._scraped = None
+
+        self._set_membership(segments, percentiles)
+        if competitors is not None:
+            self._set_scraped(tiers, competitors)
+
+    @property
+    def use_cases(self):
+        return list(self._use_cases)
+
+    def get_segments(self):
+        """
+        Unique segment keys with use cases' masks
+
+        returns a DataFrame with country, article_id, mask columns,
+        a bit N of the mask is set when the article is in the use case N
+        """
+
+        segments = self._keys.copy()
+        segments['mask'] = self._masks.view(np.int64)
+        return segments
+
+    def table1(self):
+        """Target SKUs by country and use case"""
+
+        countries, country_idx = np.unique(self._keys['country'].to_numpy(), return_inverse=True)
+        table = self._count_bits(country_idx, self._masks, len(countries), countries)
+        table.index.name = 'country'
+        table['deduped_skus'] = np.bincount(country_idx, weights=self._masks != 0,
+                                            minlength=len(countries)).astype(int)
+        return table
+
+    def table2(self):
+        """Assumed URLs by competitor and use case, articles are deduplicated across countries"""
+
+        table = self._count_unique_articles('competitor')
+        table = table.rename(columns={'deduped': 'deduped_assumed_urls'})
+        return table
+
+    def table3(self):
+        """Assumed URLs by vendor and use case, articles are deduplicated across countries"""
+
+        table = self._count_unique_articles('vendor')
+        table = table.rename(columns={'deduped': 'deduped_sum'})
+        return table
+
+    def coverage(self):
+        """
+        Scraped coverage counts per country, competitor and use case
+
+        returns a DataFrame with country, competitor, use_case, articles columns
+        """
+
+        scraped = self._scraped
+        groups = scraped[['country', 'competitor']]
+        group_codes, group_values = pd.MultiIndex.from_frame(groups).factorize()
+        table = self._count_bits(group_codes, self._masks[scraped['key'].to_numpy()], len(group_values))
+        table.index = pd.MultiIndex.from_tuples(list(group_values), names=['country', 'competitor'])
+
+        long_table = table.stack().rename('articles').reset_index()
+        long_table = long_table.rename(columns={long_table.columns[2]: 'use_case'})
+        return long_table[long_table['articles'] > 0].reset_index(drop=True)
+
+    def _set_membership(self, segments, percentiles):
+        id_vars = ['country', 'article_id']
+        segment_columns = [col for col in segments.columns if col not in id_vars]
+
+        frames = []
+        for col in segment_columns:
+            frames.append((col, segments.loc[segments[col] == 1, id_vars]))
+        for prefix, df in percentiles.items():
+            frames.append((prefix + ' Last Month', df.loc[df['in_last'] == 1, id_vars]))
+            frames.append((prefix + ' TTM', df.loc[df['in_last'].isin([0, 1]), id_vars]))
+
+        if len(frames) > self._max_use_cases:
+            raise ValueError('Too many use cases: %s' % len(frames))
+
+        # Keys are merged use case by use case, no (article, use case) rows are kept at once
+        key_index = pd.MultiIndex.from_arrays([np.array([], dtype=object), np.array([], dtype=np.int64)],
+                                              names=id_vars)
+        for _, df in frames:
+            key_index = key_index.union(pd.MultiIndex.from_frame(self._normalize(df)).unique(), sort=False)
+        key_index = key_index.sort_values()
+        self._keys = key_index.to_frame(index=False)
+
+        masks = np.zeros(len(self._keys), dtype=np.uint64)
+        for bit, (use_case, df) in enumerate(frames):
+            positions = key_index.get_indexer(pd.MultiIndex.from_frame(self._normalize(df)))
+            masks[positions] |= np.uint64(1) << np.uint64(bit)
+            self._use_cases.append(use_case)
+
+        self._masks = masks
+
+    def _set_scraped(self, tiers, competitors):
+        pairs = tiers[['country', 'competitor']].drop_duplicates()
+        scraped = competitors[['country', 'article_id', 'competitor', 'vendor']]
+        scraped = scraped.merge(pairs, on=['country', 'competitor'])
+        scraped = scraped.drop_duplicates(subset=['country', 'article_id', 'competitor'])
+
+        key_index = pd.MultiIndex.from_frame(self._keys)
+        keys = key_index.get_indexer(pd.MultiIndex.from_frame(self._normalize(scraped[['country', 'article_id']])))
+
+        scraped = scraped.assign(key=keys)
+        self._scraped = scraped[scraped['key'] >= 0].reset_index(drop=True)
+
+    def _count_unique_articles(self, group_column):
+        scraped = self._scraped
+        scraped = scraped[scraped[group_column].notna()]
+        group_codes, group_values = pd.factorize(scraped[group_column], sort=True)
+        article_codes, article_values = pd.factorize(self._keys['article_id'].to_numpy()[scraped['key'].to_numpy()])
+
+        # One mask per (group, article) pair: countries of an article are merged
+        pair_codes = group_codes.astype(np.int64) * len(article_values) + article_codes
+        unique_pairs, pair_idx = np.unique(pair_codes, return_inverse=True)
+        pair_masks = np.zeros(len(unique_pairs), dtype=np.uint64)
+        np.bitwise_or.at(pair_masks, pair_idx, self._masks[scraped['key'].to_numpy()])
+
+        pair_groups = unique_pairs // len(article_values)
+        table = self._count_bits(pair_groups, pair_masks, len(group_values), group_values)
+        table.index.name = group_column
+        table['deduped'] = np.bincount(pair_groups, minlength=len(group_values)).astype(int)
+        return table
+
+    def _count_bits(self, group_idx, masks, groups_count, index=None):
+        data = {}
+        for bit, use_case in enumerate(self._use_cases):
+            is_set = (masks >> np.uint64(bit)) & np.uint64(1)
+            data[use_case] = np.bincount(group_idx, weights=is_set, minlength=groups_count).astype(int)
+
+        table = pd.DataFrame(data, index=index)
+        table = table[sorted(table.columns)]
+        table.columns.name = 'use_case'
+        return table
+
+    @staticmethod
+    def _normalize(df):
+        df = df[['country', 'article_id']]
+        return pd.DataFrame({
+            'country': df['country'].astype(str).to_numpy(),
+            'article_id': pd.to_numeric(df['article_id']).astype(np.int64).to_numpy()
+        })
@@ -0,0 +1,704 @@
+"""
+A module for flash selections' update
+
+The pipeline of flash_update_selections notebook: top articles, segmented sales,
+competitors' scrape coverage and tiers are downloaded from ClickHouse once per
+date partition and cached locally, the derived tables are recalculated only
+when their inputs change.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import pandas as pd
+import selection_coverage
+import coverage_pushdown
+
+
+DEFAULT_CATEGORIES = (
+    'Brake Discs', 'Shock Absorbers Components', 'Lubrication Products', 'Engine Oil Products', 'Oil Additives'
+)
+
+DEFAULT_GENERIC_IDS = (
+    1862, 479, 3096, 259, 391, 3902, 3437, 50, 1256, 429, 542, 4921, 189, 307,
+    100215, 2905, 3859, 190, 3675, 3436, 560, 198, 443, 1263, 3901, 7413, 395,
+    1191, 637, 262, 2021, 4172, 324, 937, 3175, 567, 607, 1387, 1431, 3702,
+    3884, 261
+)
+
+DEFAULT_COUNTRIES = ('DE', 'FR', 'ES', 'IT', 'GB', 'SE', 'AT', 'BE', 'NL', 'CH')
+
+
+SQL_TOP_30 = """
+WITH
+
+-- Parameters
+toDate('{ref_date}') AS ref_date
+, toLastDayOfMonth(ref_date) AS curr_month
+, toWeek(ref_date) - 1 AS curr_week
+, {max_days} AS max_days
+, {tiers} AS curr_tiers
+
+-- Top 30% articles
+, top_articles AS (
+    SELECT
+        country
+        , article_id
+        , if(max(end_date) = curr_month, 1, 0) AS in_last
+    FROM core.top_revenue_article AS ta
+    ARRAY JOIN arrayDistinct(arrayConcat(criteria1_country_code, criteria2_country_code)) AS country
+    WHERE end_date BETWEEN toLastDayOfMonth(dateAdd(MONTH, -11, curr_month)) AND curr_month
+    GROUP BY country, article_id
+)
+
+-- Competitors tiers
+, comp_tiers AS (
+    SELECT DISTINCT
+        country_code AS country
+        , competitor
+        , tier
+    FROM default.competitor_tier AS ct
+    WHERE tier IN curr_tiers
+)
+
+-- Potential signals
+, potential_signals AS (
+    SELECT
+        country
+        , article_id
+        , competitor
+        , tier
+        , in_last
+    FROM top_articles AS ta
+    LEFT JOIN comp_tiers AS ct
+    ON ta.country = ct.country
+)
+
+-- Competitors data
+, comp_signals AS (
+    SELECT
+        country_code AS country
+        , article_id
+        , company_name AS competitor
+        , argMax(vendor, update_date) AS vendor
+        , if(toWeek(min(partition_date)) < curr_week, 1, 0) AS is_old
+        , if(toWeek(max(partition_date)) = curr_week, 1, 0) AS in_new
+        , if(count(DISTINCT partition_date) > max_days / 7, 'daily', 'weekly') AS frequency
+    FROM core_base.competitor_price_log AS cp
+    INNER JOIN potential_signals AS ps
+    ON cp.country_code = ps.country
+        AND cp.article_id = ps.article_id
+        AND cp.company_name = ps.competitor
+    PREWHERE toYear(partition_date) = toYear(ref_date)
+        AND toWeek(partition_date) <= curr_week
+        AND competitor_tier IN curr_tiers
+    GROUP BY country, article_id, competitor
+)
+
+-- Potential and competitors signals
+, full_signals AS (
+    SELECT
+        country
+        , toString(article_id) AS article_id
+        , competitor
+        , tier
+        , in_last
+        , if(cs.article_id > 0, 1, 0) AS is_scrapped
+        , is_old
+        , in_new
+        , frequency
+        , vendor
+    FROM potential_signals AS ps
+    GLOBAL LEFT JOIN comp_signals AS cs
+    ON ps.country = cs.country
+        AND ps.article_id = cs.article_id
+        AND ps.competitor = cs.competitor
+)
+
+-- Main
+SELECT *, concat(country, article_id, competitor) AS key
+FROM full_signals
+
+FORMAT TabSeparatedWithNamesAndTypes
+"""
+
+SQL_TOP_50 = """
+WITH
+
+-- Parameters
+toDate('{ref_date}') AS ref_date
+, toYear(ref_date) AS curr_year
+, toMonth(ref_date) - 1 AS curr_month
+, toWeek(ref_date) AS curr_week
+, {max_days} AS max_days
+, {tiers} AS curr_tiers
+
+-- Top 50% articles
+, top_articles AS (
+    SELECT
+        country_code as country
+        , article_id
+        , if(max(for_valid_month) = curr_month, 1, 0) AS in_last
+    FROM dev_analytics_pdc.top_selection_50 AS ta
+    WHERE for_valid_month <= curr_month
+    GROUP BY country, article_id
+)
+
+-- Competitors tiers
+, comp_tiers AS (
+    SELECT DISTINCT
+        country_code AS country
+        , competitor
+        , tier
+    FROM default.competitor_tier AS ct
+    WHERE tier IN curr_tiers
+)
+
+-- Potential signals
+, potential_signals AS (
+    SELECT
+        country
+        , article_id
+        , competitor
+        , tier
+        , in_last
+    FROM top_articles AS ta
+    LEFT JOIN comp_tiers AS ct
+    ON ta.country = ct.country
+)
+
+-- Competitors data
+, comp_signals AS (
+    SELECT
+        country_code AS country
+        , article_id
+        , company_name AS competitor
+        , argMax(vendor, update_date) AS vendor
+        , if(toWeek(min(partition_date)) < curr_week - 1, 1, 0) AS is_old
+        , if(toWeek(max(partition_date)) = curr_week - 1, 1, 0) AS in_new
+        , if(count(DISTINCT partition_date) > max_days / 7, 'daily', 'weekly') AS frequency
+    FROM core_base.competitor_price_log AS cp
+    INNER JOIN potential_signals AS ps
+    ON cp.country_code = ps.country
+        AND cp.article_id = ps.article_id
+        AND cp.company_name = ps.competitor
+    PREWHERE toYear(partition_date) = curr_year
+        AND toWeek(partition_date) < curr_week
+        AND competitor_tier IN curr_tiers
+    GROUP BY country, article_id, competitor
+)
+
+-- Potential and competitors signals
+, full_signals AS (
+    SELECT
+        country
+        , toString(article_id) AS article_id
+        , competitor
+        , tier
+        , in_last
+        , if(cs.article_id > 0, 1, 0) AS is_scrapped
+        , is_old
+        , in_new
+        , frequency
+        , vendor
+    FROM potential_signals AS ps
+    GLOBAL LEFT JOIN comp_signals AS cs
+    ON ps.country = cs.country
+        AND ps.article_id = cs.article_id
+        AND ps.competitor = cs.competitor
+)
+
+-- Main
+SELECT *, concat(country, article_id, competitor) AS key
+FROM full_signals
+
+FORMAT TabSeparatedWithNamesAndTypes
+"""
+
+SQL_SEGMENTS = """
+WITH
+    toDate('{ref_date}') AS ref_date,
+    {categories} AS strategic_categories_list,
+    {generic_ids} AS specific_generic_ids_list,
+
+base_sales AS (
+    SELECT
+        multiIf(upper(origin) IN ('BF', 'BN'), 'BE', upper(origin) IN ('LF', 'LD'), 'LU', upper(origin) IN ('LR'), 'LV', upper(origin) IN ('EN'), 'GB', upper(origin) IN ('CF'), 'CH', upper(origin) IN ('DG'), 'DE', upper(origin)) AS country,
+        article_id,
+        dictGet('default.tecdoc_article_src', 'generic_id', toUInt64(article_id)) AS generic_id,
+        dictGetOrDefault('default.category_tree_reporting', 'subcategory', toUInt64(generic_id), 'W/O Category') AS subcategory,
+        dictGetOrDefault('default.category_tree_reporting', 'main_category', toUInt64(generic_id), 'W/O Category') AS category,
+        order_or_refund_created_date_berlin AS sale_date,
+        money_total_product_navision AS revenue
+    FROM analytics.product_sales_2
+    WHERE
+        sale_date >= date_sub(MONTH, 3, ref_date) AND sale_date < date_add(MONTH, 1, ref_date)
+        AND operation = 'sales'
+        AND country IN {countries}
+        AND money_total_product_navision > 0
+),
+category_asp AS (
+    SELECT category, sum(revenue) / count() AS asp FROM base_sales GROUP BY category
+),
+top_5_asp_categories AS (
+    SELECT category FROM category_asp ORDER BY asp DESC LIMIT 5
+),
+article_aggregated_flags AS (
+    SELECT
+        country, article_id, any(generic_id) AS generic_id, any(category) AS category,any(subcategory) AS subcategory,
+        max(if(sale_date >= ref_date, 1, 0)) AS had_sales_t1m,
+        max(if(sale_date >= date_sub(MONTH, 2, ref_date), 1, 0)) AS had_sales_t3m,
+        1 AS had_sales_t4m
+    FROM base_sales GROUP BY country, article_id
+)
+
+SELECT
+    agg.country, agg.article_id,
+    if(agg.category IN (SELECT category FROM top_5_asp_categories) AND agg.had_sales_t1m = 1, 1, 0) AS top_5_asp_cat_t1m,
+    if(agg.category IN (SELECT category FROM top_5_asp_categories) AND agg.had_sales_t3m = 1, 1, 0) AS top_5_asp_cat_t3m,
+    agg.had_sales_t1m AS has_sales_t1m,
+    agg.had_sales_t3m AS has_sales_t3m,
+    agg.had_sales_t4m AS has_sales_t4m,
+    if(agg.subcategory IN strategic_categories_list AND agg.had_sales_t1m = 1, 1, 0) AS strategic_cat_t1m,
+    if(agg.subcategory IN strategic_categories_list AND agg.had_sales_t3m = 1, 1, 0) AS strategic_cat_t3m,
+    if(agg.generic_id IN specific_generic_ids_list AND agg.had_sales_t3m = 1, 1, 0) AS specific_generic_ids_t3m
+FROM article_aggregated_flags AS agg
+FORMAT TabSeparatedWithNamesAndTypes
+"""
+
+SQL_COMPETITORS = """
+WITH
+    toDate('{ref_date}') AS ref_date
+    , toWeek(ref_date) AS curr_week
+    , {tiers} AS curr_tiers
+
+SELECT
+    country_code AS country
+    , article_id
+    , company_name AS competitor
+    , argMax(vendor, update_date) AS vendor
+    , 1 as is_scraped
+FROM core_base.competitor_price_log AS cp
+PREWHERE toYear(partition_date) = toYear(ref_date)
+    AND toWeek(partition_date) <= curr_week
+    AND competitor_tier IN curr_tiers
+GROUP BY country, article_id, competitor, is_scraped
+
+FORMAT TabSeparatedWithNamesAndTypes
+"""
+
+SQL_TIERS = """
+WITH
+    {tiers} AS curr_tiers
+
+SELECT DISTINCT
+    country_code AS country
+    , competitor
+    , tier
+FROM default.competitor_tier AS ct
+WHERE tier IN curr_tiers
+
+FORMAT TabSeparatedWithNamesAndTypes
+"""
+
+
+def get_clickhouse_df(sql, database):
+    """The notebook's ClickHouse loader from the shared utils"""
+
+    from autodoc_connection import get_clickhouse_df as get_df
+    return get_df(sql, database)
+
+
+def get_fingerprint(*parts):
+    text = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:32]
+
+
+class QueryCache:
+    """
+    A class keeps DataFrames on a local disk.
+
+    Every frame is stored under a date partition by a fingerprint
+    of the SQL text and its parameters. A new partition makes old ones stale,
+    only the latest keep_partitions partitions are kept.
+    """
+
+    def __init__(self, cache_dir, keep_partitions=4):
+        self._cache_dir = cache_dir
+        self._keep_partitions = keep_partitions
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    @property
+    def cache_dir(self):
+        return self._cache_dir
+
+    def get(self, partition, key):
+        file_name = self._file_name(partition, key)
+        if not os.path.exists(file_name):
+            return None
+
+        try:
+            return pd.read_pickle(file_name)
+        except (OSError, ValueError) as e:
+            print('Error:', e)
+            return None
+
+    def put(self, partition, key, df):
+        partition_dir = os.path.join(self.cache_dir, partition)
+        is_new = not os.path.exists(partition_dir)
+        os.makedirs(partition_dir, exist_ok=True)
+
+        file_name = self._file_name(partition, key)
+        df.to_pickle(file_name + '.tmp')
+        os.replace(file_name + '.tmp', file_name)
+
+        if is_new:
+            self._drop_old_partitions(partition)
+
+    def invalidate(self, partition):
+        partition_dir = os.path.join(self.cache_dir, partition)
+        if os.path.exists(partition_dir):
+            shutil.rmtree(partition_dir)
+
+    def _file_name(self, partition, key):
+        return os.path.join(self.cache_dir, partition, key + '.pkl')
+
+    def _drop_old_partitions(self, current):
+        """Keeps the current partition and the latest of the others, keep_partitions in total"""
+
+        partitions = sorted(name for name in os.listdir(self.cache_dir)
+                            if name != current and os.path.isdir(os.path.join(self.cache_dir, name)))
+        dropped = max(len(partitions) - max(self._keep_partitions - 1, 0), 0)
+        for partition in partitions[:dropped]:
+            self.invalidate(partition)
+
+
+class SelectionPipeline:
+    """
+    A class implements flash selections' update.
+
+    Query steps download data from ClickHouse, derived steps transform it.
+    Every step has a fingerprint: of its SQL and parameters for queries,
+    of its name and inputs' fingerprints for derived steps. Results are cached
+    by fingerprints in the reference date's partition, so a step is recalculated
+    only when its inputs change.
+    """
+
+    _queries = {
+        'top_30': (SQL_TOP_30, 'mDWH'),
+        'top_50': (SQL_TOP_50, 'mDWH'),
+        'segments': (SQL_SEGMENTS, 'bsn'),
+        'competitors': (SQL_COMPETITORS, 'mDWH'),
+        'tiers': (SQL_TIERS, 'mDWH')
+    }
+
+    _inputs = {
+        'long_segments': ('segments', 'top_30', 'top_50'),
+        'master_grid': ('long_segments', 'tiers', 'competitors'),
+        'table1': ('long_segments',),
+        'table2': ('master_grid',),
+        'table3': ('master_grid',),
+        'matrix_table1': ('segments', 'top_30', 'top_50', 'tiers', 'competitors'),
+        'matrix_table2': ('segments', 'top_30', 'top_50', 'tiers', 'competitors'),
+        'matrix_table3': ('segments', 'top_30', 'top_50', 'tiers', 'competitors'),
+        'coverage': ('segments', 'top_30', 'top_50', 'tiers', 'competitors'),
+        'pushdown_table1': ('segments', 'top_30', 'top_50', 'tiers'),
+        'pushdown_table2': ('segments', 'top_30', 'top_50', 'tiers'),
+        'pushdown_table3': ('segments', 'top_30', 'top_50', 'tiers'),
+        'pushdown_coverage': ('segments', 'top_30', 'top_50', 'tiers')
+    }
+
+    def __init__(self, ref_date, tiers=(1,), categories=DEFAULT_CATEGORIES, generic_ids=DEFAULT_GENERIC_IDS,
+                 countries=DEFAULT_COUNTRIES, max_days=30, cache_dir='selections_cache', query_func=None,
+                 engine='matrix', pushdown_backend=None):
+        """
+        Attributes:
+            -ref_date - string 'YYYY-MM-DD', a reference date of the selection
+            -tiers - tuple, competitors' tiers
+            -categories - tuple, strategic subcategories
+            -generic_ids - tuple, specific generic ids
+            -countries - tuple, countries of sales
+            -query_func - callable(sql, database), returns DataFrame, get_clickhouse_df by default
+            -engine - string, 'matrix' for CoverageMatrix tables, 'long' for the notebook's melt and merge,
+                'pushdown' for coverage aggregated by pushdown_backend without downloading competitors
+            -pushdown_backend - coverage_pushdown.ClickHouseBackend or SQLiteBackend
+        """
+
+        self._ref_date = str(ref_date)
+        self._tiers = tuple(tiers)
+        self._categories = tuple(categories)
+        self._generic_ids = tuple(generic_ids)
+        self._countries = tuple(countries)
+        self._max_days = max_days
+        self._cache = QueryCache(cache_dir)
+        self._query_func = get_clickhouse_df if query_func is None else query_func
+        self._engine = engine
+        self._pushdown_backend = pushdown_backend
+        if engine == 'pushdown' and pushdown_backend is None:
+            raise ValueError('Pushdown engine needs a backend')
+        self._frames = {}
+        self._fingerprints = {}
+        self._coverage_matrix = None
+
+    @property
+    def ref_date(self):
+        return self._ref_date
+
+    @property
+    def cache(self):
+        return self._cache
+
+    @property
+    def parameters(self):
+        return {
+            'ref_date': self._ref_date,
+            'tiers': self._as_sql_tuple(self._tiers),
+            'categories': self._as_sql_list(self._categories),
+            'generic_ids': self._as_sql_list(self._generic_ids),
+            'countries': self._as_sql_tuple(self._countries),
+            'max_days': self._max_days
+        }
+
+    def top_30(self):
+        """Top 30% articles' signals"""
+
+        return self._query('top_30', *self._queries['top_30'], prepare=self._with_int_articles)
+
+    def top_50(self):
+        """Top 50% articles' signals"""
+
+        return self._query('top_50', *self._queries['top_50'], prepare=self._with_int_articles)
+
+    def segments(self):
+        """Segmented sales: use cases' flags per (country, article_id)"""
+
+        return self._query('segments', *self._queries['segments'])
+
+    def competitors(self):
+        """Scraped (country, article_id, competitor) with a vendor"""
+
+        return self._query('competitors', *self._queries['competitors'])
+
+    def tiers(self):
+        """Competitors of the tiers per country"""
+
+        return self._query('tiers', *self._queries['tiers'])
+
+    def long_segments(self):
+        """All use cases in a long format: country, article_id, use_case"""
+
+        return self._derive('long_segments', self._inputs['long_segments'], self._get_long_segments)
+
+    def master_grid(self):
+        return self._derive('master_grid', self._inputs['master_grid'], self._get_master_grid)
+
+    def coverage(self):
+        """Scraped articles per country, competitor and use case"""
+
+        if self._engine == 'pushdown':
+            return self._derive('pushdown_coverage', self._inputs['pushdown_coverage'],
+                                lambda *frames: self._get_pushdown(*frames).coverage())
+
+        return self._derive('coverage', self._inputs['coverage'],
+                            lambda *frames: self._get_coverage_matrix(*frames).coverage())
+
+    def table1(self):
+        """Target SKUs by country and use case"""
+
+        if self._engine == 'matrix':
+            return self._derive('matrix_table1', self._inputs['matrix_table1'],
+                                lambda *frames: self._get_coverage_matrix(*frames).table1())
+        if self._engine == 'pushdown':
+            # Target SKUs do not depend on competitors
+            return self._derive('pushdown_table1', self._inputs['pushdown_table1'],
+                                lambda *frames: self._get_coverage_matrix(*frames).table1())
+
+        return self._derive('table1', self._inputs['table1'], self._get_table1)
+
+    def table2(self):
+        """Assumed URLs by competitor and use case"""
+
+        if self._engine == 'matrix':
+            return self._derive('matrix_table2', self._inputs['matrix_table2'],
+                                lambda *frames: self._get_coverage_matrix(*frames).table2())
+        if self._engine == 'pushdown':
+            return self._derive('pushdown_table2', self._inputs['pushdown_table2'],
+                                lambda *frames: self._get_pushdown(*frames).table2())
+
+        return self._derive('table2', self._inputs['table2'], lambda grid: self._get_scraped_pivot(
+            grid, 'competitor', 'deduped_assumed_urls'))
+
+    def table3(self):
+        """Assumed URLs by vendor and use case"""
+
+        if self._engine == 'matrix':
+            return self._derive('matrix_table3', self._inputs['matrix_table3'],
+                                lambda *frames: self._get_coverage_matrix(*frames).table3())
+        if self._engine == 'pushdown':
+            return self._derive('pushdown_table3', self._inputs['pushdown_table3'],
+                                lambda *frames: self._get_pushdown(*frames).table3())
+
+        return self._derive('table3', self._inputs['table3'], lambda grid: self._get_scraped_pivot(
+            grid, 'vendor', 'deduped_sum'))
+
+    def run(self):
+        """Calculates all the tables, returns a tuple (table1, table2, table3)"""
+
+        return self.table1(), self.table2(), self.table3()
+
+    def _query(self, name, sql_template, database, prepare=None):
+        if name in self._frames:
+            return self._frames[name]
+
+        sql = sql_template.format(**self.parameters)
+        key = get_fingerprint(name, sql, database)
+        self._fingerprints[name] = key
+
+        df = self.cache.get(self.ref_date, key)
+        if df is None:
+            print('Fetching %s...' % name)
+            df = self._query_func(sql, database)
+            if prepare is not None:
+                df = prepare(df)
+            self.cache.put(self.ref_date, key, df)
+
+        self._frames[name] = df
+        return df
+
+    def _derive(self, name, inputs, calculate):
+        if name in self._frames:
+            return self._frames[name]
+
+        key = self._get_step_fingerprint(name)
+
+        df = self.cache.get(self.ref_date, key)
+        if df is None:
+            # Inputs are loaded only when the step has to be recalculated
+            frames = [getattr(self, input_name)() for input_name in inputs]
+            print('Calculating %s...' % name)
+            df = calculate(*frames)
+            self.cache.put(self.ref_date, key, df)
+
+        self._frames[name] = df
+        return df
+
+    def _get_step_fingerprint(self, name):
+        if name in self._fingerprints:
+            return self._fingerprints[name]
+
+        if name in self._queries:
+            sql_template, database = self._queries[name]
+            key = get_fingerprint(name, sql_template.format(**self.parameters), database)
+        else:
+            key = get_fingerprint(name, [self._get_step_fingerprint(input_name)
+                                         for input_name in self._inputs[name]])
+
+        self._fingerprints[name] = key
+        return key
+
+    def _get_coverage_matrix(self, segments, top_30, top_50, tiers, competitors=None):
+        if self._coverage_matrix is None:
+            percentiles = {'Top30%': top_30, 'Top50%': top_50}
+            self._coverage_matrix = selection_coverage.CoverageMatrix(segments, percentiles, tiers, competitors)
+
+        return self._coverage_matrix
+
+    def _get_pushdown(self, segments, top_30, top_50, tiers):
+        matrix = self._get_coverage_matrix(segments, top_30, top_50, tiers)
+        return coverage_pushdown.CoveragePushdown(self._pushdown_backend, matrix, tiers, self.parameters)
+
+    @staticmethod
+    def _as_sql_tuple(values):
+        return '(' + ', '.join(SelectionPipeline._as_sql_value(value) for value in values) + ')'
+
+    @staticmethod
+    def _as_sql_list(values):
+        return '[' + ', '.join(SelectionPipeline._as_sql_value(value) for value in values) + ']'
+
+    @staticmethod
+    def _as_sql_value(value):
+        if isinstance(value, str):
+            return "'" + value.replace("'", "\\'") + "'"
+        return str(value)
+
+    @staticmethod
+    def _with_int_articles(df):
+        df['article_id'] = df['article_id'].astype('Int64')
+        return df
+
+    @staticmethod
+    def _process_percentile_df(df, prefix):
+        last_month_segments = df[df['in_last'] == 1][['country', 'article_id']].copy()
+        last_month_segments['use_case'] = f'{prefix} Last Month'
+
+        ttm_segments = df[df['in_last'].isin([0, 1])][['country', 'article_id']].copy()
+        ttm_segments['use_case'] = f'{prefix} TTM'
+
+        return pd.concat([last_month_segments, ttm_segments]).drop_duplicates().reset_index(drop=True)
+
+    @staticmethod
+    def _get_long_segments(segments, top_30, top_50):
+        id_vars = ['country', 'article_id']
+        use_case_columns = [col for col in segments.columns if col not in id_vars]
+        long_segments_base = pd.melt(
+            segments,
+            id_vars=id_vars,
+            value_vars=use_case_columns,
+            var_name='use_case',
+            value_name='is_in_segment'
+        )
+        long_segments_base = long_segments_base[long_segments_base['is_in_segment'] == 1].drop(
+            columns='is_in_segment')
+
+        long_segments = pd.concat([
+            long_segments_base,
+            SelectionPipeline._process_percentile_df(top_30, 'Top30%'),
+            SelectionPipeline._process_percentile_df(top_50, 'Top50%')
+        ]).drop_duplicates().reset_index(drop=True)
+
+        long_segments['article_id'] = long_segments['article_id'].astype('Int64')
+        return long_segments
+
+    @staticmethod
+    def _get_master_grid(long_segments, tiers, competitors):
+        competitors = competitors.copy()
+        competitors['article_id'] = competitors['article_id'].astype('Int64')
+
+        master_grid = pd.merge(long_segments, tiers, on='country', how='inner')
+        master_grid = pd.merge(
+            master_grid,
+            competitors,
+            on=['country', 'article_id', 'competitor'],
+            how='left'
+        )
+        master_grid['is_scraped'] = master_grid['is_scraped'].fillna(0).astype(int)
+        return master_grid
+
+    @staticmethod
+    def _get_table1(long_segments):
+        table1_pivot = pd.pivot_table(
+            long_segments,
+            values='article_id',
+            index='country',
+            columns='use_case',
+            aggfunc='nunique',
+            fill_value=0
+        )
+        table1_pivot['deduped_skus'] = long_segments.groupby('country')['article_id'].nunique()
+        return table1_pivot
+
+    @staticmethod
+    def _get_scraped_pivot(master_grid, index, deduped_name):
+        scraped_items = master_grid[master_grid['is_scraped'] == 1]
+        pivot = pd.pivot_table(
+            scraped_items,
+            values='article_id',
+            index=index,
+            columns='use_case',
+            aggfunc='nunique',
+            fill_value=0
+        )
+        pivot[deduped_name] = scraped_items.groupby(index)['article_id'].nunique()
+        return pivot
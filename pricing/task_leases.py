@@ -0,0 +1,224 @@
+"""
+A module for sharing schedule tasks between several nodes
+"""
+
+import sqlite3
+import threading
+import time
+import zlib
+
+
+class LeaseTable:
+    """
+    A class implements lease based task claiming.
+
+    Leases are stored in an SQLite file on a shared file system.
+    A worker claims a task for ttl seconds and renews the lease while the task runs,
+    a lease of a crashed worker expires and the task is claimed by another worker.
+    Workers have stable names, so a restarted worker claims its own leases again.
+    Done tasks are kept for done_ttl seconds so other nodes do not price them again,
+    older done leases and leases expired done_ttl ago are deleted while tasks are claimed.
+    """
+
+    _status_leased = 'leased'
+    _status_done = 'done'
+
+    def __init__(self, file_name, ttl=300, done_ttl=86400):
+        self._file_name = file_name
+        self._ttl = ttl
+        self._done_ttl = done_ttl
+        self._pruned = 0.
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(file_name, timeout=30, isolation_level=None, check_same_thread=False)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS leases ('
+            'task_key TEXT PRIMARY KEY, '
+            'worker TEXT NOT NULL, '
+            'status TEXT NOT NULL, '
+            'expires REAL NOT NULL)'
+        )
+
+    @property
+    def ttl(self):
+        return self._ttl
+
+    @property
+    def done_ttl(self):
+        return self._done_ttl
+
+    def claim(self, task_keys, worker):
+        """
+        Claims the first free task of the candidates
+
+        returns a claimed task key or None
+        """
+
+        now = time.time()
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                if now - self._pruned >= self.ttl:
+                    self._prune(cursor, now)
+                    self._pruned = now
+
+                for task_key in task_keys:
+                    row = cursor.execute(
+                        'SELECT worker, status, expires FROM leases WHERE task_key = ?', (task_key,)
+                    ).fetchone()
+
+                    if row is not None:
+                        owner, status, expires = row
+                        if status == self._status_done or (expires > now and owner != worker):
+                            continue
+
+                    cursor.execute(
+                        'INSERT OR REPLACE INTO leases (task_key, worker, status, expires) VALUES (?, ?, ?, ?)',
+                        (task_key, worker, self._status_leased, now + self.ttl)
+                    )
+                    cursor.execute('COMMIT')
+                    return task_key
+
+                cursor.execute('COMMIT')
+            except sqlite3.Error:
+                cursor.execute('ROLLBACK')
+                raise
+
+        return None
+
+    def renew(self, task_key, worker):
+        """Extends a lease, returns False if the lease is lost"""
+
+        return self._update(
+            'UPDATE leases SET expires = ? WHERE task_key = ? AND worker = ? AND status = ?',
+            (time.time() + self.ttl, task_key, worker, self._status_leased)
+        )
+
+    def complete(self, task_key, worker):
+        """Marks a task done, the done lease expires in done_ttl seconds"""
+
+        return self._update(
+            'UPDATE leases SET status = ?, expires = ? WHERE task_key = ? AND worker = ?',
+            (self._status_done, time.time() + self.done_ttl, task_key, worker)
+        )
+
+    def release(self, task_key, worker):
+        """Gives a task back to the pool"""
+
+        return self._update(
+            'DELETE FROM leases WHERE task_key = ? AND worker = ? AND status = ?',
+            (task_key, worker, self._status_leased)
+        )
+
+    def get_done(self, task_keys, worker):
+        """Keys of the tasks the worker has done"""
+
+        done = []
+        with self._lock:
+            for task_key in task_keys:
+                row = self._connection.execute(
+                    'SELECT 1 FROM leases WHERE task_key = ? AND worker = ? AND status = ?',
+                    (task_key, worker, self._status_done)
+                ).fetchone()
+                if row is not None:
+                    done.append(task_key)
+
+        return done
+
+    def prune(self):
+        """Deletes expired done leases and leases expired done_ttl ago, returns the number of deleted ones"""
+
+        with self._lock:
+            return self._prune(self._connection.cursor(), time.time())
+
+    def keep(self, task_key, worker):
+        """Returns a context manager renewing the lease while the task runs"""
+
+        return LeaseKeeper(self, task_key, worker)
+
+    def close(self):
+        self._connection.close()
+
+    def _prune(self, cursor, now):
+        cursor.execute(
+            'DELETE FROM leases WHERE (status = ? AND expires < ?) OR (status = ? AND expires < ?)',
+            (self._status_done, now, self._status_leased, now - self.done_ttl)
+        )
+        return cursor.rowcount
+
+    def _update(self, query, pars):
+        with self._lock:
+            cursor = self._connection.execute(query, pars)
+            return cursor.rowcount > 0
+
+
+class LeaseKeeper:
+    """
+    A context manager renews a lease in a background thread
+
+    start() and stop() renew a lease outliving a block, e.g. until a task's archive is written.
+    """
+
+    def __init__(self, lease_table, task_key, worker):
+        self._lease_table = lease_table
+        self._task_key = task_key
+        self._worker = worker
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._renew, daemon=True)
+        self._is_lost = False
+
+    @property
+    def is_lost(self):
+        return self._is_lost
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _renew(self):
+        interval = max(self._lease_table.ttl / 3., 1.)
+        while not self._stop_event.wait(interval):
+            if not self._lease_table.renew(self._task_key, self._worker):
+                self._is_lost = True
+                print('Lease lost:', self._task_key)
+                break
+
+
+class RegionSharding:
+    """
+    A class partitions tasks between nodes geographically.
+
+    Branches are grouped into square cells of cell_size degrees,
+    every cell belongs to one of the nodes, so competitors of a region
+    are loaded by the same node.
+    """
+
+    def __init__(self, node, nodes, cell_size=0.5):
+        self._node = int(node)
+        self._nodes = max(int(nodes), 1)
+        self._cell_size = float(cell_size)
+
+    @property
+    def node(self):
+        return self._node
+
+    def get_region(self, lat, lng):
+        return '%d:%d' % (lat // self._cell_size, lng // self._cell_size)
+
+    def get_node(self, region):
+        # A stable hash, so all the nodes agree on the regions' owners
+        return zlib.crc32(region.encode()) % self._nodes + 1
+
+    def is_own(self, lat, lng):
+        return self.get_node(self.get_region(lat, lng)) == self.node
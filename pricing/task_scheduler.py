@@ -0,0 +1,148 @@
+"""
+A module for ordering of schedule tasks
+"""
+
+import os
+import json
+import datetime
+import pandas as pd
+
+
+class RuntimeEstimates:
+    """
+    A class keeps past calculation seconds of branches.
+
+    An exponential moving average of every branch is stored in a JSON file,
+    branches without runs are estimated by the median of the known ones.
+    """
+
+    def __init__(self, file_name, alpha=0.3):
+        self._file_name = file_name
+        self._alpha = alpha
+        self._seconds = {}
+        self._load()
+
+    @property
+    def file_name(self):
+        return self._file_name
+
+    def get(self, pharm_id):
+        """Estimated seconds of the branch"""
+
+        seconds = self._seconds.get(str(pharm_id).upper())
+        if seconds is None:
+            return self.get_default()
+
+        return seconds
+
+    def get_default(self):
+        if not self._seconds:
+            return 1.
+
+        return float(pd.Series(list(self._seconds.values())).median())
+
+    def update(self, pharm_id, seconds):
+        key = str(pharm_id).upper()
+        prev = self._seconds.get(key)
+        self._seconds[key] = seconds if prev is None else prev + self._alpha * (seconds - prev)
+
+    def save(self):
+        temp_name = self.file_name + '.tmp'
+        try:
+            with open(temp_name, 'w') as file:
+                json.dump({'seconds': self._seconds}, file, indent=2)
+            os.replace(temp_name, self.file_name)
+        except OSError as e:
+            print('Error:', e)
+
+    def _load(self):
+        if not os.path.exists(self.file_name):
+            return
+
+        try:
+            with open(self.file_name, 'r') as file:
+                self._seconds = json.load(file).get('seconds', {})
+        except (OSError, ValueError) as e:
+            print('Error:', e)
+            self._seconds = {}
+
+
+class TaskScheduler:
+    """
+    A class orders tasks by age, estimated size and locality.
+
+    Tasks waiting longer than max_wait seconds go first, the oldest first.
+    The others are grouped into square cells of cell_size degrees, branches
+    of a cell share competitors, so they run back to back while competitors'
+    prices are cached. Cells with more estimated work start first and so do
+    the biggest branches of a cell: long tasks don't end up in the tail of the run.
+
+    Attributes:
+        -estimates - RuntimeEstimates
+        -cell_size - degrees, about the largest distance band
+        -max_wait - seconds since the task's DateTime
+    """
+
+    def __init__(self, estimates, cell_size=0.02, max_wait=3600.):
+        self._estimates = estimates
+        self._cell_size = float(cell_size)
+        self._max_wait = float(max_wait)
+
+    @property
+    def estimates(self):
+        return self._estimates
+
+    def order(self, tasks, coordinates, now=None):
+        """
+        Orders tasks to run
+
+        Attributes:
+            -tasks - dict {task key: (ID_Branch, task DateTime)}
+            -coordinates - dict {upper case ID_Branch: (lat, lng)}
+
+        returns a list of task keys
+        """
+
+        now = pd.Timestamp(now or datetime.datetime.now())
+
+        overdue = []
+        cells = {}
+        for task_key, (pharm_id, task_date) in tasks.items():
+            age = self.get_age(task_date, now)
+            size = self._estimates.get(pharm_id)
+
+            if age >= self._max_wait:
+                overdue.append((age, task_key))
+                continue
+
+            lat_lng = coordinates.get(str(pharm_id).upper())
+            cell = task_key if lat_lng is None else self.get_cell(*lat_lng)
+            cells.setdefault(cell, []).append((size, age, task_key))
+
+        ordered = [task_key for _, task_key in sorted(overdue, key=lambda item: -item[0])]
+
+        cell_tasks = sorted(cells.values(), key=lambda items: (-sum(item[0] for item in items),
+                                                               -max(item[1] for item in items)))
+        for items in cell_tasks:
+            ordered.extend(task_key for _, _, task_key in sorted(items, key=lambda item: (-item[0], -item[1])))
+
+        return ordered
+
+    @staticmethod
+    def get_age(task_date, now):
+        """Seconds since the task's DateTime, 0 when it's unknown"""
+
+        created = pd.to_datetime(task_date, errors='coerce') if task_date != '' else pd.NaT
+        if pd.isna(created):
+            return 0.
+
+        if created.tzinfo is not None and now.tzinfo is None:
+            # Naive times are local
+            now = now.tz_localize(datetime.datetime.now().astimezone().tzinfo)
+        elif created.tzinfo is None and now.tzinfo is not None:
+            now = now.tz_localize(None)
+
+        return (now - created).total_seconds()
+
+    def get_cell(self, lat, lng):
+        return '%d:%d' % (lat // self._cell_size, lng // self._cell_size)
@@ -0,0 +1,60 @@
+import threading
+import zipfile
+
+import pytest
+
+import archive_writer
+
+
+@pytest.mark.parametrize('codec', ['store', 'deflate', 'bzip2', 'lzma'])
+def test_archives_are_written_with_the_codec(tmp_path, monkeypatch, codec):
+    monkeypatch.chdir(tmp_path)
+    with open('prices.xml', 'w') as file:
+        file.write('<Offers>' + '<Offer Code="1"/>' * 100 + '</Offers>')
+
+    archive_writer.write_archive('prices.zip', 'prices.xml', codec, level=9)
+
+    with zipfile.ZipFile('prices.zip') as z_file:
+        assert z_file.read('prices.xml').count(b'<Offer ') == 100
+    with pytest.raises(ValueError):
+        archive_writer.write_archive('prices.zip', 'prices.xml', 'zstd')
+
+
+def test_writer_reports_results_and_errors():
+    def fail():
+        raise OSError('Disk is full')
+
+    with archive_writer.ArchiveWriter(workers=2) as writer:
+        written = writer.submit('A', lambda: 'a.zip')
+        failed = writer.submit('B', fail)
+
+        assert written.result(timeout=5) == 'a.zip'
+        assert isinstance(failed.exception(timeout=5), OSError)
+
+
+def test_wait_returns_after_the_last_job_of_the_key():
+    release = threading.Event()
+    done = []
+
+    def job(name):
+        def write():
+            release.wait(5)
+            done.append(name)
+            return name
+        return write
+
+    with archive_writer.ArchiveWriter(workers=1, queue_size=1) as writer:
+        writer.submit('A', job('first'))
+        writer.submit('A', job('second'))
+        # The queue is full, a submit blocks until a job is taken
+        blocked = threading.Thread(target=writer.submit, args=('B', job('third')))
+        blocked.start()
+        blocked.join(0.1)
+        assert blocked.is_alive()
+
+        release.set()
+        writer.wait('A')
+        assert done[:2] == ['first', 'second']
+        blocked.join(5)
+
+    assert done == ['first', 'second', 'third']
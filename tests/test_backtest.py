@@ -0,0 +1,70 @@
+import datetime
+
+import pandas as pd
+
+import backtest
+import price_history
+import pricing
+
+
+DAY = datetime.datetime(2024, 5, 1)
+
+
+def make_settings(tmp_path):
+    return pricing.PricingSettings(values={
+        'prices': (100., 300., 500., 1000., 2000., 3000.),
+        'distances': (300., 500., 1000., 2000.),
+        'default_unit': 100.,
+        'default_unit_price': 1.,
+        'deviation': 0.005,
+        'save_path': str(tmp_path),
+        'auth': 'auth',
+        'branches_api': 'http://branches',
+        'tasks_api': 'http://tasks',
+        'tasks_delete_api': 'http://tasks/delete',
+        'prices_api': 'http://prices',
+        'prices_all_api': 'http://prices/all'
+    })
+
+
+def append(history, source, branch, goods, prices, day, hour):
+    history.append(pd.DataFrame({'ID_Branch': branch, 'ID_Goods': goods, 'Price': prices,
+                                 'PriceReserve': [price / 2 for price in prices]}),
+                   source, timestamp=DAY + datetime.timedelta(days=day, hours=hour))
+
+
+def test_new_snapshot_replaces_the_branch_rows():
+    def records(source, branch, goods, hour):
+        return pd.DataFrame({'Source': source, 'ID_Branch': branch, 'ID_Goods': goods,
+                             'Timestamp': DAY + datetime.timedelta(hours=hour), 'Price': 1., 'PriceReserve': 1.})
+
+    state = pd.concat([records('competitor', 'B', ['G1', 'G2'], 1), records('competitor', 'C', ['G1'], 1),
+                       records('own', 'B', ['G3'], 1)], ignore_index=True)
+    new_records = pd.concat([records('competitor', 'B', ['G1', 'G4'], 2), records('competitor', 'B', ['G1'], 3)],
+                            ignore_index=True)
+
+    state = backtest.Backtest._roll(state, new_records)
+
+    assert sorted(zip(state['Source'], state['ID_Branch'], state['ID_Goods'])) == [
+        ('competitor', 'B', 'G1'), ('competitor', 'C', 'G1'), ('own', 'B', 'G3')]
+
+
+def test_goods_missing_in_a_competitor_snapshot_are_not_priced_by_it(tmp_path):
+    history = price_history.PriceHistory(str(tmp_path / 'history'))
+    for day in (0, 1):
+        append(history, price_history.PriceSource.Own, 'A', ['G1', 'G2'], [100., 100.], day, 8)
+        append(history, price_history.PriceSource.Exported, 'A', ['G1', 'G2'], [100., 100.], day, 12)
+    append(history, price_history.PriceSource.Competitor, 'B', ['G1', 'G2'], [80., 80.], 0, 9)
+    # G2 is sold out at B the next day
+    append(history, price_history.PriceSource.Competitor, 'B', ['G1'], [80.], 1, 9)
+
+    pharmacy_table = pd.DataFrame({'ID_Branch': ['A', 'B'], 'ID_Enterprise': ['E1', 'E2'], 'Code': [1, 2],
+                                   'SerialNumber': [10, 20], 'Lat': [50.45, 50.4501], 'Lng': [30.52, 30.5201]})
+    deltas, summary = backtest.Backtest(history, pharmacy_table, make_settings(tmp_path)).run(
+        ['A'], DAY, DAY + datetime.timedelta(days=1))
+
+    prices = deltas.set_index(['Date', 'ID_Goods'])['PriceReserve']
+    assert prices[(pd.Timestamp(DAY), 'G2')] < 100.
+    assert prices[(pd.Timestamp(DAY + datetime.timedelta(days=1)), 'G2')] == 100.
+    assert prices[(pd.Timestamp(DAY + datetime.timedelta(days=1)), 'G1')] < 100.
+    assert summary['goods'].tolist() == [2, 2]
@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+
+import branch_index
+
+
+def make_index(exclusion_groups=()):
+    pharmacy_table = pd.DataFrame({
+        'ID_Branch': ['A', 'B', 'C', 'D', 'E', 'F'],
+        'ID_Enterprise': ['e1', 'E2', 'E3', 'E1', 'E4', None]
+    })
+    return branch_index.BranchIndex(pharmacy_table, ['A', 'B', 'C', 'D', 'E', 'F', 'G'], exclusion_groups)
+
+
+def competitors(index, id_branch):
+    return index.branches[index.get_competitors_mask(id_branch)].tolist()
+
+
+def test_branches_of_an_enterprise_are_not_competitors():
+    index = make_index()
+
+    assert competitors(index, 'A') == ['B', 'C', 'E', 'F', 'G']
+    assert competitors(index, 'D') == ['B', 'C', 'E', 'F', 'G']
+    # Branches without an enterprise compete with everyone
+    assert competitors(index, 'F') == ['A', 'B', 'C', 'D', 'E', 'G']
+    assert competitors(index, 'X') == index.branches.tolist()
+
+
+def test_enterprises_of_an_exclusion_group_share_a_code():
+    groups = branch_index.BranchIndex.parse_groups('e2, E3 ;E4,E9;;')
+    index = make_index(groups)
+
+    assert groups == (frozenset({'E2', 'E3'}), frozenset({'E4', 'E9'}))
+    assert competitors(index, 'B') == ['A', 'D', 'E', 'F', 'G']
+    assert competitors(index, 'E') == ['A', 'B', 'C', 'D', 'F', 'G']
+    assert np.unique(index.codes).size == 5
+
+
+def test_numeric_setting_is_one_enterprise():
+    assert branch_index.BranchIndex.parse_groups(12.) == (frozenset({'12'}),)
+    assert branch_index.BranchIndex.parse_groups('') == ()
@@ -0,0 +1,36 @@
+import json
+
+import competitor_ranking
+
+
+def test_leaders_are_ranked_and_scores_decay(tmp_path):
+    file_name = str(tmp_path / 'leaders.json')
+    leadership = competitor_ranking.CompetitorLeadership(file_name, decay=0.5)
+
+    leadership.update({'a': 4, 'b': 1}, fetched=['a', 'b'])
+    leadership.update({'b': 4}, fetched=['a', 'b'])
+
+    assert leadership.scores == {'A': 2., 'B': 4.5}
+    assert leadership.rank(['a', 'b', 'c']) == ['b', 'a', 'c']
+    # A new object reads the stored state
+    assert competitor_ranking.CompetitorLeadership(file_name).fetched == {'A': 2, 'B': 2}
+
+
+def test_selection_explores_competitors_fetched_longest_ago(tmp_path):
+    leadership = competitor_ranking.CompetitorLeadership(str(tmp_path / 'leaders.json'), exploration=0.25)
+    leadership.update({'a': 5, 'b': 4, 'c': 3, 'd': 2}, fetched=['a', 'b', 'c', 'd'])
+    leadership.update({}, fetched=['a', 'b', 'c', 'e'])
+
+    # Three leaders and one place for the longest unfetched competitor
+    assert leadership.select(['a', 'b', 'c', 'd', 'e', 'f'], 4) == ['a', 'b', 'c', 'f']
+    assert leadership.select(['a', 'b'], 4) == ['a', 'b']
+
+
+def test_old_files_keep_scores_only(tmp_path):
+    file_name = tmp_path / 'leaders.json'
+    file_name.write_text(json.dumps({'A': 1.}))
+
+    leadership = competitor_ranking.CompetitorLeadership(str(file_name))
+
+    assert leadership.has_history()
+    assert leadership.scores == {'A': 1.} and leadership.fetched == {}
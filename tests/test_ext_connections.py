@@ -0,0 +1,269 @@
+import gzip
+import io
+import json
+import threading
+
+import pandas as pd
+import pytest
+
+import coverage_pushdown
+import ext_connections as ext_con
+
+
+class FakeConnection:
+    created = 0
+
+    def __init__(self, *args):
+        FakeConnection.created += 1
+        self.args = args
+        self.is_alive = True
+        self.closed = False
+
+    def ping(self):
+        return self.is_alive
+
+    def disconnect(self):
+        self.closed = True
+
+    def execute(self, query, external_tables=None):
+        return pd.DataFrame({'query': [query], 'tables': [len(external_tables or [])]})
+
+
+def test_pool_blocks_when_all_connections_are_taken():
+    pool = ext_con.ConnectionPool(FakeConnection, max_size=2)
+    first = pool.acquire()
+    second = pool.acquire()
+
+    with pytest.raises(TimeoutError):
+        pool.acquire(timeout=0.05)
+
+    released = threading.Timer(0.05, pool.release, (first,))
+    released.start()
+    assert pool.acquire(timeout=5) is first
+    assert pool.size == 2
+    pool.release(second)
+
+
+def test_pool_reuses_idle_and_evicts_old_connections(monkeypatch):
+    now = [100.]
+    monkeypatch.setattr(ext_con.time, 'monotonic', lambda: now[0])
+    pool = ext_con.ConnectionPool(FakeConnection, max_size=2, max_idle=60., check_after=10.)
+
+    with pool.connection() as connection:
+        pass
+    with pool.connection() as reused:
+        assert reused is connection
+
+    now[0] += 61
+    with pool.connection() as new_connection:
+        assert new_connection is not connection
+    assert connection.closed
+    assert pool.size == 1
+
+
+def test_pool_discards_broken_connections(monkeypatch):
+    now = [100.]
+    monkeypatch.setattr(ext_con.time, 'monotonic', lambda: now[0])
+    pool = ext_con.ConnectionPool(FakeConnection, max_size=1, check_after=10.)
+
+    with pytest.raises(ValueError):
+        with pool.connection() as connection:
+            raise ValueError('Query failed')
+    assert connection.closed
+    assert pool.size == 0
+
+    with pool.connection() as connection:
+        connection.is_alive = False
+    # A connection idle longer than check_after is pinged before reuse
+    now[0] += 11
+    with pool.connection() as new_connection:
+        assert new_connection is not connection
+    assert connection.closed
+    assert pool.size == 1
+
+
+def test_pool_closes_connections_over_reduced_size():
+    pool = ext_con.ConnectionPool(FakeConnection, max_size=2)
+    connections = [pool.acquire(), pool.acquire()]
+
+    pool.max_size = 1
+    pool.release(connections[0])
+    pool.release(connections[1])
+
+    assert connections[0].closed and not connections[1].closed
+    assert pool.size == 1
+    pool.close()
+    assert connections[1].closed and pool.size == 0
+
+
+def test_get_pool_shares_a_pool_per_connection_data(monkeypatch):
+    monkeypatch.setattr(ext_con, 'pools', {})
+    backends = ext_con.BackendRegistry()
+    backends.register(ext_con.ConnectionType.ClickHouseServer, FakeConnection)
+    monkeypatch.setattr(ext_con, 'backends', backends)
+
+    pool = ext_con.get_pool(ext_con.ConnectionType.ClickHouseServer, 'host', 9000, 'user', 'password')
+    assert ext_con.get_pool(ext_con.ConnectionType.ClickHouseServer, 'host', 9000, 'user', 'password') is pool
+    assert ext_con.get_pool(ext_con.ConnectionType.ClickHouseServer, 'other', 9000, 'user', 'password') is not pool
+
+    backend = coverage_pushdown.ClickHouseBackend(pool)
+    tables = {'segments': pd.DataFrame({'country': ['DE'], 'article_id': [1], 'mask': [1]})}
+    created = FakeConnection.created
+    for _ in range(3):
+        df = backend.execute('SELECT 1', tables)
+
+    assert df['tables'].tolist() == [1]
+    assert FakeConnection.created == created + 1
+    with pool.connection() as connection:
+        assert connection.args == ('host', 9000, 'user', 'password')
+
+
+
+def test_drivers_are_imported_on_first_use():
+    module = ext_con.LazyModule('colorsys')
+    assert not module.is_loaded
+
+    assert module.rgb_to_hsv(1., 0., 0.)[0] == 0.
+    assert module.is_loaded
+    assert ext_con.LazyModule.load_stats['colorsys']['seconds'] >= 0
+    with pytest.raises(AttributeError):
+        module._private
+
+
+def test_backend_drivers_are_loaded_when_the_backend_is_used():
+    drivers = (ext_con.LazyModule('html'), ext_con.LazyModule('shlex'))
+    backends = ext_con.BackendRegistry()
+    backends.register(ext_con.ConnectionType.ClickHouseServer, FakeConnection, drivers)
+    backends.register(ext_con.ConnectionType.SQLServer, FakeConnection, (ext_con.LazyModule('netrc'),))
+
+    assert not backends.is_loaded(ext_con.ConnectionType.ClickHouseServer)
+    connection = backends.create(ext_con.ConnectionType.ClickHouseServer, 'host', 9000)
+
+    assert connection.args == ('host', 9000)
+    assert backends.is_loaded(ext_con.ConnectionType.ClickHouseServer)
+    assert not backends.is_loaded(ext_con.ConnectionType.SQLServer)
+    with pytest.raises(KeyError):
+        backends.get(ext_con.ConnectionType.API)
+
+
+XML = ('<items>' + ''.join('<item Code="%d" Price="%d.5"/>' % (ind, ind) for ind in range(5)) +
+       '<item Code="5" Price="5.5" Name="E"/><item Code="6"/></items>')
+
+
+def test_xml_is_parsed_by_chunks(monkeypatch):
+    monkeypatch.setattr(ext_con.Parser, 'chunk_size', 3)
+
+    chunks = list(ext_con.Parser.iter_xml(io.BytesIO(XML.encode()), dtypes={'Code': int}))
+    df = ext_con.Parser.parse_xml(io.BytesIO(XML.encode()), dtypes={'Code': int, 'Price': float})
+
+    assert [len(chunk) for chunk in chunks] == [3, 3, 1]
+    assert df.columns.tolist() == ['Code', 'Price', 'Name']
+    assert df['Code'].tolist() == list(range(7)) and str(df['Code'].dtype) == 'Int64'
+    assert df['Price'].iloc[:6].tolist() == [0.5, 1.5, 2.5, 3.5, 4.5, 5.5] and pd.isna(df['Price'].iloc[6])
+    assert df['Name'].isna().tolist() == [True] * 5 + [False, True]
+
+
+def test_xml_chunks_are_reduced_before_they_are_joined(monkeypatch):
+    monkeypatch.setattr(ext_con.Parser, 'chunk_size', 2)
+
+    df = ext_con.Parser.parse_xml(io.BytesIO(XML.encode()), columns=['Code', 'Price'], dtypes={'Code': int},
+                                  reducer=lambda chunk: chunk[chunk['Code'] % 2 == 0])
+    single = ext_con.Parser.parse_xml(io.BytesIO(b'<items><item Code="1"/></items>'))
+
+    assert df['Code'].tolist() == [0, 2, 4, 6]
+    assert single['Code'].tolist() == ['1']
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, body=b''):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.raw = io.BytesIO(body)
+        self.headers = {}
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSession:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.sent = []
+
+    def request(self, **kwargs):
+        self.sent.append(kwargs)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def test_failed_requests_are_retried(monkeypatch):
+    monkeypatch.setattr(ext_con.time, 'sleep', lambda seconds: None)
+    policy = ext_con.RequestPolicy(retries=2)
+    ok = FakeResponse()
+    session = FakeSession(FakeResponse(503), ext_con.requests.exceptions.ConnectionError('Reset'), ok)
+
+    assert policy.request(session, 'GET', 'http://api/prices?sn=1') is ok
+    assert len(session.sent) == 3 and not ok.closed
+
+    with pytest.raises(ext_con.APIError):
+        policy.request(FakeSession(FakeResponse(404)), 'GET', 'http://api/prices?sn=1')
+    stats = policy.get_stats()
+    assert stats['endpoints']['api/prices']['count'] == 4
+    assert stats['endpoints']['api/prices']['errors'] == 2
+    assert stats['open_circuits'] == []
+
+
+def test_failed_read_ends_the_trial_of_a_half_open_circuit(monkeypatch):
+    now = [100.]
+    monkeypatch.setattr(ext_con.time, 'monotonic', lambda: now[0])
+    policy = ext_con.RequestPolicy(retries=0, failure_threshold=1, reset_after=10.)
+    url = 'http://api/prices?sn=1'
+
+    with pytest.raises(ext_con.APIError):
+        policy.request(FakeSession(FakeResponse(500)), 'GET', url)
+    with pytest.raises(ext_con.CircuitOpenError):
+        policy.request(FakeSession(FakeResponse()), 'GET', url)
+    # Other competitors have their own circuits
+    policy.request(FakeSession(FakeResponse()), 'GET', 'http://api/prices?sn=2')
+
+    def read(respond):
+        raise ValueError('Broken JSON')
+
+    now[0] += 11
+    trial = FakeResponse()
+    with pytest.raises(ValueError):
+        policy.request(FakeSession(trial), 'GET', url, read=read)
+    assert trial.closed
+    assert policy.get_stats()['open_circuits'] == ['api?sn=1']
+
+    now[0] += 11
+    assert policy.request(FakeSession(FakeResponse(body=b'[]')), 'GET', url, read=lambda respond: 'read') == 'read'
+    assert policy.get_stats()['open_circuits'] == []
+
+
+class FakeRaw:
+    def __init__(self, body):
+        self._body = io.BytesIO(body)
+
+    def read(self, size, decode_content=True):
+        return self._body.read(size)
+
+
+def test_json_bodies_are_decoded_into_typed_frames():
+    items = [{'govid': 'G1', 'price': '10.5', 'Quantity': '1,5', 'DateTime': '2024-05-01T10:00:00', 'code': 7},
+             {'govid': 'G2', 'price': '11', 'Quantity': '2', 'DateTime': '2024-05-01T11:00:00', 'code': 8}]
+    body = json.dumps({'response': {'items': items}}).encode()
+
+    stream = ext_con.DecodedStream(FakeRaw(gzip.compress(body)), 'gzip')
+    df = ext_con.API._to_df(stream, 'json_detailed')
+    expected = pd.read_json(io.StringIO(json.dumps(items)))
+
+    pd.testing.assert_frame_equal(df, expected, check_dtype=False)
+    assert df['price'].tolist() == [10.5, 11.] and df['Quantity'].tolist() == ['1,5', '2']
+    assert str(df['DateTime'].dtype).startswith('datetime64')
+    assert stream.compressed_bytes < stream.uncompressed_bytes == len(body)
+
+    assert ext_con.API._to_df(io.BytesIO(json.dumps({'Items': []}).encode()), 'json').empty
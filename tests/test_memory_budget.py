@@ -0,0 +1,63 @@
+import threading
+
+import pandas as pd
+
+import memory_budget
+
+
+def test_peak_rss_is_the_process_peak_and_growth_is_above_the_start(monkeypatch):
+    rss = iter([100, 300, 250])
+    monkeypatch.setattr(memory_budget, 'get_rss', lambda: next(rss, 250))
+
+    with memory_budget.PeakRSS(interval=0.001) as peak_rss:
+        pass
+
+    assert peak_rss.start == 100
+    assert peak_rss.peak >= 250
+    assert peak_rss.growth == peak_rss.peak - 100
+
+
+def test_budget_keeps_the_biggest_recent_growth(monkeypatch):
+    rss = [100]
+    monkeypatch.setattr(memory_budget, 'get_rss', lambda: rss[0])
+    budget = memory_budget.MemoryBudget(1000)
+
+    def calculate():
+        rss[0] = 600
+        return 'priced'
+
+    result, peak_rss = budget.run(calculate)
+
+    assert result == 'priced' and peak_rss.growth == 500
+    assert budget.estimate == 500
+    budget.acquire()
+    budget.release(100)
+    assert budget.estimate == 400
+
+
+def test_budget_waits_while_the_process_is_over_the_budget(monkeypatch):
+    rss = [900]
+    monkeypatch.setattr(memory_budget, 'get_rss', lambda: rss[0])
+    budget = memory_budget.MemoryBudget(1000)
+    budget.acquire()
+    budget.release(200)
+
+    budget.acquire()
+    started = threading.Event()
+    second = threading.Thread(target=lambda: (budget.acquire(), started.set()))
+    second.start()
+    # One calculation always runs, others wait for memory
+    assert not started.wait(0.2)
+
+    rss[0] = 500
+    budget.release()
+    assert started.wait(5)
+    second.join()
+    budget.release()
+
+
+def test_frame_bytes_include_strings():
+    df = pd.DataFrame({'ID_Goods': ['G%d' % ind for ind in range(100)], 'Price': [1.] * 100})
+
+    assert memory_budget.get_frame_bytes(None) == 0
+    assert memory_budget.get_frame_bytes(df) > memory_budget.get_frame_bytes(df[['Price']])
@@ -0,0 +1,79 @@
+import datetime
+import json
+
+import numpy as np
+import pandas as pd
+
+import price_export
+
+
+DATE = datetime.datetime(2024, 5, 1, 10)
+
+
+def make_prices():
+    return pd.DataFrame({
+        'Code': [1, 2, 2, 3, 4],
+        'Name': ['A', 'B', 'B', 'C', 'D'],
+        'Producer': ['P', 'P', 'Q', 'P', None],
+        'Price': [10., 20., 21., 30., 40.],
+        'PriceReserve': [9., 19., 20., 29., np.nan],
+        'Quantity': [1., 2., 3., 4., 5.]
+    })
+
+
+def export(tmp_path, prices, snapshot_every=0):
+    exporter = price_export.PriceExport(str(tmp_path), 100, price_export.ExportMode.Delta, snapshot_every)
+    kind, offers = exporter.select(prices)
+    exporter.commit(kind, 'archive.zip', DATE, prices, offers)
+    return kind, offers
+
+
+def test_full_mode_exports_every_offer(tmp_path):
+    prices = make_prices()
+    exporter = price_export.PriceExport(str(tmp_path), 100)
+
+    kind, offers = exporter.select(prices)
+
+    assert kind == price_export.ExportMode.Full
+    pd.testing.assert_frame_equal(offers, prices)
+
+
+def test_delta_exports_changed_new_and_removed_offers(tmp_path):
+    prices = make_prices()
+    assert export(tmp_path, prices)[0] == price_export.ExportMode.Full
+
+    current = prices.copy()
+    current.loc[2, 'PriceReserve'] = 18.
+    current = pd.concat([current.drop(index=3), pd.DataFrame({
+        'Code': [5], 'Name': ['E'], 'Producer': ['P'], 'Price': [50.], 'PriceReserve': [49.], 'Quantity': [1.]
+    })], ignore_index=True)
+
+    kind, offers = export(tmp_path, current)
+
+    assert kind == price_export.ExportMode.Delta
+    # The removed offer comes first with zero quantity, the changed offer of a repeated Code is kept
+    assert offers['Code'].tolist() == [3, 2, 5]
+    assert offers['Quantity'].tolist() == [0., 3., 1.]
+    assert offers['PriceReserve'].tolist() == [29., 18., 49.]
+
+
+def test_delta_without_changes_is_empty(tmp_path):
+    prices = make_prices()
+    export(tmp_path, prices)
+
+    # Missing values are equal to missing values of the last export
+    kind, offers = export(tmp_path, make_prices())
+
+    assert kind == price_export.ExportMode.Delta
+    assert offers.empty
+
+
+def test_snapshot_is_written_every_n_exports(tmp_path):
+    prices = make_prices()
+    kinds = [export(tmp_path, prices, snapshot_every=3)[0] for _ in range(4)]
+
+    assert kinds == ['full', 'delta', 'delta', 'full']
+    with open(str(tmp_path / 'manifest_100.json')) as file:
+        manifest = json.load(file)
+    assert manifest['snapshot']['file'] == 'archive.zip'
+    assert manifest['deltas'] == []
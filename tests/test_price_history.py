@@ -0,0 +1,69 @@
+import datetime
+import os
+
+import pandas as pd
+
+import price_history
+
+
+DAY = datetime.datetime(2024, 5, 1)
+
+
+def make_prices(branch, goods, price, hour):
+    return pd.DataFrame({
+        'ID_Branch': branch,
+        'ID_Goods': goods,
+        'Price': [price + ind for ind in range(len(goods))],
+        'PriceReserve': price,
+        'DateTime': DAY + datetime.timedelta(hours=hour)
+    })
+
+
+def test_scan_returns_observations_of_the_period(tmp_path):
+    history = price_history.PriceHistory(str(tmp_path))
+    history.append(make_prices('a', ['G1', 'G2'], 10.123456, 1), price_history.PriceSource.Own)
+    history.append(make_prices('b', ['G1'], 20., 25), price_history.PriceSource.Competitor)
+    history.append(make_prices('a', ['G1'], 30., 49), price_history.PriceSource.Own)
+
+    df = history.scan(DAY, DAY + datetime.timedelta(days=1, hours=23))
+
+    assert df['ID_Branch'].tolist() == ['A', 'A', 'B']
+    assert df['Price'].tolist() == [10.123456, 11.123456, 20.]
+    assert df['Price'].dtype == float
+    assert history.scan(DAY, DAY + datetime.timedelta(days=3), branches=['b'])['Price'].tolist() == [20.]
+    assert history.scan(DAY, DAY + datetime.timedelta(days=3), source='own')['Price'].tolist() == [
+        10.123456, 11.123456, 30.]
+
+
+def test_latest_takes_the_last_price_of_every_key(tmp_path):
+    history = price_history.PriceHistory(str(tmp_path))
+    history.append(make_prices('a', ['G1', 'G2'], 10., 1), price_history.PriceSource.Own)
+    history.append(make_prices('a', ['G1'], 20., 2), price_history.PriceSource.Own)
+    history.append(make_prices('a', ['G1'], 30., 25), price_history.PriceSource.Own)
+    history.append(make_prices('a', ['G1'], 40., 50), price_history.PriceSource.Own)
+
+    df = history.latest(DAY + datetime.timedelta(days=1, hours=12))
+
+    assert df.sort_values('ID_Goods')[['ID_Goods', 'Price']].values.tolist() == [['G1', 30.], ['G2', 11.]]
+    assert history.latest(DAY + datetime.timedelta(hours=1, minutes=30))['Price'].tolist() == [10., 11.]
+    assert history.latest(DAY - datetime.timedelta(days=1)).empty
+
+
+def test_partitions_are_compacted(tmp_path, monkeypatch):
+    monkeypatch.setattr(price_history.PriceHistory, 'compact_files', 3)
+    history = price_history.PriceHistory(str(tmp_path))
+
+    for hour in range(9):
+        history.append(make_prices('b%d' % hour, ['G1'], float(hour), hour), price_history.PriceSource.Competitor)
+
+    names = sorted(os.listdir(str(tmp_path / '20240501')))
+    assert len(names) == 3
+    assert sum(name.startswith('compact_') for name in names) == 2
+    df = price_history.PriceHistory(str(tmp_path)).scan(DAY, DAY + datetime.timedelta(hours=23))
+    assert df['Price'].tolist() == [float(hour) for hour in range(9)]
+
+    assert history.compact(DAY) is None
+    history.compact(DAY, full=True)
+    assert len(os.listdir(str(tmp_path / '20240501'))) == 1
+    assert history.latest(DAY + datetime.timedelta(hours=23))['Price'].sort_values().tolist() == [
+        float(hour) for hour in range(9)]
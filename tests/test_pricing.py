@@ -0,0 +1,356 @@
+import contextlib
+import datetime
+import pickle
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+import price_history
+import pricing
+
+
+VALUES = {
+    'prices': (100., 300., 500., 1000., 2000., 3000.),
+    'distances': (300., 500., 1000., 2000.),
+    'default_unit': 100.,
+    'default_unit_price': 1.,
+    'deviation': 0.005,
+    'price_difference': 0.005,
+    'branches_api': 'http://branches',
+    'tasks_api': 'http://tasks',
+    'tasks_delete_api': 'http://tasks/delete',
+    'prices_api': 'http://prices',
+    'prices_all_api': 'http://prices/all',
+    'auth': 'auth',
+    'price_history': ''
+}
+
+
+def make_settings(tmp_path, **overrides):
+    values = dict(VALUES, save_path=str(tmp_path / 'save'))
+    values.update(overrides)
+    return pricing.PricingSettings(values=values)
+
+
+def make_branches():
+    return pd.DataFrame({
+        'ID_Branch': ['A', 'B', 'C', 'D'],
+        'ID_Enterprise': ['E1', 'E2', 'E3', 'E1'],
+        'Code': [1, 2, 3, 1],
+        'SerialNumber': [10, 20, 30, 40],
+        'Lat': [50.4500, 50.4501, 50.4520, 50.4510],
+        'Lng': [30.5200, 30.5201, 30.5230, 30.5210]
+    })
+
+
+def make_schedule(settings, tasks):
+    """A schedule of the tasks without the tasks API"""
+
+    schedule = pricing.PricingSchedule.__new__(pricing.PricingSchedule)
+    schedule._default_settings = settings
+    schedule._cache = pricing.BranchCache()
+    schedule._task_times = []
+    schedule._tasks = pd.DataFrame(tasks)
+    schedule._is_scheduled = True
+    schedule._set_sharding()
+    return schedule
+
+
+@pytest.fixture
+def branches(monkeypatch):
+    calls = []
+
+    def load_pharmacy_table(settings):
+        calls.append(settings)
+        return make_branches()
+
+    monkeypatch.setattr(pricing.GoodsPricing, 'load_pharmacy_table', staticmethod(load_pharmacy_table))
+    return calls
+
+
+def test_cache_keeps_branches_and_distances_between_calculations(tmp_path, branches):
+    settings = make_settings(tmp_path)
+    cache = pricing.BranchCache()
+
+    first = pricing.GoodsPricing(1, 10, 'A', settings, cache=cache)
+    second = pricing.GoodsPricing(2, 20, 'B', settings, cache=cache)
+    bands = first.get_band_competitors()
+    second.get_band_competitors()
+
+    assert len(branches) == 1
+    assert first.distance_table is second.distance_table
+    # D belongs to A's enterprise
+    assert sorted(sum(bands.values(), [])) == ['B', 'C']
+
+
+def test_pharmacy_is_found_by_enterprise_and_serial_number(tmp_path, branches):
+    new_pricing = pricing.GoodsPricing(3, 30, '', make_settings(tmp_path), cache=pricing.BranchCache())
+
+    new_pricing.get_band_competitors()
+
+    assert new_pricing.id_pharmacy == 'C'
+
+
+def test_recalculate_reports_stages_and_stops_when_cancelled(tmp_path, branches, monkeypatch):
+    monkeypatch.setattr(pricing.GoodsPricing, '_set_current_pharmacy_prices', lambda self: True)
+    stages = []
+    cancel_event = threading.Event()
+
+    def progress(stage, current, total):
+        stages.append(stage)
+        if stage == 'Distances':
+            cancel_event.set()
+
+    new_pricing = pricing.GoodsPricing(1, 10, 'A', make_settings(tmp_path), cache=pricing.BranchCache(),
+                                       progress=progress, cancel_event=cancel_event)
+
+    assert not new_pricing.recalculate()
+    assert stages == ['Ratios', 'Branches', 'Distances']
+    assert new_pricing.is_cancelled
+    assert new_pricing.stage == 'Distances'
+    assert set(new_pricing.timings) == {'Ratios', 'Branches'}
+
+
+def test_runner_reports_pharmacies_in_tasks_order(tmp_path, monkeypatch):
+    def execute(self, new_settings=None, writer=None):
+        time.sleep(0.01 * (6 - self.serial_number))
+        if self.serial_number == 3:
+            raise ValueError('Broken prices')
+        return self.serial_number != 4
+
+    monkeypatch.setattr(pricing.GoodsPricing, 'execute', execute)
+    reported = []
+    runner = pricing.PricingRunner(make_settings(tmp_path), workers=4)
+
+    results = runner.run([(1, serial_number, 'B%d' % serial_number) for serial_number in range(1, 6)],
+                         on_result=reported.append)
+
+    assert [result['serial_number'] for result in results] == [1, 2, 3, 4, 5]
+    assert [result['success'] for result in results] == [True, True, False, False, True]
+    assert results[2]['error'] == 'Broken prices'
+    assert reported == results
+    assert all(result['seconds'] > 0 for result in results)
+
+
+def test_threads_share_one_history(tmp_path, monkeypatch):
+    created = []
+
+    class History:
+        def __init__(self, path):
+            time.sleep(0.01)
+            created.append(path)
+
+    monkeypatch.setattr(price_history, 'PriceHistory', History)
+    settings = make_settings(tmp_path, price_history=1.)
+    barrier = threading.Barrier(8)
+    histories = []
+
+    def get_history():
+        barrier.wait()
+        histories.append(pricing.GoodsPricing(1, 10, 'A', settings).get_history())
+
+    threads = [threading.Thread(target=get_history) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    pricing.GoodsPricing._histories.pop(str(tmp_path / 'save'))
+    assert len(created) == 1
+    assert all(history is histories[0] for history in histories)
+
+
+def test_restarted_schedule_skips_priced_tasks_and_acknowledges_them(tmp_path, branches, monkeypatch):
+    executed = []
+    acknowledged = []
+    is_api_available = [False]
+
+    def execute(self, new_settings=None, writer=None):
+        executed.append(self.id_pharmacy)
+        if self.id_pharmacy == 'C' and not is_api_available[0]:
+            return False
+        self._archive_name = str(tmp_path / (self.id_pharmacy + '.zip'))
+        open(self._archive_name, 'w').close()
+        return True
+
+    def del_schedule(self, pharm_ids):
+        acknowledged.append(sorted(pharm_ids))
+        return is_api_available[0]
+
+    monkeypatch.setattr(pricing.GoodsPricing, 'execute', execute)
+    monkeypatch.setattr(pricing.PricingSchedule, '_del_schedule', del_schedule)
+    settings = make_settings(tmp_path, ack_batch_size=2.)
+    tasks = {'ID_Branch': ['A', 'B', 'C', 'D'], 'Code': [1, 2, 3, 1], 'SerialNumber': [10, 20, 30, 40],
+             'DateTime': ['2024-05-01T10:00:00'] * 4}
+
+    # The tasks API is down, priced tasks stay in the checkpoint unacknowledged
+    make_schedule(settings, tasks).run()
+    assert sorted(executed) == ['A', 'B', 'C', 'D']
+
+    executed.clear()
+    acknowledged.clear()
+    is_api_available[0] = True
+    make_schedule(settings, tasks).run()
+
+    assert executed == ['C']
+    assert sorted(sum(acknowledged, [])) == ['A', 'B', 'C', 'D']
+    assert all(len(batch) >= 2 for batch in acknowledged[:-1])
+
+
+def test_settings_are_validated_and_immutable(tmp_path):
+    settings = make_settings(tmp_path, prices='[100, 300, 500]', max_threads='4')
+
+    assert settings.get_setting('prices') == (100., 300., 500.)
+    assert settings.get_setting('max_threads') == 4.
+    with pytest.raises(AttributeError):
+        settings.prices = (1., 2.)
+    with pytest.raises(ValueError):
+        make_settings(tmp_path, prices=(300., 100.))
+    with pytest.raises(ValueError):
+        make_settings(tmp_path, deviation='high')
+    assert not make_settings(tmp_path, auth='')
+
+
+def test_equal_settings_share_hashes_and_survive_pickling(tmp_path):
+    settings = make_settings(tmp_path)
+    replaced = settings.replace(deviation='0.01')
+
+    assert settings == make_settings(tmp_path)
+    assert hash(settings) == hash(make_settings(tmp_path))
+    assert replaced.get_setting('deviation') == 0.01
+    assert settings.get_setting('deviation') == 0.005
+    assert replaced != settings and replaced.fingerprint != settings.fingerprint
+    assert replaced.replace(deviation=0.005) == settings
+
+    restored = pickle.loads(pickle.dumps(settings))
+    assert restored == settings and hash(restored) == hash(settings)
+
+
+def test_cache_extends_one_price_index_with_new_and_reloaded_competitors(monkeypatch):
+    now = [100.]
+    monkeypatch.setattr(pricing.time, 'monotonic', lambda: now[0])
+    cache = pricing.BranchCache(prices_ttl=60.)
+    loads = []
+
+    def get_prices(branches, price):
+        for id_branch in branches:
+            def load_prices(id_branch=id_branch):
+                loads.append(id_branch)
+                return pd.DataFrame({'govcode': [1, 2], 'govid': ['G1', 'G2'], 'innercode': [1, 2],
+                                     'price': [price, price + 1.], 'priceReserve': [price, price],
+                                     'ID_Branch': id_branch, 'DateTime': pd.Timestamp('2024-05-01')})
+            cache.get_branch_prices(id_branch, load_prices)
+        return cache.get_price_index(branches, pricing.GoodsPricing._concat_prices)
+
+    first = get_prices(['A', 'B'], 10.)
+    second = get_prices(['B', 'C'], 5.)
+    assert second is not first and get_prices(['A', 'C'], 1.) is second
+    assert loads == ['A', 'B', 'C']
+    assert second.get_min_prices(['G1', 'G2'], second.get_branch_codes(['A', 'B'])).tolist() == [10., 11.]
+    assert second.get_min_prices(['G1', 'G2'], second.get_branch_codes(['C'])).tolist() == [5., 6.]
+
+    # The prices expire, reloaded B's prices replace its rows and evicted A and C are dropped
+    now[0] += 61
+    third = get_prices(['B'], 20.)
+    assert loads[-1] == 'B'
+    assert third.get_min_prices(['G1'], third.get_branch_codes(['B'])).tolist() == [20.]
+    assert third.get_min_prices(['G1'], third.get_branch_codes(['A', 'B', 'C'])).tolist() == [20.]
+    assert first.get_min_prices(['G1'], first.get_branch_codes(['B'])).tolist() == [10.]
+
+
+def test_exported_prices_are_stored_when_the_archive_is_written(tmp_path, monkeypatch):
+    written = []
+
+    class Parser:
+        @staticmethod
+        def df_to_xml(df, full_path, item_name):
+            written.append(df)
+            open(full_path, 'w').close()
+
+    def write_archive(archive_name, file_name, codec, level):
+        if len(written) > 1:
+            raise OSError('Disk is full')
+
+    monkeypatch.setattr(pricing.ext_con, 'TabletkiParser', Parser, raising=False)
+    monkeypatch.setattr(pricing.archive_writer, 'write_archive', write_archive)
+    settings = make_settings(tmp_path, price_history=1.)
+    new_pricing = pricing.GoodsPricing(1, 10, 'A', settings)
+    new_pricing._id_pharmacy = 'A'
+    new_pricing._min_date = datetime.datetime(2024, 5, 1, 10)
+    new_pricing._new_prices = pd.DataFrame({
+        'Code': [1, 2], 'Name': ['N1', 'N2'], 'Producer': ['P', 'P'], 'Price': [10., 20.],
+        'PriceReserve': [9., 19.], 'Quantity': [1., 2.], 'ID_Goods': ['G1', 'G2']
+    })
+    try:
+        assert new_pricing.save_prices()
+        new_pricing._new_prices = new_pricing.new_prices.assign(PriceReserve=[8., 18.])
+        with pytest.raises(OSError):
+            new_pricing.save_prices()
+
+        history = new_pricing.get_history().scan(datetime.datetime(2000, 1, 1), datetime.datetime.now())
+    finally:
+        pricing.GoodsPricing._histories.pop(str(tmp_path / 'save'))
+
+    assert 'ID_Goods' not in written[0].columns
+    assert history['ID_Goods'].tolist() == ['G1', 'G2']
+    assert history['PriceReserve'].tolist() == [9., 19.]
+
+
+def test_pair_distances_match_the_distances_table(tmp_path, branches):
+    cache = pricing.BranchCache()
+    new_pricing = pricing.GoodsPricing(1, 10, 'A', make_settings(tmp_path), cache=cache)
+    new_pricing._calculate_pharmacy_table()
+    pairs = [('A', 'b'), ('C', 'D'), ('A', 'X')]
+
+    distances = new_pricing.get_branch_distances(pairs)
+    new_pricing._calculate_distance_table()
+
+    assert distances == new_pricing.get_branch_distances(pairs)
+    assert distances[2] is None
+    assert new_pricing.get_branch_distance('B', 'A') == distances[0] > 0
+    assert pricing.GoodsPricing.get_distance(50.45, 30.52, 50.4501, 30.5201) == distances[0]
+
+
+def test_pair_distances_are_memoized_by_recent_use():
+    cache = pricing.BranchCache(max_pairs=2)
+    calculated = []
+
+    def calculator(pairs):
+        calculated.append(pairs)
+        return [len(id_1 + id_2) for id_1, id_2 in pairs]
+
+    assert cache.get_pair_distances([('a', 'b'), ('B', 'A'), ('c', 'dd')], calculator) == [2, 2, 3]
+    cache.get_pair_distances([('A', 'B')], calculator)
+    cache.get_pair_distances([('e', 'f')], calculator)
+    cache.get_pair_distances([('A', 'B'), ('C', 'DD')], calculator)
+
+    # Keys don't depend on the pair's order, C-DD is evicted as the least recently used
+    assert calculated == [[('A', 'B'), ('C', 'DD')], [('E', 'F')], [('C', 'DD')]]
+
+
+def test_budgeted_prices_are_reduced_and_fail_over_the_budget(tmp_path, branches, monkeypatch):
+    class Connection:
+        def execute(self, url, method, pars, data_type):
+            return pd.DataFrame({'govcode': [1, 1, 2], 'govid': ['G1', 'G1', 'G2'], 'innercode': [1, 1, 2],
+                                 'price': [12., 10., 20.], 'priceReserve': [11., 9., 19.]})
+
+    @contextlib.contextmanager
+    def api_connection(settings):
+        yield Connection()
+
+    monkeypatch.setattr(pricing, 'api_connection', api_connection)
+    monkeypatch.setattr(pricing.GoodsPricing, '_get_band_competitors', lambda self, top_k=None: {300.: ['B', 'C']})
+
+    new_pricing = pricing.GoodsPricing(1, 10, 'A', make_settings(tmp_path, memory_budget=100., max_threads=2.))
+    new_pricing._calculate_pharmacy_table()
+    assert new_pricing._calculate_pharmacies_prices()
+    prices = new_pricing.competitors_prices.sort_values(['ID_Branch', 'ID_Goods'])
+    assert prices[['ID_Goods', 'ID_Branch', 'Price']].values.tolist() == [
+        ['G1', 'B', 10.], ['G2', 'B', 20.], ['G1', 'C', 10.], ['G2', 'C', 20.]]
+
+    # A part of the competitors would skew the prices, the pharmacy isn't priced
+    new_pricing = pricing.GoodsPricing(1, 10, 'A', make_settings(tmp_path, memory_budget=0.0001))
+    new_pricing._calculate_pharmacy_table()
+    assert not new_pricing._calculate_pharmacies_prices()
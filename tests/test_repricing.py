@@ -0,0 +1,150 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import goods_parallel
+import price_index
+import repricing
+
+
+class Settings:
+    def __init__(self, **values):
+        self._values = values
+
+    def get_setting(self, name):
+        return self._values[name]
+
+
+SETTINGS = Settings(prices=(100, 300, 500, 1000, 2000, 3000), distances=(300, 500, 1000, 2000, 5000),
+                    default_unit=1000, default_unit_price=5, deviation=0.01)
+
+
+def reprice_rows(pharmacy_prices, competitors_prices, band_competitors, ratio_matrix, settings):
+    """The per-row loop the vectorized repricing replaced"""
+
+    price_bands = list(settings.get_setting('prices'))
+    distances = list(settings.get_setting('distances'))
+
+    new_prices = []
+    for _, row in pharmacy_prices.iterrows():
+        id_goods = row.ID_Goods
+        if not id_goods or id_goods in repricing.UNLINKED_GOODS:
+            new_prices.append(row.PriceReserve)
+            continue
+
+        same_goods = pharmacy_prices[pharmacy_prices['ID_Goods'] == id_goods]
+        base_price = max(same_goods.Price)
+        reserve_price = max(same_goods.PriceReserve)
+        if competitors_prices is None:
+            new_prices.append(reserve_price)
+            continue
+        if not base_price:
+            base_price = reserve_price
+
+        fit_range = [band for band in price_bands if band > reserve_price]
+        price_range = fit_range[0] if fit_range else price_bands[-1]
+
+        goods_prices = competitors_prices[competitors_prices['ID_Goods'] == id_goods]
+        candidates = []
+        for pos, dist in enumerate(distances):
+            prices = goods_prices[goods_prices['ID_Branch'].isin(band_competitors[dist])].Price
+            min_price = 0 if prices.empty else min(prices)
+            new_price = round(min_price * ratio_matrix[price_bands.index(price_range)][pos], 2)
+            if new_price:
+                candidates.append(new_price)
+
+        min_new_price = min(candidates) if candidates else base_price
+        new_prices.append(min([base_price, max([reserve_price, min_new_price])]))
+
+    return np.array(new_prices, dtype=float)
+
+
+def make_prices(seed):
+    rng = np.random.default_rng(seed)
+    goods = ['G%d' % ind for ind in range(60)]
+
+    own_goods = list(rng.choice(goods, 80)) + ['', repricing.UNLINKED_GOODS[0], repricing.UNLINKED_GOODS[1]]
+    reserve = np.round(rng.uniform(10, 4000, len(own_goods)), 2)
+    pharmacy_prices = pd.DataFrame({
+        'ID_Goods': own_goods,
+        'Price': np.where(rng.random(len(own_goods)) < 0.1, 0., np.round(reserve * rng.uniform(1, 1.5, len(own_goods)), 2)),
+        'PriceReserve': reserve
+    })
+
+    branches = ['B%d' % ind for ind in range(12)]
+    competitors_prices = pd.DataFrame({
+        'ID_Goods': rng.choice(goods, 600),
+        'ID_Branch': rng.choice(branches, 600),
+        'Price': np.round(rng.uniform(5, 4500, 600), 2)
+    })
+    band_competitors = {dist: branches[pos * 2:pos * 2 + 3] for pos, dist in enumerate(SETTINGS.get_setting('distances'))}
+
+    return pharmacy_prices, competitors_prices, band_competitors
+
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_reprice_goods_matches_per_row_loop(seed):
+    pharmacy_prices, competitors_prices, band_competitors = make_prices(seed)
+    ratio_matrix = repricing.get_ratio_matrix(SETTINGS)
+    distances = SETTINGS.get_setting('distances')
+
+    index = price_index.MinPriceIndex(competitors_prices)
+    band_codes = repricing.get_band_codes(index, band_competitors, distances)
+    new_prices = repricing.reprice_goods(pharmacy_prices, index, band_codes, ratio_matrix,
+                                         SETTINGS.get_setting('prices'))
+
+    expected = reprice_rows(pharmacy_prices, competitors_prices, band_competitors, ratio_matrix, SETTINGS)
+    np.testing.assert_allclose(new_prices, expected)
+
+
+def test_reprice_goods_without_competitors_keeps_reserve_prices():
+    pharmacy_prices, _, band_competitors = make_prices(4)
+    ratio_matrix = repricing.get_ratio_matrix(SETTINGS)
+
+    new_prices = repricing.reprice_goods(pharmacy_prices, None, [], ratio_matrix, SETTINGS.get_setting('prices'))
+
+    expected = reprice_rows(pharmacy_prices, None, band_competitors, ratio_matrix, SETTINGS)
+    np.testing.assert_allclose(new_prices, expected)
+
+
+def test_extended_index_matches_an_index_of_all_the_prices():
+    pharmacy_prices, competitors_prices, band_competitors = make_prices(5)
+    ratio_matrix = repricing.get_ratio_matrix(SETTINGS)
+    distances = SETTINGS.get_setting('distances')
+    is_first = competitors_prices['ID_Branch'].isin(['B0', 'B1', 'B2', 'B3'])
+    old_prices = competitors_prices[competitors_prices['ID_Branch'] == 'B1'].assign(Price=1.)
+
+    # B1 is reloaded, its old prices are replaced
+    index = price_index.MinPriceIndex(pd.concat([competitors_prices[is_first & (competitors_prices['ID_Branch'] != 'B1')],
+                                                 old_prices]))
+    index = index.extend(competitors_prices[~is_first | (competitors_prices['ID_Branch'] == 'B1')], removed=['B1'])
+    expected_index = price_index.MinPriceIndex(competitors_prices)
+
+    goods = np.unique(competitors_prices['ID_Goods'])
+    for branches in (['B1'], ['B0', 'B5', 'B11'], ['B%d' % ind for ind in range(12)]):
+        np.testing.assert_allclose(index.get_min_prices(goods, index.get_branch_codes(branches)),
+                                   expected_index.get_min_prices(goods, expected_index.get_branch_codes(branches)))
+
+    band_codes = repricing.get_band_codes(index, band_competitors, distances)
+    new_prices = repricing.reprice_goods(pharmacy_prices, index, band_codes, ratio_matrix,
+                                         SETTINGS.get_setting('prices'))
+    expected = reprice_rows(pharmacy_prices, competitors_prices, band_competitors, ratio_matrix, SETTINGS)
+    np.testing.assert_allclose(new_prices, expected)
+
+
+def test_goods_pool_matches_serial_repricing():
+    pharmacy_prices, competitors_prices, band_competitors = make_prices(6)
+    ratio_matrix = repricing.get_ratio_matrix(SETTINGS)
+    index = price_index.MinPriceIndex(competitors_prices)
+    band_codes = repricing.get_band_codes(index, band_competitors, SETTINGS.get_setting('distances'))
+    price_bands = SETTINGS.get_setting('prices')
+
+    pool = goods_parallel.GoodsPool(3)
+    pool.min_goods = 0
+    try:
+        new_prices = pool.reprice_goods(pharmacy_prices, index, band_codes, ratio_matrix, price_bands)
+    finally:
+        pool.close()
+
+    expected = repricing.reprice_goods(pharmacy_prices, index, band_codes, ratio_matrix, price_bands)
+    np.testing.assert_array_equal(new_prices, expected)
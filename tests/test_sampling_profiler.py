@@ -0,0 +1,45 @@
+import time
+
+import sampling_profiler
+
+
+def busy(seconds):
+    ended = time.perf_counter() + seconds
+    while time.perf_counter() < ended:
+        sum(range(100))
+
+
+def test_samples_are_collapsed_by_stage(tmp_path):
+    profiler = sampling_profiler.SamplingProfiler(interval=0.002, modules=('test_sampling_profiler',))
+    stage = ['Ratios']
+
+    with profiler.record('pharmacy 15', stage=lambda: stage[0]) as recording:
+        busy(0.1)
+        stage[0] = 'Goods'
+        busy(0.1)
+
+    assert recording.samples > 0 and not recording.active
+    stages = recording.get_stages()
+    assert set(stages) <= {'Ratios', 'Goods'} and stages
+    assert sum(recording.stacks.values()) <= recording.seconds + 0.05
+    # Frames below the outermost frame of the focus modules are dropped
+    assert all(stack.split(';')[1].startswith('test_sampling_profiler:') for stack in recording.stacks)
+    assert 'test_sampling_profiler:busy' in recording.get_functions(modules=('test_sampling_profiler',))
+
+    file_name = recording.write(str(tmp_path / '15.folded'))
+    with open(file_name) as file:
+        lines = file.read().splitlines()
+    assert len(lines) == len(recording.stacks)
+    assert all(int(line.rsplit(' ', 1)[1]) >= 1 for line in lines)
+
+
+def test_sampling_thread_stops_without_recordings():
+    profiler = sampling_profiler.SamplingProfiler(interval=0.001)
+    with profiler.record('pharmacy 1'):
+        busy(0.01)
+
+    for _ in range(100):
+        if profiler._thread is None:
+            break
+        time.sleep(0.01)
+    assert profiler._thread is None
@@ -0,0 +1,34 @@
+import schedule_checkpoint
+
+
+def test_checkpoint_keeps_done_tasks_between_runs(tmp_path):
+    file_name = str(tmp_path / 'checkpoint.json')
+    archive = tmp_path / 'rest_10.zip'
+    archive.write_text('')
+
+    checkpoint = schedule_checkpoint.ScheduleCheckpoint(file_name)
+    checkpoint.set_done('a', '2024-05-01', str(archive))
+    checkpoint.set_done('B', '2024-05-01', '')
+    checkpoint.set_acknowledged(['A'])
+
+    checkpoint = schedule_checkpoint.ScheduleCheckpoint(file_name)
+    assert checkpoint.is_done('A', '2024-05-01')
+    assert checkpoint.is_acknowledged('A', '2024-05-01')
+    assert checkpoint.is_done('b', '2024-05-01')
+    assert not checkpoint.is_acknowledged('B', '2024-05-01')
+    # A new task timestamp of the branch is a new task
+    assert not checkpoint.is_done('A', '2024-05-02')
+
+
+def test_checkpoint_forgets_tasks_with_lost_archives_or_out_of_schedule(tmp_path):
+    archive = tmp_path / 'rest_10.zip'
+    archive.write_text('')
+    checkpoint = schedule_checkpoint.ScheduleCheckpoint(str(tmp_path / 'checkpoint.json'))
+    checkpoint.set_done('A', '2024-05-01', str(archive))
+    checkpoint.set_done('B', '2024-05-01', '')
+
+    archive.unlink()
+    assert not checkpoint.is_done('A', '2024-05-01')
+
+    checkpoint.keep_only([checkpoint.task_key('A', '2024-05-01')])
+    assert not checkpoint.is_done('B', '2024-05-01')
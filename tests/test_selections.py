@@ -0,0 +1,159 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import coverage_pushdown
+import selection_coverage
+import selections
+
+
+ENGINES = ('matrix', 'pushdown')
+
+
+def make_frames(seed):
+    rng = np.random.default_rng(seed)
+    countries = ['DE', 'FR']
+    articles = np.arange(1, 41)
+
+    segments = pd.DataFrame([(country, article) for country in countries for article in articles],
+                            columns=['country', 'article_id'])
+    segments['Brake Discs'] = rng.integers(0, 2, len(segments))
+    segments['Engine Oil Products'] = rng.integers(0, 2, len(segments))
+
+    def get_top():
+        return pd.DataFrame({
+            'country': rng.choice(countries, 30),
+            'article_id': rng.choice(articles, 30).astype(str),
+            'in_last': rng.integers(0, 3, 30)
+        }).drop_duplicates(['country', 'article_id'])
+
+    tiers = pd.DataFrame({'country': ['DE', 'DE', 'FR'], 'competitor': ['a', 'b', 'a'], 'tier': [1, 1, 1]})
+    competitors = pd.DataFrame({
+        'country': rng.choice(countries, 120),
+        'article_id': rng.choice(articles, 120),
+        'competitor': rng.choice(['a', 'b', 'c'], 120),
+        'vendor': rng.choice(['v1', 'v2', '', None], 120)
+    }).drop_duplicates(['country', 'article_id', 'competitor'])
+    competitors['is_scraped'] = 1
+
+    return {'top_30': get_top(), 'top_50': get_top(), 'segments': segments, 'competitors': competitors,
+            'tiers': tiers}
+
+
+def make_pipeline(frames, engine, cache_dir):
+    parameters = {}
+
+    def query(sql, database):
+        for name, (sql_template, _) in selections.SelectionPipeline._queries.items():
+            if sql == sql_template.format(**parameters):
+                return frames[name].copy()
+        raise AssertionError('Unknown query')
+
+    backend = coverage_pushdown.SQLiteBackend(frames['competitors']) if engine == 'pushdown' else None
+    pipeline = selections.SelectionPipeline('2024-05-01', cache_dir=str(cache_dir), query_func=query,
+                                            engine=engine, pushdown_backend=backend)
+    parameters.update(pipeline.parameters)
+    return pipeline
+
+
+def normalize(table):
+    table = table.copy()
+    table.index = table.index.astype(str)
+    table.columns = [str(col) for col in table.columns]
+    # Pivots of the long engine have no columns of use cases without articles
+    table = table.loc[:, (table != 0).any()]
+    return table[sorted(table.columns)].sort_index().astype(int)
+
+
+@pytest.mark.parametrize('seed', [1, 2])
+@pytest.mark.parametrize('engine', ENGINES)
+def test_tables_match_long_engine(tmp_path, seed, engine):
+    frames = make_frames(seed)
+    expected = make_pipeline(frames, 'long', tmp_path / 'long').run()
+    tables = make_pipeline(frames, engine, tmp_path / engine).run()
+
+    for table, expected_table in zip(tables, expected):
+        pd.testing.assert_frame_equal(normalize(table), normalize(expected_table), check_names=False)
+
+
+def test_query_cache_keeps_current_and_latest_partitions(tmp_path):
+    cache = selections.QueryCache(str(tmp_path), keep_partitions=2)
+    df = pd.DataFrame({'a': [1, 2]})
+    for partition in ('2024-05-01', '2024-05-02', '2024-05-03'):
+        cache.put(partition, 'key', df)
+
+    assert sorted(os.listdir(str(tmp_path))) == ['2024-05-02', '2024-05-03']
+    # A late write to an older partition does not drop the partition written
+    cache.put('2024-04-01', 'key', df)
+    assert '2024-04-01' in os.listdir(str(tmp_path))
+    pd.testing.assert_frame_equal(cache.get('2024-04-01', 'key'), df)
+    assert cache.get('2024-05-01', 'key') is None
+
+
+def test_pipeline_reuses_cached_steps(tmp_path):
+    segments = pd.DataFrame({'country': ['DE', 'DE', 'FR'], 'article_id': [1, 2, 1], 'Brake Discs': [1, 0, 1]})
+    top = pd.DataFrame({'country': ['DE'], 'article_id': ['2'], 'in_last': [1]})
+    frames = {'segments': segments, 'top_30': top, 'top_50': top}
+    calls = []
+
+    def query(sql, database):
+        for name, (sql_template, _) in selections.SelectionPipeline._queries.items():
+            if name in frames and sql == sql_template.format(**pipeline.parameters):
+                calls.append(name)
+                return frames[name].copy()
+        raise AssertionError('Unknown query')
+
+    pipeline = selections.SelectionPipeline('2024-05-01', cache_dir=str(tmp_path), query_func=query, engine='long')
+    table1 = pipeline.table1()
+    assert sorted(calls) == ['segments', 'top_30', 'top_50']
+
+    calls.clear()
+    pipeline = selections.SelectionPipeline('2024-05-01', cache_dir=str(tmp_path), query_func=query, engine='long')
+    pd.testing.assert_frame_equal(pipeline.table1(), table1)
+    assert calls == []
+
+    pipeline = selections.SelectionPipeline('2024-05-01', tiers=(1, 2), cache_dir=str(tmp_path),
+                                            query_func=query, engine='long')
+    pipeline.table1()
+    # Tiers are not an input of table1, only its queries with tiers are fetched again
+    assert sorted(calls) == ['top_30', 'top_50']
+
+
+def test_empty_vendor_is_counted_and_missing_one_is_not(tmp_path):
+    frames = make_frames(1)
+    for engine in ('long',) + ENGINES:
+        table3 = make_pipeline(frames, engine, tmp_path / engine).table3()
+        assert list(table3.index.astype(str)) == ['', 'v1', 'v2']
+
+
+def test_coverage_matches_between_engines(tmp_path):
+    frames = make_frames(3)
+    columns = ['country', 'competitor', 'use_case']
+    coverages = [make_pipeline(frames, engine, tmp_path / engine).coverage() for engine in ENGINES]
+    coverages = [df.astype({col: str for col in columns}).sort_values(columns).reset_index(drop=True)
+                 for df in coverages]
+
+    pd.testing.assert_frame_equal(coverages[0], coverages[1], check_dtype=False)
+
+
+def test_pushdown_table1_has_own_fingerprint(tmp_path):
+    frames = make_frames(1)
+    pipeline = make_pipeline(frames, 'pushdown', tmp_path)
+    pipeline.table1()
+
+    assert pipeline._get_step_fingerprint('pushdown_table1') != pipeline._get_step_fingerprint('matrix_table1')
+
+
+def test_coverage_matrix_keeps_one_mask_per_article():
+    segments = pd.DataFrame({'country': ['DE', 'DE', 'FR'], 'article_id': [2, 1, 1],
+                             'Brake Discs': [1, 1, 0], 'Engine Oil Products': [0, 1, 0]})
+    top = pd.DataFrame({'country': ['FR', 'DE'], 'article_id': ['1', '2'], 'in_last': [1, 0]})
+
+    matrix = selection_coverage.CoverageMatrix(segments, {'Top30%': top}, tiers=None)
+    masks = matrix.get_segments()
+
+    assert matrix.use_cases == ['Brake Discs', 'Engine Oil Products', 'Top30% Last Month', 'Top30% TTM']
+    assert masks[['country', 'article_id']].values.tolist() == [['DE', 1], ['DE', 2], ['FR', 1]]
+    assert masks['mask'].tolist() == [0b0011, 0b1001, 0b1100]
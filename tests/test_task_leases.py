@@ -0,0 +1,103 @@
+import time
+
+import pytest
+
+import task_leases
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(task_leases, 'time', clock)
+    return clock
+
+
+def test_claimed_task_is_free_after_its_lease_expires(tmp_path, clock):
+    leases = task_leases.LeaseTable(str(tmp_path / 'leases.db'), ttl=60)
+
+    assert leases.claim(['t1', 't2'], 'node_1') == 't1'
+    assert leases.claim(['t1', 't2'], 'node_2') == 't2'
+    assert leases.claim(['t1'], 'node_2') is None
+    # A restarted node claims its own lease again
+    assert leases.claim(['t1'], 'node_1') == 't1'
+
+    clock.now += 30
+    assert leases.renew('t1', 'node_1')
+    clock.now += 45
+    assert leases.claim(['t1', 't2'], 'node_3') == 't2'
+    assert not leases.renew('t2', 'node_2')
+    clock.now += 20
+    assert leases.claim(['t1'], 'node_3') == 't1'
+
+
+def test_done_and_released_tasks(tmp_path, clock):
+    leases = task_leases.LeaseTable(str(tmp_path / 'leases.db'), ttl=60)
+    leases.claim(['t1'], 'node_1')
+    leases.claim(['t2'], 'node_1')
+
+    assert leases.complete('t1', 'node_1')
+    assert leases.release('t2', 'node_1')
+
+    clock.now += 120
+    assert leases.claim(['t1', 't2'], 'node_2') == 't2'
+    assert leases.get_done(['t1', 't2'], 'node_1') == ['t1']
+    assert leases.get_done(['t1'], 'node_2') == []
+
+
+def test_done_leases_are_deleted_after_done_ttl(tmp_path, clock):
+    file_name = str(tmp_path / 'leases.db')
+    leases = task_leases.LeaseTable(file_name, ttl=60, done_ttl=3600)
+    for task_key in ('t1', 't2', 't3'):
+        leases.claim([task_key], 'node_1')
+    leases.complete('t1', 'node_1')
+
+    clock.now += 1800
+    assert leases.prune() == 0
+    leases.complete('t2', 'node_1')
+
+    clock.now += 1900
+    # t1 is done an hour ago, t3 of a crashed node expired an hour ago
+    assert leases.claim(['t4'], 'node_2') == 't4'
+    assert leases.get_done(['t1', 't2'], 'node_1') == ['t2']
+
+    count = leases._connection.execute('SELECT count(*) FROM leases').fetchone()[0]
+    assert count == 2
+
+
+def test_keeper_renews_lease_until_stopped(tmp_path):
+    leases = task_leases.LeaseTable(str(tmp_path / 'leases.db'), ttl=0.3)
+    leases.claim(['t1'], 'node_1')
+    renewed = []
+    renew = leases.renew
+
+    def count_renew(task_key, worker):
+        renewed.append(task_key)
+        return renew(task_key, worker)
+
+    leases.renew = count_renew
+    leases.keep('t1', 'node_1').start().stop()
+    assert renewed == []
+
+    with leases.keep('t1', 'node_1') as keeper:
+        leases.release('t1', 'node_1')
+        time.sleep(1.2)
+
+    assert renewed == ['t1']
+    assert keeper.is_lost
+
+
+def test_regions_are_shared_between_nodes():
+    nodes = [task_leases.RegionSharding(node, 3, cell_size=0.5) for node in (1, 2, 3)]
+    points = [(50. + lat * 0.5, 30. + lng * 0.5) for lat in range(6) for lng in range(6)]
+
+    for lat, lng in points:
+        assert sum(node.is_own(lat, lng) for node in nodes) == 1
+    assert all(any(node.is_own(lat, lng) for lat, lng in points) for node in nodes)
@@ -0,0 +1,48 @@
+import pandas as pd
+
+import task_scheduler
+
+
+NOW = '2024-05-01T12:00:00'
+
+
+def make_scheduler(tmp_path, seconds):
+    estimates = task_scheduler.RuntimeEstimates(str(tmp_path / 'estimates.json'))
+    for pharm_id, value in seconds.items():
+        estimates.update(pharm_id, value)
+    return task_scheduler.TaskScheduler(estimates, cell_size=0.02, max_wait=3600.)
+
+
+def test_overdue_tasks_go_first_then_the_biggest_cells(tmp_path):
+    scheduler = make_scheduler(tmp_path, {'a': 10., 'b': 50., 'c': 30., 'd': 5., 'e': 1.})
+    tasks = {
+        'a': ('A', '2024-05-01T11:50:00'),
+        'b': ('B', '2024-05-01T11:55:00'),
+        'c': ('C', '2024-05-01T11:59:00'),
+        'd': ('D', '2024-05-01T09:00:00'),
+        'e': ('E', '2024-05-01T10:00:00'),
+        'x': ('X', '')
+    }
+    coordinates = {'A': (50.001, 30.001), 'B': (50.005, 30.005), 'C': (50.101, 30.101),
+                   'D': (50.101, 30.101), 'E': (50.001, 30.001)}
+
+    order = scheduler.order(tasks, coordinates, now=NOW)
+
+    # Overdue D and E by age, then A and B's cell (60 s), C's cell (30 s) and X estimated by the median
+    assert order == ['d', 'e', 'b', 'a', 'c', 'x']
+
+
+def test_runtime_estimates_are_averaged_and_saved(tmp_path):
+    estimates = task_scheduler.RuntimeEstimates(str(tmp_path / 'estimates.json'), alpha=0.5)
+    assert estimates.get('a') == 1.
+
+    estimates.update('a', 10.)
+    estimates.update('A', 20.)
+    estimates.update('b', 4.)
+    estimates.save()
+
+    loaded = task_scheduler.RuntimeEstimates(estimates.file_name)
+    assert loaded.get('a') == 15.
+    assert loaded.get('unknown') == 9.5
+    assert task_scheduler.TaskScheduler.get_age('2024-05-01T11:00:00+00:00',
+                                                pd.Timestamp('2024-05-01T12:00:00+00:00')) == 3600.